@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+# Referential integrity check of BCML files, without building any SBML.
+#
+# Example of a command line :
+# $ python bcml_preflight.py ../DC-ATLAS/BCML/
+# $ python bcml_preflight.py TLR9.xml DC-SIGN.xml
+#
+# Each file is streamed once (expat, no tree is built). Declared IDs, references and
+# clone targets are kept in hash sets, and checked at the end of the file:
+# - refNode pointing to no species, Source/Sink or AndNode/OrNode
+# - cloneref pointing to no (non-clone) species
+# - ID declared twice, or two IDs giving the same SBML id
+# - species without label
+# - Process without Consumption or Production, and transcriptions (Source -> mRNA)
+#   without NecessaryStimulation, which bcml_to_sbml.py can't convert
+# The exit status is 1 if a problem was found.
+
+
+# General
+import sys
+import os.path
+import re
+import argparse
+import glob
+import xml.parsers.expat
+
+from bcml_to_sbml import idfy
+
+# Elements defining species in BCML
+speciesTags = ['Macromolecule', 'NucleicAcidFeature', 'SimpleChemical', 'Complex']
+# Other elements reactions can refer to
+nodeTags = ['Source', 'Sink', 'AndNode', 'OrNode']
+# Elements with a refNode, inside reactions and logic nodes
+referenceTags = ['Consumption', 'Production', 'Modulation', 'Inhibition', 'Catalysis', 'NecessaryStimulation', 'Stimulation', 'Logic']
+reactionTags = ['Association', 'Dissociation', 'Process']
+
+def scan(bcmlFile):
+	"""Problems found in a BCML file, as a sorted list of (line, kind, message)."""
+
+	problems = []
+	# ID -> line of its first declaration, for every element with an ID
+	declared = {}
+	# SBML id -> BCML ID, to find IDs that idfy() makes identical
+	sbmlIds = {}
+	# IDs that refNode may point to, and (non-clone) species IDs that cloneref may point to
+	nodeIds = set()
+	speciesIds = set()
+	references = []
+	clonerefs = []
+	# Reaction being read: (line, tag, ID, children refNode by tag)
+	reaction = [None]
+
+	def startElement(tag, attributes):
+		line = parser.CurrentLineNumber
+		elementId = attributes.get('ID')
+		if elementId is not None:
+			if elementId in declared:
+				problems.append((line, 'duplicate-id', "ID "+elementId+" already declared line "+str(declared[elementId])))
+			else:
+				declared[elementId] = line
+				sbmlId = idfy(elementId)
+				if sbmlId in sbmlIds and sbmlIds[sbmlId] != elementId:
+					problems.append((line, 'duplicate-id', "ID "+elementId+" and "+sbmlIds[sbmlId]+" both give SBML id "+sbmlId))
+				sbmlIds.setdefault(sbmlId, elementId)
+
+		if tag in speciesTags:
+			if attributes.get('cloneref') is not None:
+				clonerefs.append((line, attributes.get('cloneref')))
+			else:
+				if elementId is not None:
+					nodeIds.add(elementId)
+					speciesIds.add(elementId)
+				if tag != 'Complex' and attributes.get('label', '').strip() == '':
+					problems.append((line, 'empty-label', tag+" "+str(elementId)+" has no label"))
+		elif tag in nodeTags:
+			if elementId is not None:
+				nodeIds.add(elementId)
+		elif tag in reactionTags:
+			reaction[0] = (line, tag, elementId, {})
+		elif tag in referenceTags:
+			references.append((line, tag, attributes.get('refNode')))
+			if reaction[0] is not None and tag != 'Logic':
+				reaction[0][3].setdefault(tag, []).append(attributes.get('refNode'))
+
+	def endElement(tag):
+		if tag not in reactionTags or reaction[0] is None:
+			return
+		(line, reactionTag, reactionId, children) = reaction[0]
+		reaction[0] = None
+		if reactionTag != 'Process':
+			return
+		for childTag in ['Consumption', 'Production']:
+			if childTag not in children:
+				problems.append((line, 'missing-participant', "Process "+str(reactionId)+" has no "+childTag))
+		if 'Consumption' in children and 'Production' in children and 'NecessaryStimulation' not in children \
+				and str(children['Production'][0]).startswith("mRNA") and re.match("^[Ss][0-9]{1,2}$", str(children['Consumption'][0])) is not None:
+			problems.append((line, 'missing-participant', "transcription "+str(reactionId)+" has no NecessaryStimulation"))
+
+	parser = xml.parsers.expat.ParserCreate()
+	parser.StartElementHandler = startElement
+	parser.EndElementHandler = endElement
+	try:
+		with open(bcmlFile, 'rb') as bcmlHandle:
+			parser.ParseFile(bcmlHandle)
+	except xml.parsers.expat.ExpatError as error:
+		problems.append((error.lineno, 'malformed', str(error)))
+
+	for (line, tag, refNode) in references:
+		if refNode is None:
+			problems.append((line, 'dangling-ref', tag+" without refNode"))
+		elif refNode not in nodeIds:
+			problems.append((line, 'dangling-ref', tag+" refers to unknown node "+refNode))
+	for (line, cloneref) in clonerefs:
+		if cloneref not in speciesIds:
+			problems.append((line, 'dangling-cloneref', "cloneref to unknown species "+cloneref))
+
+	problems.sort(key=lambda problem: problem[0])
+	return problems
+
+def listFiles(paths):
+	"""BCML files given directly, or found in the given directories."""
+	bcmlFiles = []
+	for path in paths:
+		if os.path.isdir(path):
+			bcmlFiles += sorted(glob.glob(os.path.join(path, "*.xml")))
+		else:
+			bcmlFiles.append(path)
+	return bcmlFiles
+
+def report(bcmlFiles, output=sys.stdout):
+	"""Scan the files, printing one line per problem. Returns the number of files with problems."""
+	nbFailed = 0
+	for bcmlFile in bcmlFiles:
+		problems = scan(bcmlFile)
+		for (line, kind, message) in problems:
+			output.write(bcmlFile+":"+str(line)+": "+kind+": "+message+"\n")
+		if problems:
+			nbFailed += 1
+	return nbFailed
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Check references and IDs of BCML files without converting them.")
+	parser.add_argument('bcml', nargs='+', help="BCML files, or directories of BCML files")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+	bcmlFiles = listFiles(args.bcml)
+	nbFailed = report(bcmlFiles)
+	print(str(len(bcmlFiles))+" files checked, "+str(nbFailed)+" with problems")
+	return 1 if nbFailed != 0 else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
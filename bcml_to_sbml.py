@@ -10,12 +10,29 @@
 import sys
 import os.path
 import re
+import argparse
+import hashlib
+import json
 
 # For BCML
 import xml.etree.ElementTree as ET
 
-# For SBML
-from libsbml import *
+from error_report import collecting, MapError
+from canonical_order import sbmlListTag, entryKey
+
+# For SBML: libsbml takes a while to load, it is only imported once an SBML
+# document is actually read or built (see loadLibsbml), so that --help,
+# --dry-run or an up-to-date incremental run start fast
+libsbml = None
+
+__version__ = "1.0"
+
+def loadLibsbml():
+	global libsbml
+	if libsbml is None:
+		import libsbml as loadedLibsbml
+		libsbml = loadedLibsbml
+	return libsbml
 
 def check(value, message):
 	"""If 'value' is None, prints an error message constructed using
@@ -28,12 +45,12 @@ def check(value, message):
 	if value == None:
 		raise SystemExit('LibSBML returned a null value trying to ' + message + '.')
 	elif type(value) is int:
-		if value == LIBSBML_OPERATION_SUCCESS:
+		if value == loadLibsbml().LIBSBML_OPERATION_SUCCESS:
 			return
 		else:
 			err_msg = 'Error encountered trying to ' + message + '.' \
 				+ 'LibSBML returned error code ' + str(value) + ': "' \
-				+ OperationReturnValue_toString(value).strip() + '"'
+				+ loadLibsbml().OperationReturnValue_toString(value).strip() + '"'
 			raise SystemExit(err_msg)
 	else:
 		return
@@ -100,102 +117,39 @@ def addSimpleChemical(bcmlSimpleChem, sbmlModel, sbmlCompartmentId):
 	# Add note
 	check( sbmlSpecies.setNotes("<p xmlns='http://www.w3.org/1999/xhtml'>\n"+extractNotes(bcmlSimpleChem)+"</p>"), 								"Add notes")
 
-def addComplex(bcmlComplex, sbmlModel, sbmlCompartmentId):
-	
-	sbmlSpecies = sbmlModel.createSpecies()
-	#print(idfy(str(bcmlComplex.attrib.get('ID'))))
-	
-	# Id
-	check( sbmlSpecies.setId(idfy(str(bcmlComplex.attrib.get('ID')))),						"Set ID")
-	# Name
-	check( sbmlSpecies.setName(str(bcmlComplex.attrib.get('ID'))+":"),						"Set name")
-	# Compartment
-	check( sbmlSpecies.setCompartment(sbmlCompartmentId),									"Set compartment")
-	# SpeciesType
-	#check( sbmlSpecies.setSpeciesType("complex"),											"Set type")
+# Elements a complex can contain, in the order their species and notes are written:
+# BCML element, class in the notes, function adding a new species (None for sub-complexes)
+complexMemberTags = [('Macromolecule', 'MacroMolecule', addMacroMolecule),
+					('Complex', 'Complex', None),
+					('SimpleChemical', 'SimpleChemical', addSimpleChemical)]
+complexMemberAdders = dict((bcmlTag, addFunction) for (bcmlTag, memberClass, addFunction) in complexMemberTags)
+
+def complexMembers(bcmlComplex):
+	"""Members of a complex, in one pass over its children, as a list of
+	(BCML element, class, SBML id, True if the member is a new species)."""
+	groups = dict((bcmlTag, []) for (bcmlTag, memberClass, addFunction) in complexMemberTags)
+	for bcmlMember in bcmlComplex:
+		if bcmlMember.tag in groups:
+			groups[bcmlMember.tag].append(bcmlMember)
+	members = []
+	for (bcmlTag, memberClass, addFunction) in complexMemberTags:
+		for bcmlMember in groups[bcmlTag]:
+			if bcmlMember.attrib.get('cloneref') is None:
+				members.append((bcmlMember, memberClass, idfy(str(bcmlMember.attrib.get('ID'))), True))
+			else:
+				members.append((bcmlMember, memberClass, idfy(str(bcmlMember.attrib.get('cloneref'))), False))
+	return members
+
+def complexNotes(bcmlComplex, members):
 	
-	# Add notes
 	supplementaryNotes = ""
 	
 	# Add cardinality information as note (if present)
 	if bcmlComplex.attrib.get('cardinality') is not None:
 		supplementaryNotes += "Complex:Cardinality:"+str(bcmlComplex.attrib.get('cardinality'))+"\n"
 	
-	# Add supplementary macromolecules as species
-	countNewMacroMolecules = 0
-	countAll = 0
-	for bcmlMacromol in bcmlComplex.findall('Macromolecule'):
-		countAll+=1
-		if bcmlMacromol.attrib.get('cloneref') is None:
-			addMacroMolecule(bcmlMacromol, sbmlModel, sbmlCompartmentId)
-			countNewMacroMolecules+=1
-			supplementaryNotes += "Complex:MacroMolecule:"+idfy(str(bcmlMacromol.attrib.get('ID')))+"\n"
-		else:
-			supplementaryNotes += "Complex:MacroMolecule:"+idfy(str(bcmlMacromol.attrib.get('cloneref')))+"\n"
-	
-	# Add supplementary complex as species (yes, there can be complexes in complexes)
-	for bcmlSubComplex in bcmlComplex.findall('Complex'):
-		countAll+=1
-		if bcmlSubComplex.attrib.get('cloneref') is None:
-			addComplex(bcmlSubComplex, sbmlModel, sbmlCompartmentId)
-			countNewMacroMolecules+=1
-			supplementaryNotes += "Complex:Complex:"+idfy(str(bcmlSubComplex.attrib.get('ID')))+"\n"
-		else:
-			supplementaryNotes += "Complex:Complex:"+idfy(str(bcmlSubComplex.attrib.get('cloneref')))+"\n"
-	
-	# Can also contain SimpleChemicals
-	for bcmlSimpleChem in bcmlComplex.findall('SimpleChemical'):
-		countAll+=1
-		if bcmlSimpleChem.attrib.get('cloneref') is None:
-			addSimpleChemical(bcmlSimpleChem, sbmlModel, sbmlCompartmentId)
-			countNewMacroMolecules+=1
-			supplementaryNotes += "Complex:SimpleChemical:"+idfy(str(bcmlSimpleChem.attrib.get('ID')))+"\n"
-		else:
-			supplementaryNotes += "Complex:SimpleChemical:"+idfy(str(bcmlMacromol.attrib.get('cloneref')))+"\n"
-	
-	# Create a new association reaction if all macromolecules inside the complex are newly defined
-	if countAll==countNewMacroMolecules:
-		sbmlReaction = sbmlModel.createReaction()
-		# Add notes saying to report to the complex notes
-		check( sbmlReaction.setNotes("<p xmlns='http://www.w3.org/1999/xhtml'>\nReaction:Complex building\nSee produced Complex for details.</p>"),	"Add notes")
-		
-		if bcmlComplex.attrib.get('type') == 'And':
-			# ID
-			check( sbmlReaction.setId("ra"+idfy(str(bcmlComplex.attrib.get('ID')))),											"Set ID")
-			# Is reversible
-			check( sbmlReaction.setReversible(False),														"Set reversible")
-			# SBO term: and
-			check( sbmlReaction.setSBOTerm(173),															"Set SBO term")	
-			#print(sbmlReaction.getId())
-		
-		elif bcmlComplex.attrib.get('type') == 'Or':
-			# ID
-			check( sbmlReaction.setId("ro"+idfy(str(bcmlComplex.attrib.get('ID')))),											"Set ID")
-			# Is reversible
-			check( sbmlReaction.setReversible(False),														"Set reversible")
-			# SBO term: or
-			check( sbmlReaction.setSBOTerm(174),															"Set SBO term")	
-			#print(sbmlReaction.getId())
-			
-		else:
-			# ID
-			check( sbmlReaction.setId("ru"+idfy(str(bcmlComplex.attrib.get('ID')))),											"Set ID")
-			# Is reversible
-			check( sbmlReaction.setReversible(False),														"Set reversible")
-			# SBO term: logical combination (logic unknown or not specified)
-			check( sbmlReaction.setSBOTerm(237),															"Set SBO term")	
-			#print(sbmlReaction.getId())
-
-		# Add reactants
-		for bcmlReactant in bcmlComplex.findall('Macromolecule'):
-			sbmlReactant = sbmlReaction.createReactant()
-			#print("- "+bcmlReactant.attrib.get('label')+" "+idfy(bcmlReactant.attrib.get('ID')))
-			check( sbmlReactant.setSpecies(idfy(bcmlReactant.attrib.get('ID'))),					"Set Reference")
-		
-		# Add product
-		sbmlProduct = sbmlReaction.createProduct()
-		#print("+ "+idfy(bcmlComplex.attrib.get('ID')))
-		check( sbmlProduct.setSpecies(idfy(bcmlComplex.attrib.get('ID'))),						"Set Reference")
+	for (bcmlMember, memberClass, memberId, isNew) in members:
+		supplementaryNotes += "Complex:"+memberClass+":"+memberId+"\n"
 	
 	# Include logic information in notes
 	if bcmlComplex.attrib.get('type') == 'And':
@@ -204,14 +158,121 @@ def addComplex(bcmlComplex, sbmlModel, sbmlCompartmentId):
 		supplementaryNotes += "Complex:Logic:Or\n"
 	else:
 		supplementaryNotes += "Complex:Logic:?\n"
+	
+	return supplementaryNotes
 
-	# Add note
-	check( sbmlSpecies.setNotes("<p xmlns='http://www.w3.org/1999/xhtml'>\n"+supplementaryNotes+"\n"+extractNotes(bcmlComplex)+"</p>"),	"Add notes")
+def addComplexAssociation(bcmlComplex, members, sbmlModel):
+	
+	sbmlReaction = sbmlModel.createReaction()
+	# Add notes saying to report to the complex notes
+	check( sbmlReaction.setNotes("<p xmlns='http://www.w3.org/1999/xhtml'>\nReaction:Complex building\nSee produced Complex for details.</p>"),	"Add notes")
+	
+	if bcmlComplex.attrib.get('type') == 'And':
+		# ID
+		check( sbmlReaction.setId("ra"+idfy(str(bcmlComplex.attrib.get('ID')))),											"Set ID")
+		# Is reversible
+		check( sbmlReaction.setReversible(False),														"Set reversible")
+		# SBO term: and
+		check( sbmlReaction.setSBOTerm(173),															"Set SBO term")	
+	
+	elif bcmlComplex.attrib.get('type') == 'Or':
+		# ID
+		check( sbmlReaction.setId("ro"+idfy(str(bcmlComplex.attrib.get('ID')))),											"Set ID")
+		# Is reversible
+		check( sbmlReaction.setReversible(False),														"Set reversible")
+		# SBO term: or
+		check( sbmlReaction.setSBOTerm(174),															"Set SBO term")	
+		
+	else:
+		# ID
+		check( sbmlReaction.setId("ru"+idfy(str(bcmlComplex.attrib.get('ID')))),											"Set ID")
+		# Is reversible
+		check( sbmlReaction.setReversible(False),														"Set reversible")
+		# SBO term: logical combination (logic unknown or not specified)
+		check( sbmlReaction.setSBOTerm(237),															"Set SBO term")	
+
+	# Add reactants: every member (macromolecules, sub-complexes and simple chemicals)
+	for (bcmlMember, memberClass, memberId, isNew) in members:
+		sbmlReactant = sbmlReaction.createReactant()
+		check( sbmlReactant.setSpecies(memberId),					"Set Reference")
+	
+	# Add product
+	sbmlProduct = sbmlReaction.createProduct()
+	check( sbmlProduct.setSpecies(idfy(bcmlComplex.attrib.get('ID'))),						"Set Reference")
+
+def addComplex(bcmlComplex, sbmlModel, sbmlCompartmentId):
+	"""Add a complex, its new members and sub-complexes as species. Nested complexes
+	are walked with an explicit stack (no recursion limit), each complex once: species
+	are created in pre-order, and the association reactions in post-order, once all
+	members exist."""
+	
+	# Per complex ID: SBML species and members
+	visited = {}
+	stack = [('complex', bcmlComplex)]
+	while stack:
+		(task, bcmlElement) = stack.pop()
+		
+		if task == 'species':
+			complexMemberAdders[bcmlElement.tag](bcmlElement, sbmlModel, sbmlCompartmentId)
+			continue
+		
+		complexId = str(bcmlElement.attrib.get('ID'))
+		
+		if task == 'complex':
+			if complexId in visited:
+				continue
+			sbmlSpecies = sbmlModel.createSpecies()
+			# Id
+			check( sbmlSpecies.setId(idfy(complexId)),								"Set ID")
+			# Name
+			check( sbmlSpecies.setName(complexId+":"),								"Set name")
+			# Compartment
+			check( sbmlSpecies.setCompartment(sbmlCompartmentId),					"Set compartment")
+			# SpeciesType
+			#check( sbmlSpecies.setSpeciesType("complex"),							"Set type")
+			members = complexMembers(bcmlElement)
+			visited[complexId] = (sbmlSpecies, members)
+			
+			# New members are added in order, then the complex is finished
+			tasks = []
+			for (bcmlMember, memberClass, memberId, isNew) in members:
+				if isNew:
+					tasks.append(('complex' if bcmlMember.tag == 'Complex' else 'species', bcmlMember))
+			tasks.append(('finish', bcmlElement))
+			stack.extend(reversed(tasks))
+		
+		else:
+			(sbmlSpecies, members) = visited[complexId]
+			# Create a new association reaction if all members of the complex are newly defined
+			if all([ isNew for (bcmlMember, memberClass, memberId, isNew) in members ]):
+				addComplexAssociation(bcmlElement, members, sbmlModel)
+			# Add note
+			check( sbmlSpecies.setNotes("<p xmlns='http://www.w3.org/1999/xhtml'>\n"+complexNotes(bcmlElement, members)+"\n"+extractNotes(bcmlElement)+"</p>"),	"Add notes")
+
+def requiredChild(bcmlElement, tag):
+	"""First 'tag' child of a BCML element; MapError (a data error, see error_report.py) if it has none."""
+	bcmlChild = bcmlElement.find(tag)
+	if bcmlChild is None:
+		raise MapError(bcmlElement.tag+" "+str(bcmlElement.attrib.get('ID'))+" has no "+tag)
+	return bcmlChild
+
+def requiredRef(bcmlElement):
+	"""refNode of a BCML participant or Logic element; MapError if it has none."""
+	ref = bcmlElement.attrib.get('refNode')
+	if ref is None:
+		raise MapError(bcmlElement.tag+" without refNode")
+	return ref
+
+def logicNode(bcmlRoot, tag, nodeId):
+	"""AndNode or OrNode with this ID; MapError if there is none."""
+	for bcmlNode in bcmlRoot.iter(tag):
+		if bcmlNode.attrib.get('ID') == nodeId:
+			return bcmlNode
+	raise MapError("no "+tag+" "+str(nodeId))
 
 def addProcess(bcmlReaction, sbmlModel, sbmlCompartmentId, sbmlReactionNb, andDict, orDict, bcmlRoot):
     
-	bcmlReactant = bcmlReaction.find('Consumption')
-	bcmlProduct = bcmlReaction.find('Production')
+	bcmlProduct = requiredChild(bcmlReaction, 'Production')
 	
 	supplementaryNotes = ""
 	
@@ -221,7 +282,7 @@ def addProcess(bcmlReaction, sbmlModel, sbmlCompartmentId, sbmlReactionNb, andDi
 	check( sbmlReaction.setReversible(False),													"Set reversible")
 
 	# Checking if we have a case of transcription Source -> mRNA (with gene and TF referenced through a AndNode)
-	if str(bcmlProduct.attrib.get('refNode')).startswith("mRNA") and re.match("^[Ss][0-9]{1,2}$", str(bcmlReactant.attrib.get('refNode')), flags=0) is not None:
+	if str(bcmlProduct.attrib.get('refNode')).startswith("mRNA") and re.match("^[Ss][0-9]{1,2}$", str(requiredChild(bcmlReaction, 'Consumption').attrib.get('refNode')), flags=0) is not None:
 		
 		supplementaryNotes += "Reaction:Transcription\n"
 		
@@ -232,14 +293,14 @@ def addProcess(bcmlReaction, sbmlModel, sbmlCompartmentId, sbmlReactionNb, andDi
 		# SBO:0000183 - transcription
 		check( sbmlReaction.setSBOTerm(183),															"Set SBO term")	
 		
-		bcmlStimulation = bcmlReaction.find('NecessaryStimulation')
-		bcmlStimulationRefNode = bcmlStimulation.attrib.get('refNode')
+		bcmlStimulation = requiredChild(bcmlReaction, 'NecessaryStimulation')
+		bcmlStimulationRefNode = requiredRef(bcmlStimulation)
 		
 		if bcmlStimulationRefNode in andDict:
 			
-			bcmlAndNode = bcmlRoot.find(".//AndNode[@ID='"+bcmlStimulationRefNode+"']")
+			bcmlAndNode = logicNode(bcmlRoot, 'AndNode', bcmlStimulationRefNode)
 			for bcmlLog in bcmlAndNode.findall('Logic'):
-				if bcmlLog.attrib.get('refNode').startswith('gene'):
+				if requiredRef(bcmlLog).startswith('gene'):
 					supplementaryNotes += addReactant(bcmlLog, sbmlReaction, orDict, bcmlRoot)
 				else:
 					supplementaryNotes += addModulation(bcmlLog, sbmlReaction, orDict, bcmlRoot)
@@ -302,9 +363,9 @@ def addProcess(bcmlReaction, sbmlModel, sbmlCompartmentId, sbmlReactionNb, andDi
 	check( sbmlReaction.setNotes("<p xmlns='http://www.w3.org/1999/xhtml'>\n"+supplementaryNotes+"</p>"),	"Add notes")
 
 def addReactant(bcmlReactant, sbmlReaction, orDict, bcmlRoot):
-	speciesRef = bcmlReactant.attrib.get('refNode')
+	speciesRef = requiredRef(bcmlReactant)
 	if speciesRef in orDict:
-		bcmlOrNode = bcmlRoot.find(".//OrNode[@ID='"+speciesRef+"']")
+		bcmlOrNode = logicNode(bcmlRoot, 'OrNode', speciesRef)
 		notes = ""
 		for bcmlLog in bcmlOrNode.findall('Logic'):
 			notes += addReactant(bcmlLog, sbmlReaction, orDict, bcmlRoot)
@@ -320,9 +381,9 @@ def addReactant(bcmlReactant, sbmlReaction, orDict, bcmlRoot):
 	return ""
 	
 def addProduct(bcmlProduct, sbmlReaction, orDict, bcmlRoot):
-	speciesRef = bcmlProduct.attrib.get('refNode')
+	speciesRef = requiredRef(bcmlProduct)
 	if speciesRef in orDict:
-		bcmlOrNode = bcmlRoot.find(".//OrNode[@ID='"+speciesRef+"']")
+		bcmlOrNode = logicNode(bcmlRoot, 'OrNode', speciesRef)
 		notes = ""
 		for bcmlLog in bcmlOrNode.findall('Logic'):
 			notes += addProduct(bcmlLog, sbmlReaction, orDict, bcmlRoot)
@@ -338,9 +399,9 @@ def addProduct(bcmlProduct, sbmlReaction, orDict, bcmlRoot):
 	return ""
 
 def addModulation(bcmlModifier, sbmlReaction, orDict, bcmlRoot):
-	speciesRef = bcmlModifier.attrib.get('refNode')
+	speciesRef = requiredRef(bcmlModifier)
 	if speciesRef in orDict:
-		bcmlOrNode = bcmlRoot.find(".//OrNode[@ID='"+speciesRef+"']")
+		bcmlOrNode = logicNode(bcmlRoot, 'OrNode', speciesRef)
 		notes = ""
 		for bcmlLog in bcmlOrNode.findall('Logic'):
 			notes += addModulation(bcmlLog, sbmlReaction, orDict, bcmlRoot)
@@ -355,9 +416,9 @@ def addModulation(bcmlModifier, sbmlReaction, orDict, bcmlRoot):
 	return "Modulation:"+idfy(speciesRef)+"\n"
 
 def addInhibition(bcmlModifier, sbmlReaction, orDict, bcmlRoot):
-	speciesRef = bcmlModifier.attrib.get('refNode')
+	speciesRef = requiredRef(bcmlModifier)
 	if speciesRef in orDict:
-		bcmlOrNode = bcmlRoot.find(".//OrNode[@ID='"+speciesRef+"']")
+		bcmlOrNode = logicNode(bcmlRoot, 'OrNode', speciesRef)
 		notes = ""
 		for bcmlLog in bcmlOrNode.findall('Logic'):
 			notes += addInhibition(bcmlLog, sbmlReaction, orDict, bcmlRoot)
@@ -372,9 +433,9 @@ def addInhibition(bcmlModifier, sbmlReaction, orDict, bcmlRoot):
 	return "Inhibition:"+idfy(speciesRef)+"\n"
 
 def addCatalysis(bcmlModifier, sbmlReaction, orDict, bcmlRoot):
-	speciesRef = bcmlModifier.attrib.get('refNode')
+	speciesRef = requiredRef(bcmlModifier)
 	if speciesRef in orDict:
-		bcmlOrNode = bcmlRoot.find(".//OrNode[@ID='"+speciesRef+"']")
+		bcmlOrNode = logicNode(bcmlRoot, 'OrNode', speciesRef)
 		notes = ""
 		for bcmlLog in bcmlOrNode.findall('Logic'):
 			notes += addCatalysis(bcmlLog, sbmlReaction, orDict, bcmlRoot)
@@ -389,9 +450,9 @@ def addCatalysis(bcmlModifier, sbmlReaction, orDict, bcmlRoot):
 	return "Catalysis:"+idfy(speciesRef)+"\n"
 
 def addNecessaryStimulation(bcmlModifier, sbmlReaction, orDict, bcmlRoot):
-	speciesRef = bcmlModifier.attrib.get('refNode')
+	speciesRef = requiredRef(bcmlModifier)
 	if speciesRef in orDict:
-		bcmlOrNode = bcmlRoot.find(".//OrNode[@ID='"+speciesRef+"']")
+		bcmlOrNode = logicNode(bcmlRoot, 'OrNode', speciesRef)
 		notes = ""
 		for bcmlLog in bcmlOrNode.findall('Logic'):
 			notes += addNecessaryStimulation(bcmlLog, sbmlReaction, orDict, bcmlRoot)
@@ -410,10 +471,10 @@ def addStimulation(bcmlModifier, sbmlReaction, orDict, bcmlRoot):
 	if speciesRef is None or speciesRef == '':
 		speciesRef = bcmlModifier.text
 	if speciesRef is None:
-		raise SystemExit('Stimulation without a reference! ' + speciesRef + '.')
+		raise SystemExit('Stimulation without a reference!')
 	
 	if speciesRef in orDict:
-		bcmlOrNode = bcmlRoot.find(".//OrNode[@ID='"+speciesRef+"']")
+		bcmlOrNode = logicNode(bcmlRoot, 'OrNode', speciesRef)
 		notes = ""
 		for bcmlLog in bcmlOrNode.findall('Logic'):
 			notes += addStimulation(bcmlLog, sbmlReaction, orDict, bcmlRoot)
@@ -538,21 +599,30 @@ def extractNotes(bcmlElement):
 	# e.g. EntrezGeneId:Org:ID from upercase(Organism)/annotation
 	if bcmlElement.find('Organism') is not None:
 		hasNotes = True
-		# Loop through all Organism entries
-		for bcmlOrganism in bcmlElement.findall('Organism'):
-			# Loop through all annotation entries
-			for bcmlOrgAnnot in bcmlOrganism.findall('annotation'):
-				# ENTREZ: ?
-				organism = bcmlOrganism.attrib.get('name')
-				if organism is None:
-					organism = ""
-				sbmlNotes += bcmlOrgAnnot.attrib.get('DB')+":"+organism.upper()+":"+bcmlOrgAnnot.attrib.get('ID').strip()+"\n"
+		for (database, organism, identifier) in organismAnnotations(bcmlElement):
+			sbmlNotes += database+":"+organism+":"+identifier+"\n"
 	
 	# Notes must be XHTML. !! For later: Store in Protein/gene notes
 	
 	# Return notes as one string
 	return sbmlNotes
 
+def organismAnnotations(bcmlElement):
+	"""(DB, ORGANISM, ID) of all Organism/annotation entries of a BCML element"""
+	annotations = []
+	# Loop through all Organism entries
+	for bcmlOrganism in bcmlElement.findall('Organism'):
+		# Loop through all annotation entries
+		for bcmlOrgAnnot in bcmlOrganism.findall('annotation'):
+			# ENTREZ: ?
+			organism = bcmlOrganism.attrib.get('name')
+			if organism is None:
+				organism = ""
+			if bcmlOrgAnnot.attrib.get('ID') is None:
+				raise MapError("Organism annotation without ID")
+			annotations.append((bcmlOrgAnnot.attrib.get('DB'), organism.upper(), bcmlOrgAnnot.attrib.get('ID').strip()))
+	return annotations
+
 def idfy(string):
 	str1 = re.sub("[-+():, ]", '_', string)
 	if re.match('^[0-9]', str1):
@@ -560,14 +630,170 @@ def idfy(string):
 	return str1
 
 
-def main(argv):
+def hashElement(bcmlElement):
+	"""Content hash of a BCML element and its whole subtree. Formatting
+	whitespace is ignored so that re-indenting a file does not count as an edit.
+	"""
+	digest = hashlib.sha1()
+	for bcmlNode in bcmlElement.iter():
+		# Pre-order walk; storing the number of children keeps the tree shape
+		text = bcmlNode.text.strip() if bcmlNode.text is not None else ''
+		digest.update((bcmlNode.tag+"\x1f"+repr(sorted(bcmlNode.attrib.items()))+"\x1f"+text+"\x1f"+str(len(bcmlNode))+"\x1e").encode('utf-8'))
+	return digest.hexdigest()
+
+def elementKey(bcmlElement, sbmlCompartmentId, position):
+	# Fingerprints are keyed by BCML ID; elements without one fall back to their position
+	bcmlId = bcmlElement.attrib.get('ID')
+	if bcmlId is None:
+		return sbmlCompartmentId+":"+bcmlElement.tag+":"+str(position)
+	return bcmlId
+
+def recordElement(fingerprint, key, bcmlElement, sbmlModel, nbSpecies, nbReactions, sbmlCompartmentId, sbmlReactionNb=None):
+	"""Store in 'fingerprint' the hash of 'bcmlElement' together with the SBML
+	species and reactions its conversion created (everything after 'nbSpecies'
+	and 'nbReactions').
+	"""
+	if fingerprint is None:
+		return
+	entry = {'hash': hashElement(bcmlElement),
+			'compartment': sbmlCompartmentId,
+			'species': [ sbmlModel.getSpecies(i).getId() for i in range(nbSpecies, sbmlModel.getNumSpecies()) ],
+			'reactions': [ sbmlModel.getReaction(i).getId() for i in range(nbReactions, sbmlModel.getNumReactions()) ]}
+	if sbmlReactionNb is not None:
+		entry['reactionNb'] = sbmlReactionNb
+	fingerprint['elements'][key] = entry
+
+def logicHash(bcmlRoot):
+	# AndNode/OrNode are expanded into every reaction referencing them: any change invalidates all reactions
+	digest = hashlib.sha1()
+	for bcmlComp in bcmlRoot.iter('Compartment'):
+		for bcmlNode in bcmlComp.findall('AndNode') + bcmlComp.findall('OrNode'):
+			digest.update(hashElement(bcmlNode).encode('utf-8'))
+	return digest.hexdigest()
 
+compartmentLabelBlanks = re.compile('[\s+]')
+
+def compartmentLabel(bcmlComp):
+	bcmlCompLabel = bcmlComp.attrib.get('label')
+	if bcmlCompLabel is None:
+		return 'default'
+	return compartmentLabelBlanks.sub('', bcmlCompLabel)
+
+def addCompartment(bcmlComp, sbmlModel, sbmlCompartmentId, label=None):
+	
+	# Create an equivalent in SBML
+	sbmlComp = sbmlModel.createCompartment()
+	
+	# Set id
+	check(sbmlComp.setId(sbmlCompartmentId), "set compartment Id")
+	# Set name
+	if label is None:
+		label = compartmentLabel(bcmlComp)
+	check(sbmlComp.setName(str(label)), "set compartment Name")
+	# Set spatial dimensions (needed)
+	check(sbmlComp.setSpatialDimensions(3), 'set compartment dimensions')
+	# Set size (needed)
+	check(sbmlComp.setSize(1), 'set compartment "size"')
+	# Set units (needed)
+	check(sbmlComp.setUnits("volume"), 'set compartment units')
+	# Set outside
+	#check(sbmlComp.setOutside("default"), 'set compartment outside')
+	# Set constant (needed)
+	check(sbmlComp.setConstant(True), 'set compartment constant')
+
+# BCML species elements and the function converting them
+speciesConverters = [('Macromolecule', addMacroMolecule),
+					('NucleicAcidFeature', addNucleicAcidFeature),
+					('SimpleChemical', addSimpleChemical),
+					('Complex', addComplex)]
+
+def removeAddedElements(sbmlModel, nbSpecies, nbReactions):
+	"""Remove the species and reactions added after the first 'nbSpecies' and 'nbReactions',
+	so that an element that failed half-way leaves nothing behind."""
+	while sbmlModel.getNumReactions() > nbReactions:
+		sbmlModel.removeReaction(sbmlModel.getNumReactions()-1)
+	while sbmlModel.getNumSpecies() > nbSpecies:
+		sbmlModel.removeSpecies(sbmlModel.getNumSpecies()-1)
+
+def addSpecies(bcmlComp, sbmlModel, sbmlCompartmentId, fingerprint=None, selected=None, errors=None):
+	"""Add all species of a compartment. If 'selected' is given, only the
+	elements whose key is in it are converted. If 'errors' is an ErrorReport (see
+	error_report.py), a species that fails is recorded there and skipped."""
+	
+	position = 0
+	for (bcmlTag, addFunction) in speciesConverters:
+		for bcmlSpecies in bcmlComp.findall(bcmlTag):
+			position += 1
+			key = elementKey(bcmlSpecies, sbmlCompartmentId, position)
+			if selected is not None and key not in selected:
+				continue
+			nbSpecies = sbmlModel.getNumSpecies()
+			nbReactions = sbmlModel.getNumReactions()
+			with collecting(errors, "species", bcmlSpecies):
+				try:
+					addFunction(bcmlSpecies, sbmlModel, sbmlCompartmentId)
+				except (Exception, SystemExit):
+					removeAddedElements(sbmlModel, nbSpecies, nbReactions)
+					raise
+				recordElement(fingerprint, key, bcmlSpecies, sbmlModel, nbSpecies, nbReactions, sbmlCompartmentId)
+
+def collectLogicNodes(bcmlComp, andDict, orDict):
+	for bcmlAndNode in bcmlComp.findall('AndNode'):
+		andDict[bcmlAndNode.attrib.get('ID')] = [ idfy(str(bcmlLog.attrib.get('refNode'))) for bcmlLog in bcmlAndNode.findall('Logic') ]
+	for bcmlOrNode in bcmlComp.findall('OrNode'):
+		orDict[bcmlOrNode.attrib.get('ID')]	= [ idfy(str(bcmlLog.attrib.get('refNode'))) for bcmlLog in bcmlOrNode.findall('Logic') ]
+
+def queueReactions(bcmlComp, sbmlCompartmentId, reactionQueue, sbmlReactionNb, selected=None):
+	"""Append the reactions of a compartment to 'reactionQueue', as (BCML element,
+	compartment id, key, reaction number) records, numbered from 'sbmlReactionNb'.
+	If 'selected' is given, only the elements whose key is in it are queued,
+	with the reaction number it maps to. Returns the next free reaction number.
+	"""
+	
+	position = 0
+	for bcmlTag in ['Association', 'Dissociation', 'Process']:
+		for bcmlReaction in bcmlComp.findall(bcmlTag):
+			position += 1
+			key = elementKey(bcmlReaction, sbmlCompartmentId, position)
+			if selected is None:
+				reactionNb = sbmlReactionNb
+				sbmlReactionNb += 1
+			elif key in selected:
+				reactionNb = selected[key]
+			else:
+				continue
+			reactionQueue.append((bcmlReaction, sbmlCompartmentId, key, reactionNb))
+	
+	return sbmlReactionNb
+
+def addReactions(reactionQueue, sbmlModel, andDict, orDict, bcmlRoot, fingerprint=None, errors=None):
+	"""Convert the queued reactions, once all species and logic nodes are known:
+	libsbml doesn't add a reactant/product whose species doesn't exist yet.
+	If 'errors' is given, a reaction that fails is recorded there and skipped."""
+	
+	for (bcmlReaction, sbmlCompartmentId, key, reactionNb) in reactionQueue:
+		nbSpecies = sbmlModel.getNumSpecies()
+		nbReactions = sbmlModel.getNumReactions()
+		with collecting(errors, "reactions", bcmlReaction):
+			try:
+				# Process/Association/Dissociation
+				if bcmlReaction.tag == 'Process':
+					addProcess(bcmlReaction, sbmlModel, sbmlCompartmentId, reactionNb, andDict, orDict, bcmlRoot)
+				else:
+					addReaction(bcmlReaction, sbmlModel, sbmlCompartmentId, reactionNb, orDict, bcmlRoot)
+			except (Exception, SystemExit):
+				removeAddedElements(sbmlModel, nbSpecies, nbReactions)
+				raise
+			recordElement(fingerprint, key, bcmlReaction, sbmlModel, nbSpecies, nbReactions, sbmlCompartmentId, reactionNb)
+
+def createDocument(modelName):
+	
 	# Create an empty SBMLDocument object.  It's a good idea to check for
 	# possible errors.  Even when the parameter values are hardwired like
 	# this, it is still possible for a failure to occur (e.g., if the
 	# operating system runs out of memory).
 	try:
-		document = SBMLDocument(2, 4)
+		document = loadLibsbml().SBMLDocument(2, 4)
 	except ValueError:
 		raise SystemExit('Could not create SBMLDocumention object')
 	
@@ -578,7 +804,7 @@ def main(argv):
 	# Check model correctly created
 	check(sbmlModel, "create model")
 	# Add a name to the model
-	check(sbmlModel.setName(argv[1]), "Give name to model")
+	check(sbmlModel.setName(modelName), "Give name to model")
 	
 	# Set default units (best practice to set them)
 	#check(sbmlModel.setTimeUnits("second"), 'set model-wide time units')
@@ -602,10 +828,19 @@ def main(argv):
 	#sbmlSTcomplex.setId("complex")
 	#sbmlModel.addSpeciesType(sbmlSTcomplex)
 	
-	## Read BCML and create elements in SBML model
+	return document
+
+def convert(bcmlRoot, modelName, fingerprint=None, profiler=None, errors=None):
+	"""Build a complete SBMLDocument from a parsed BCML file. If 'fingerprint'
+	is a dictionary, it is filled with what is needed for a later incremental update.
+	Stage boundaries are reported to 'profiler' if given (see memory_profile.py).
+	Species and reactions that fail are skipped and recorded in 'errors' if given.
+	"""
 	
-	# Open BCML file and parse
-	bcmlRoot = ET.parse(argv[1]).getroot()
+	document = createDocument(modelName)
+	sbmlModel = document.getModel()
+	
+	## Read BCML and create elements in SBML model
 	
 	# Counter for compartments
 	compartmentCounter = 1
@@ -615,57 +850,28 @@ def main(argv):
 	sinkList = []
 	andDict = {}
 	orDict = {}
+	# Reactions, converted after the traversal
+	reactionQueue = []
+	sbmlReactionNb = 1
+	
+	if fingerprint is not None:
+		fingerprint['compartments'] = []
+		fingerprint['logic'] = logicHash(bcmlRoot)
+		fingerprint['elements'] = {}
 	
 	# Loop through each compartment
 	#print("* Compartment")
 	for bcmlComp in bcmlRoot.iter('Compartment'):
 		
-		# Get Compartment name
-		bcmlCompLabel = bcmlComp.attrib.get('label')
-		bcmlCompLabel = re.sub('[\s+]', '', bcmlCompLabel)
-		if bcmlCompLabel is None:
-			bcmlCompLabel = 'default'
-		#print(bcmlCompLabel)
-		
 		# Create an equivalent in SBML
-		sbmlComp = sbmlModel.createCompartment()
-		
-		# Set id
 		sbmlCompartmentId = "c"+str(compartmentCounter)
-		check(sbmlComp.setId(sbmlCompartmentId), "set compartment Id")
-		# Set name
-		check(sbmlComp.setName(str(bcmlCompLabel)), "set compartment Name")
-		# Set spatial dimensions (needed)
-		check(sbmlComp.setSpatialDimensions(3), 'set compartment dimensions')
-		# Set size (needed)
-		check(sbmlComp.setSize(1), 'set compartment "size"')
-		# Set units (needed)
-		check(sbmlComp.setUnits("volume"), 'set compartment units')
-		# Set outside
-		#check(sbmlComp.setOutside("default"), 'set compartment outside')
-		# Set constant (needed)
-		check(sbmlComp.setConstant(True), 'set compartment constant')
-				
-		# Add macromolecules as species and related information as notes
-		#print("* MacroMolecule")
-		for bcmlMacromol in bcmlComp.findall('Macromolecule'):
-			addMacroMolecule(bcmlMacromol, sbmlModel, sbmlCompartmentId)
-		
-		# Species:  NucleicAcidFeature : RNA, gene 
-		# <UnitOfInformation label="gene"/"mRNA"
-		#print("* Species")
-		for bcmlNAfeature in bcmlComp.findall('NucleicAcidFeature'):
-			addNucleicAcidFeature(bcmlNAfeature, sbmlModel, sbmlCompartmentId)
-		
-		# Species : SimpleChemical
-		#print("* SimpleChemical")
-		for bcmlSimpleChem in bcmlComp.findall('SimpleChemical'):
-			addSimpleChemical(bcmlSimpleChem, sbmlModel, sbmlCompartmentId)
-		
-		# Species: Complex
-		#print("* Complex")
-		for bcmlComplex in bcmlComp.findall('Complex'):
-			addComplex(bcmlComplex, sbmlModel, sbmlCompartmentId)
+		label = compartmentLabel(bcmlComp)
+		addCompartment(bcmlComp, sbmlModel, sbmlCompartmentId, label)
+		if fingerprint is not None:
+			fingerprint['compartments'].append(label)
+		
+		# Species: Macromolecule, NucleicAcidFeature (RNA, gene), SimpleChemical, Complex
+		addSpecies(bcmlComp, sbmlModel, sbmlCompartmentId, fingerprint, errors=errors)
 		
 		# Species: Source, Sink
 		# Are not explicit in SBML? eg reaction without reactant/product?
@@ -677,63 +883,506 @@ def main(argv):
 
 		# AndNode / OrNode
 		#print("* AndNode / OrNode")
-		for bcmlAndNode in bcmlComp.findall('AndNode'):
-			andDict[bcmlAndNode.attrib.get('ID')] = [ idfy(str(bcmlLog.attrib.get('refNode'))) for bcmlLog in bcmlAndNode.findall('Logic') ]
-		for bcmlOrNode in bcmlComp.findall('OrNode'):
-			orDict[bcmlOrNode.attrib.get('ID')]	= [ idfy(str(bcmlLog.attrib.get('refNode'))) for bcmlLog in bcmlOrNode.findall('Logic') ]
+		collectLogicNodes(bcmlComp, andDict, orDict)
+		
+		# Reactions: queued with their compartment, and converted once all species exist
+		# (reactions add species references. If the corresponding species don't 
+		# exist already, libsbml doesn't add them as reactant/product)
+		sbmlReactionNb = queueReactions(bcmlComp, sbmlCompartmentId, reactionQueue, sbmlReactionNb)
 		
 		compartmentCounter+=1
 	
 	#print(andDict)
 	#print(orDict)
+	if profiler is not None:
+		profiler.endStage("species")
 		
-	# Loop through each compartment again to create reactions
-	# Needed because reactions add species references. If the corresponding species don't 
-	# exist already, libsbml doesn't add them as reactant/product
-	#print("* Compartment for reactions")
-	sbmlReactionNb = 1
-	for bcmlComp in bcmlRoot.iter('Compartment'):
-		
-		# Get Compartment name
-		bcmlCompLabel = bcmlComp.attrib.get('label')
-		bcmlCompLabel = re.sub('[\s+]', '', bcmlCompLabel)
-		if bcmlCompLabel is None:
-			bcmlCompLabel = 'default'
-		#print(bcmlCompLabel)
-		
-		# Reaction
-		# Process/Association/Dissociation
-		#print("* Association")
-		for bcmlReaction in bcmlComp.findall('Association'):
-			addReaction(bcmlReaction, sbmlModel, sbmlCompartmentId, sbmlReactionNb, orDict, bcmlRoot)
-			sbmlReactionNb += 1
+	#print("* Reactions")
+	addReactions(reactionQueue, sbmlModel, andDict, orDict, bcmlRoot, fingerprint, errors)
+	
+	if fingerprint is not None:
+		fingerprint['nextReactionNb'] = sbmlReactionNb
+	if profiler is not None:
+		profiler.endStage("reactions")
+	
+	return document
+
+def updateIncrementally(bcmlRoot, document, fingerprint, errors=None):
+	"""Patch 'document', produced by an earlier conversion described by
+	'fingerprint', so that it matches 'bcmlRoot'. Only species and reactions
+	coming from added, removed or modified BCML elements are touched; all the
+	other SBML elements are left as they are. Returns the updated fingerprint,
+	or None if the change is too large to be patched (compartments changed, or a
+	removed species still referenced by an unchanged reaction).
+	"""
+	
+	sbmlModel = document.getModel()
+	
+	bcmlCompartments = list(bcmlRoot.iter('Compartment'))
+	if [ compartmentLabel(bcmlComp) for bcmlComp in bcmlCompartments ] != fingerprint['compartments']:
+		return None
+	
+	oldElements = fingerprint['elements']
+	newFingerprint = {'compartments': fingerprint['compartments'], 'logic': logicHash(bcmlRoot), 'elements': {}}
+	logicChanged = newFingerprint['logic'] != fingerprint['logic']
+	
+	# Sort current BCML elements into unchanged and to be (re)converted
+	andDict = {}
+	orDict = {}
+	changedSpecies = {}
+	changedReactions = {}
+	nextReactionNb = fingerprint['nextReactionNb']
+	for (compartmentIdx, bcmlComp) in enumerate(bcmlCompartments):
+		sbmlCompartmentId = "c"+str(compartmentIdx+1)
+		collectLogicNodes(bcmlComp, andDict, orDict)
 		
-		#print("* Dissociation")
-		for bcmlReaction in bcmlComp.findall('Dissociation'):
-			addReaction(bcmlReaction, sbmlModel, sbmlCompartmentId, sbmlReactionNb, orDict, bcmlRoot)
-			sbmlReactionNb += 1
+		position = 0
+		for (bcmlTag, addFunction) in speciesConverters:
+			for bcmlSpecies in bcmlComp.findall(bcmlTag):
+				position += 1
+				key = elementKey(bcmlSpecies, sbmlCompartmentId, position)
+				oldEntry = oldElements.get(key)
+				if oldEntry is not None and 'reactionNb' not in oldEntry and oldEntry['compartment'] == sbmlCompartmentId and oldEntry['hash'] == hashElement(bcmlSpecies):
+					newFingerprint['elements'][key] = oldEntry
+				else:
+					changedSpecies[key] = True
 		
-		#print("* Process")
-		for bcmlReaction in bcmlComp.findall('Process'):
-			addProcess(bcmlReaction, sbmlModel, sbmlCompartmentId, sbmlReactionNb, andDict, orDict, bcmlRoot)
-			sbmlReactionNb += 1
-	
+		position = 0
+		for bcmlTag in ['Association', 'Dissociation', 'Process']:
+			for bcmlReaction in bcmlComp.findall(bcmlTag):
+				position += 1
+				key = elementKey(bcmlReaction, sbmlCompartmentId, position)
+				oldEntry = oldElements.get(key)
+				if oldEntry is not None and 'reactionNb' in oldEntry and not logicChanged and oldEntry['compartment'] == sbmlCompartmentId and oldEntry['hash'] == hashElement(bcmlReaction):
+					newFingerprint['elements'][key] = oldEntry
+				elif oldEntry is not None and 'reactionNb' in oldEntry:
+					# Modified reaction keeps its SBML id
+					changedReactions[key] = oldEntry['reactionNb']
+				else:
+					changedReactions[key] = nextReactionNb
+					nextReactionNb += 1
+	newFingerprint['nextReactionNb'] = nextReactionNb
+	
+	# Remove everything created by removed or modified elements
+	for (key, oldEntry) in oldElements.items():
+		if key in newFingerprint['elements']:
+			continue
+		for sbmlReactionId in oldEntry['reactions']:
+			sbmlModel.removeReaction(sbmlReactionId)
+		for sbmlSpeciesId in oldEntry['species']:
+			sbmlModel.removeSpecies(sbmlSpeciesId)
+	
+	# Convert new and modified elements: species first, then reactions referencing them
+	reactionQueue = []
+	for (compartmentIdx, bcmlComp) in enumerate(bcmlCompartments):
+		sbmlCompartmentId = "c"+str(compartmentIdx+1)
+		addSpecies(bcmlComp, sbmlModel, sbmlCompartmentId, newFingerprint, changedSpecies, errors)
+		queueReactions(bcmlComp, sbmlCompartmentId, reactionQueue, None, changedReactions)
+	
+	# An unchanged reaction must not keep a reference to a species that is gone
+	for (key, entry) in newFingerprint['elements'].items():
+		for sbmlReactionId in entry['reactions']:
+			sbmlReaction = sbmlModel.getReaction(sbmlReactionId)
+			for sbmlList in [sbmlReaction.getListOfReactants(), sbmlReaction.getListOfProducts(), sbmlReaction.getListOfModifiers()]:
+				for sbmlReference in sbmlList:
+					if sbmlModel.getSpecies(sbmlReference.getSpecies()) is None:
+						return None
+	addReactions(reactionQueue, sbmlModel, andDict, orDict, bcmlRoot, newFingerprint, errors)
+	
+	return newFingerprint
+
+# Edge types of the graph sidecar: reactant/product, then modifiers by SBO term
+graphEdgeTypes = ['reactant', 'product', 'SBO:0000013', 'SBO:0000020', 'SBO:0000459', 'SBO:0000461', 'SBO:0000462']
+
+def writeGraph(sbmlModel, graphfile):
+	"""Write the species/reaction bipartite graph of 'sbmlModel' as CSR arrays
+	in an (uncompressed) .npz file. Nodes are the species, then the reactions,
+	named in 'ids'. Species point to the reactions they are reactant or modifier
+	of, reactions point to their products; 'edge_type' indexes 'edge_types'.
+	"""
+	import numpy
+	
+	nbSpecies = sbmlModel.getNumSpecies()
+	ids = [ sbmlModel.getSpecies(i).getId() for i in range(nbSpecies) ]
+	ids += [ sbmlModel.getReaction(i).getId() for i in range(sbmlModel.getNumReactions()) ]
+	nodeIndex = dict((nodeId, idx) for (idx, nodeId) in enumerate(ids))
+	edgeTypeIndex = dict((edgeType, idx) for (idx, edgeType) in enumerate(graphEdgeTypes))
+	
+	sources = []
+	targets = []
+	edgeTypes = []
+	for reactionIdx in range(sbmlModel.getNumReactions()):
+		sbmlReaction = sbmlModel.getReaction(reactionIdx)
+		reactionNode = nbSpecies+reactionIdx
+		references = [ (sbmlReactant, 'reactant') for sbmlReactant in sbmlReaction.getListOfReactants() ]
+		references += [ (sbmlModifier, sbmlModifier.getSBOTermID()) for sbmlModifier in sbmlReaction.getListOfModifiers() ]
+		references += [ (sbmlProduct, 'product') for sbmlProduct in sbmlReaction.getListOfProducts() ]
+		for (sbmlReference, edgeType) in references:
+			# References to undeclared species are skipped
+			if sbmlReference.getSpecies() not in nodeIndex or edgeType not in edgeTypeIndex:
+				continue
+			speciesNode = nodeIndex[sbmlReference.getSpecies()]
+			if edgeType == 'product':
+				sources.append(reactionNode)
+				targets.append(speciesNode)
+			else:
+				sources.append(speciesNode)
+				targets.append(reactionNode)
+			edgeTypes.append(edgeTypeIndex[edgeType])
+	
+	sources = numpy.array(sources, dtype=numpy.int32)
+	order = numpy.argsort(sources, kind='stable')
+	indptr = numpy.zeros(len(ids)+1, dtype=numpy.int32)
+	numpy.cumsum(numpy.bincount(sources, minlength=len(ids)), out=indptr[1:])
+	
+	numpy.savez(graphfile,
+			ids=numpy.array(ids),
+			n_species=numpy.array(nbSpecies),
+			indptr=indptr,
+			indices=numpy.array(targets, dtype=numpy.int32)[order],
+			edge_type=numpy.array(edgeTypes, dtype=numpy.int8)[order],
+			edge_types=numpy.array(graphEdgeTypes))
+
+# Tables written with --tables: name and columns, as (column, 'str' or 'int').
+# Lists (state variables, DB:ORGANISM:ID annotations) are joined with ';', missing SBO terms are -1.
+tableColumns = [('species', [('id', 'str'), ('name', 'str'), ('compartment', 'str'), ('class', 'str'), ('sbo', 'int'), ('state_variables', 'str'), ('organism_ids', 'str')]),
+				('reactions', [('id', 'str'), ('kind', 'str'), ('sbo', 'int')]),
+				('participants', [('reaction', 'str'), ('species', 'str'), ('role', 'str'), ('sbo', 'int')])]
+
+def readTables(bcmlRoot, sbmlModel):
+	"""Rows of the species, reactions and participants tables of a converted map."""
 	
+	# Class, state variables and annotations are read from BCML, by SBML id
+	bcmlSpeciesById = {}
+	for bcmlComp in bcmlRoot.iter('Compartment'):
+		for (bcmlTag, addFunction) in speciesConverters:
+			for bcmlSpecies in bcmlComp.iter(bcmlTag):
+				if bcmlSpecies.attrib.get('cloneref') is None:
+					bcmlSpeciesById.setdefault(idfy(str(bcmlSpecies.attrib.get('ID'))), bcmlSpecies)
+	
+	speciesRows = []
+	for sbmlSpecies in sbmlModel.getListOfSpecies():
+		bcmlSpecies = bcmlSpeciesById.get(sbmlSpecies.getId())
+		speciesClass = ''
+		stateVariables = []
+		organismIds = []
+		if bcmlSpecies is not None:
+			speciesClass = bcmlSpecies.tag
+			stateVariables = [ bcmlStateVariable.attrib.get('label').strip() for bcmlStateVariable in bcmlSpecies.findall('StateVariable') if bcmlStateVariable.attrib.get('label', '').strip() != '' ]
+			organismIds = [ str(database)+":"+organism+":"+identifier for (database, organism, identifier) in organismAnnotations(bcmlSpecies) ]
+		speciesRows.append((sbmlSpecies.getId(), sbmlSpecies.getName(), sbmlSpecies.getCompartment(), speciesClass,
+				sbmlSpecies.getSBOTerm(), ";".join(stateVariables), ";".join(organismIds)))
+	
+	reactionRows = []
+	participantRows = []
+	for sbmlReaction in sbmlModel.getListOfReactions():
+		# Kind of reaction, from the "Reaction:..." line of the notes
+		kind = re.search("Reaction:([^\n<]*)", sbmlReaction.getNotesString() if sbmlReaction.isSetNotes() else "")
+		reactionRows.append((sbmlReaction.getId(), kind.group(1).strip() if kind is not None else '', sbmlReaction.getSBOTerm()))
+		for sbmlReactant in sbmlReaction.getListOfReactants():
+			participantRows.append((sbmlReaction.getId(), sbmlReactant.getSpecies(), 'reactant', sbmlReactant.getSBOTerm()))
+		for sbmlProduct in sbmlReaction.getListOfProducts():
+			participantRows.append((sbmlReaction.getId(), sbmlProduct.getSpecies(), 'product', sbmlProduct.getSBOTerm()))
+		for sbmlModifier in sbmlReaction.getListOfModifiers():
+			participantRows.append((sbmlReaction.getId(), sbmlModifier.getSpecies(), 'modifier', sbmlModifier.getSBOTerm()))
+	
+	return {'species': speciesRows, 'reactions': reactionRows, 'participants': participantRows}
+
+def tablePath(outputfile, tableName, tableFormat):
+	return os.path.splitext(outputfile)[0]+"_"+tableName+"."+tableFormat
+
+def writeTables(tables, outputfile, tableFormat):
+	"""Write the tables next to the SBML file, as CSV (with a header) or as NumPy
+	structured arrays (.npy, fixed-width strings and int32). Returns the files written."""
+	tablefiles = []
+	for (tableName, columns) in tableColumns:
+		rows = tables[tableName]
+		tablefile = tablePath(outputfile, tableName, tableFormat)
+		if tableFormat == 'csv':
+			import csv
+			with open(tablefile, 'w') as tableHandle:
+				writer = csv.writer(tableHandle, lineterminator='\n')
+				writer.writerow([ column for (column, columnType) in columns ])
+				writer.writerows(rows)
+		else:
+			import numpy
+			dtype = []
+			for (idx, (column, columnType)) in enumerate(columns):
+				if columnType == 'int':
+					dtype.append((column, numpy.int32))
+				else:
+					dtype.append((column, 'U'+str(max([1]+[ len(row[idx]) for row in rows ]))))
+			numpy.save(tablefile, numpy.array(rows, dtype=dtype))
+		tablefiles.append(tablefile)
+	return tablefiles
+
+def fileHash(path):
+	digest = hashlib.sha1()
+	with open(path, 'rb') as fileHandle:
+		for block in iter(lambda: fileHandle.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def dryRun(bcmlRoot, outputfile):
+	"""Print what would be converted, without building any SBML."""
+	nbCompartments = 0
+	nbSpecies = 0
+	nbReactions = 0
+	for bcmlComp in bcmlRoot.iter('Compartment'):
+		nbCompartments += 1
+		for (bcmlTag, addFunction) in speciesConverters:
+			# Species defined inside complexes too
+			nbSpecies += len([ bcmlSpecies for bcmlSpecies in bcmlComp.iter(bcmlTag) if bcmlSpecies.attrib.get('cloneref') is None ])
+		for bcmlTag in ['Association', 'Dissociation', 'Process']:
+			nbReactions += len(bcmlComp.findall(bcmlTag))
+	print(str(nbCompartments)+" compartments, "+str(nbSpecies)+" species, "+str(nbReactions)+" reactions would be written to "+outputfile)
+
+def outputPath(bcmlFile):
+	outputdir = os.path.join(os.path.dirname(bcmlFile), "to_SBML")
+	return os.path.join(outputdir, os.path.splitext(os.path.basename(bcmlFile))[0]+"_sbml.xml")
+
+def fingerprintPath(outputfile):
+	return os.path.splitext(outputfile)[0]+"_fingerprint.json"
+
+def graphPath(outputfile):
+	return os.path.splitext(outputfile)[0]+"_graph.npz"
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Read a BCML file and create an SBML.")
+	parser.add_argument('bcml', help="BCML file to convert")
+	parser.add_argument('--version', action='version', version='%(prog)s '+__version__)
+	parser.add_argument('--dry-run', action='store_true',
+			help="only read the BCML file and print what would be converted")
+	parser.add_argument('--preflight', action='store_true',
+			help="only check the references, IDs and labels of the BCML file (see bcml_preflight.py)")
+	parser.add_argument('--incremental', action='store_true',
+			help="only add, remove or update the species and reactions affected by BCML changes since the previous "
+				"conversion, keeping the other elements of the existing SBML untouched (a fingerprint file is kept next to it)")
+	parser.add_argument('--identity-index', metavar='INDEX',
+			help="add the Organism annotations (DB, organism, ID) of the species of this map to a corpus-wide JSON index")
+	parser.add_argument('--memory-report', metavar='REPORT',
+			help="write a JSON report of the memory used by each stage (tracemalloc and RSS)")
+	parser.add_argument('--tables', choices=['csv', 'npy'],
+			help="also write species, reactions and participants tables next to the SBML, as CSV or NumPy structured arrays")
+	parser.add_argument('--metrics', metavar='FILE',
+			help="write conversion metrics (Prometheus text format) to this file at exit")
+	parser.add_argument('--metrics-port', metavar='PORT', type=int,
+			help="serve conversion metrics (Prometheus text format) on this local port while running")
+	parser.add_argument('--graph', action='store_true',
+			help="also write the species/reaction graph as CSR arrays in a _graph.npz file next to the SBML (needs numpy)")
+	parser.add_argument('--canonical', action='store_true',
+			help="write the SBML in canonical order (sorted by id), so that equivalent conversions are identical byte for byte")
+	parser.add_argument('--error-report', metavar='REPORT',
+			help="skip the species and reactions that fail instead of stopping at the first one, and write them to this JSON report")
+	args = parser.parse_args(argv[1:])
+	if not os.path.isfile(args.bcml):
+		parser.error("cannot read BCML file "+args.bcml)
+	return args
+
+def sbmlAttribute(sbmlItem, name):
+	# Attributes of canonical_order.canonicalLists, read through libsbml
+	if name == 'id':
+		return sbmlItem.getId()
+	if name == 'species':
+		return sbmlItem.getSpecies()
+	if name == 'sboTerm':
+		return sbmlItem.getSBOTermID()
+	raise KeyError(name)
+
+def sortListOf(sbmlList, listName):
+	sbmlItems = [ sbmlList.remove(0) for idx in range(sbmlList.size()) ]
+	sbmlItems.sort(key=entryKey(sbmlListTag(listName), sbmlAttribute))
+	for sbmlItem in sbmlItems:
+		check( sbmlList.appendAndOwn(sbmlItem),	"Append to sorted list")
+
+def canonicalize(document, modelName):
+	"""Put a document in canonical order, so that equivalent conversions are identical byte
+	for byte: compartments, species and reactions sorted by id, reactants, products and
+	modifiers by species. The model is named after the BCML file only, not its path."""
+	sbmlModel = document.getModel()
+	check( sbmlModel.setName(modelName),	"Give name to model")
+	sortListOf(sbmlModel.getListOfCompartments(), 'listOfCompartments')
+	sortListOf(sbmlModel.getListOfSpecies(), 'listOfSpecies')
+	sortListOf(sbmlModel.getListOfReactions(), 'listOfReactions')
+	for sbmlReaction in sbmlModel.getListOfReactions():
+		sortListOf(sbmlReaction.getListOfReactants(), 'listOfReactants')
+		sortListOf(sbmlReaction.getListOfProducts(), 'listOfProducts')
+		sortListOf(sbmlReaction.getListOfModifiers(), 'listOfModifiers')
+
+def recordMetrics(metrics, sbmlModel):
+	"""Count the species, reactions and modifiers of a model by SBO term."""
+	from metrics import sboLabel
+	for sbmlSpecies in sbmlModel.getListOfSpecies():
+		metrics.inc('bcml_species_total', sbo=sboLabel(sbmlSpecies.getSBOTermID()))
+	for sbmlReaction in sbmlModel.getListOfReactions():
+		metrics.inc('bcml_reactions_total', sbo=sboLabel(sbmlReaction.getSBOTermID()))
+		for sbmlModifier in sbmlReaction.getListOfModifiers():
+			metrics.inc('bcml_modifiers_total', sbo=sboLabel(sbmlModifier.getSBOTermID()))
+
+def convertFile(args, outputfile, upToDate, profiler=None, errors=None):
+	"""Convert (or patch) the SBML of args.bcml and write it with its sidecars.
+	Returns the SBML document (None if nothing was converted) and the files written.
+	Species and reactions that fail are skipped and recorded in 'errors' if given."""
 	
+	# Open BCML file and parse
+	bcmlRoot = ET.parse(args.bcml).getroot()
+	if profiler is not None:
+		profiler.endStage("parse BCML")
+	
+	if args.dry_run:
+		dryRun(bcmlRoot, outputfile)
+		return (None, [])
+	
+	document = None
+	fingerprint = None
+	writtenFiles = []
+	if upToDate:
+		pass
+	elif args.incremental:
+		# Patch the previous conversion if there is one with its fingerprint
+		fingerprintfile = fingerprintPath(outputfile)
+		nbErrors = len(errors.errors) if errors is not None else 0
+		if os.path.exists(outputfile) and os.path.exists(fingerprintfile):
+			with open(fingerprintfile) as fingerprintHandle:
+				oldFingerprint = json.load(fingerprintHandle)
+			# Only the SBML the fingerprint was written with can be patched
+			if oldFingerprint.get('output') == fileHash(outputfile):
+				document = loadLibsbml().readSBMLFromFile(outputfile)
+				if document.getModel() is not None:
+					fingerprint = updateIncrementally(bcmlRoot, document, oldFingerprint, errors)
+			if profiler is not None:
+				profiler.endStage("incremental update")
+		# Fall back to a full conversion, without the errors of the abandoned patch
+		if fingerprint is None:
+			if errors is not None:
+				del errors.errors[nbErrors:]
+			fingerprint = {}
+			document = convert(bcmlRoot, args.bcml, fingerprint, profiler, errors)
+	else:
+		document = convert(bcmlRoot, args.bcml, profiler=profiler, errors=errors)
+		# The fingerprint of an earlier incremental run no longer describes the SBML
+		if os.path.exists(fingerprintPath(outputfile)):
+			os.remove(fingerprintPath(outputfile))
 	
 	## Print SBML model in file
 	
-	# Print SBML in file
-	outputdir = os.path.join(os.path.dirname(argv[1]), "to_SBML")
-	if not os.path.exists(outputdir):
-		os.makedirs(outputdir)
-	outputfile = os.path.join(outputdir, os.path.splitext(os.path.basename(argv[1]))[0]+"_sbml.xml")
-	writeSBMLToFile(document, outputfile)
+	if document is not None:
+		if args.canonical:
+			canonicalize(document, os.path.basename(args.bcml))
+		
+		# Print SBML in file
+		outputdir = os.path.dirname(outputfile)
+		if not os.path.exists(outputdir):
+			os.makedirs(outputdir)
+		libsbml.writeSBMLToFile(document, outputfile)
+		writtenFiles.append(outputfile)
+		if profiler is not None:
+			profiler.endStage("write SBML")
+		
+		if fingerprint is not None:
+			fingerprint['source'] = fileHash(args.bcml)
+			fingerprint['output'] = fileHash(outputfile)
+			fingerprint['canonical'] = args.canonical
+			# Skipped elements are converted again by the next run, even if the BCML didn't change
+			fingerprint['errors'] = len(errors.errors) if errors is not None else 0
+			with open(fingerprintPath(outputfile), 'w') as fingerprintHandle:
+				json.dump(fingerprint, fingerprintHandle, indent=1, sort_keys=True)
+			writtenFiles.append(fingerprintPath(outputfile))
+		
+		if args.graph:
+			writeGraph(document.getModel(), graphPath(outputfile))
+			writtenFiles.append(graphPath(outputfile))
+		
+		if args.tables is not None:
+			writtenFiles += writeTables(readTables(bcmlRoot, document.getModel()), outputfile, args.tables)
+	
+	if args.identity_index is not None:
+		import identity_index
+		identity_index.updateMap(args.identity_index, args.bcml, identity_index.readOccurrences(bcmlRoot))
+	
+	if profiler is not None:
+		profiler.endStage("write sidecars")
 	
 	# Print SBML on STDOUT
 	#print(writeSBMLToString(document))
 	
+	return (document, writtenFiles)
 
+def main(argv):
+	
+	args = parseArguments(argv)
+	outputfile = outputPath(args.bcml)
+	
+	if args.preflight:
+		import bcml_preflight
+		return 1 if bcml_preflight.report([args.bcml]) != 0 else 0
+	
+	collector = None
+	if args.metrics is not None or args.metrics_port is not None:
+		import metrics
+		collector = metrics.Metrics('bcml_to_sbml')
+		if args.metrics_port is not None:
+			collector.serve(args.metrics_port)
+	
+	# Incremental run on an unchanged file: nothing to convert
+	upToDate = False
+	if args.incremental and not args.dry_run and os.path.exists(outputfile) and os.path.exists(fingerprintPath(outputfile)) \
+			and (not args.graph or os.path.exists(graphPath(outputfile))) \
+			and (args.tables is None or os.path.exists(tablePath(outputfile, 'species', args.tables))):
+		with open(fingerprintPath(outputfile)) as fingerprintHandle:
+			oldFingerprint = json.load(fingerprintHandle)
+			upToDate = oldFingerprint.get('source') == fileHash(args.bcml) and oldFingerprint.get('canonical', False) == args.canonical \
+					and oldFingerprint.get('errors', 0) == 0 and oldFingerprint.get('output') == fileHash(outputfile)
+	if upToDate and args.identity_index is None and args.memory_report is None and args.error_report is None:
+		if collector is not None:
+			collector.inc('bcml_files_processed_total')
+			collector.inc('bcml_bytes_read_total', os.path.getsize(args.bcml))
+			if args.metrics is not None:
+				collector.write(args.metrics)
+		return
+	
+	profiler = None
+	if args.memory_report is not None:
+		import memory_profile
+		profiler = memory_profile.MemoryProfiler()
+	
+	stages = profiler
+	if collector is not None:
+		stages = metrics.StageObservers([profiler, collector])
+	
+	errors = None
+	if args.error_report is not None:
+		import error_report
+		errors = error_report.ErrorReport(args.bcml)
+	
+	try:
+		(document, writtenFiles) = convertFile(args, outputfile, upToDate, stages, errors)
+	except (Exception, SystemExit) as error:
+		if collector is not None:
+			collector.fail(error)
+			if args.metrics is not None:
+				collector.write(args.metrics)
+		raise
+	
+	if profiler is not None:
+		profiler.write(args.memory_report)
+	
+	if collector is not None:
+		collector.inc('bcml_files_processed_total')
+		collector.inc('bcml_bytes_read_total', os.path.getsize(args.bcml))
+		collector.inc('bcml_bytes_written_total', sum([ os.path.getsize(writtenFile) for writtenFile in writtenFiles ]))
+		if document is not None:
+			recordMetrics(collector, document.getModel())
+		if args.metrics is not None:
+			collector.write(args.metrics)
+	
+	if errors is not None:
+		error_report.writeReport(args.error_report, [errors.state()])
+		for line in errors.lines():
+			sys.stderr.write(line+"\n")
+		if len(errors.errors) != 0:
+			return 1
+	
 
 if __name__ == "__main__":
-	main(sys.argv)
+	sys.exit(main(sys.argv))
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# Throughput regression harness for bcml_to_sbml.py and improve_cd_file.py.
+#
+# Example of a command line :
+# $ python benchmark_corpus.py ../corpus --save-baseline baseline.json
+# $ python benchmark_corpus.py ../corpus --baseline baseline.json --results results.jsonl
+#
+# The corpus directory holds BCML files in BCML/ and CellDesigner files in CellDesigner/.
+# It is copied into a temporary directory, and each file is processed by its script in a
+# separate process, for which wall time and peak RSS are measured. Outputs are hashed.
+# Every run is appended to the results store (one JSON object per line). Compared with a
+# baseline, timing/memory regressions and output changes are reported separately:
+# exit status 1 for a slowdown or memory growth, 2 for changed outputs, 3 for both.
+
+
+# General
+import sys
+import os
+import os.path
+import argparse
+import glob
+import hashlib
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+# Per stage: corpus sub-directory, script, and where the script writes its output
+stages = [('BCML', 'bcml_to_sbml.py', lambda relPath: os.path.join(os.path.dirname(relPath), "to_SBML", os.path.splitext(os.path.basename(relPath))[0]+"_sbml.xml")),
+		('CellDesigner', 'improve_cd_file.py', lambda relPath: os.path.join("modified_CDML", os.path.basename(relPath)))]
+
+def fileHash(path):
+	if not os.path.exists(path):
+		return None
+	digest = hashlib.sha256()
+	with open(path, 'rb') as fileHandle:
+		for block in iter(lambda: fileHandle.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def runOne(python, script, relPath, workdir):
+	"""Run a script on one file. Returns wall time (s), peak RSS (kB) and exit status."""
+	start = time.time()
+	process = subprocess.Popen([python, os.path.join(scriptDir, script), relPath], cwd=workdir,
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	# wait4 gives the resource usage of this child only
+	(pid, status, rusage) = os.wait4(process.pid, 0)
+	wallTime = time.time()-start
+	process.returncode = os.waitstatus_to_exitcode(status)
+	return (wallTime, rusage.ru_maxrss, process.returncode)
+
+def runCorpus(corpusDir, repeat=1, python=sys.executable):
+	"""Process all corpus files. Returns a dictionary of per-file results and the aggregate."""
+	files = {}
+	workdir = tempfile.mkdtemp(prefix="benchmark_corpus_")
+	try:
+		for (subDir, script, outputOf) in stages:
+			for path in sorted(glob.glob(os.path.join(corpusDir, subDir, "*.xml"))):
+				relPath = os.path.join(subDir, os.path.basename(path))
+				key = script+":"+relPath
+				best = None
+				for run in range(repeat):
+					# Fresh copy of the input, and no output left from the previous run
+					shutil.rmtree(os.path.join(workdir, subDir), ignore_errors=True)
+					shutil.rmtree(os.path.join(workdir, "modified_CDML"), ignore_errors=True)
+					os.makedirs(os.path.join(workdir, subDir))
+					shutil.copy(path, os.path.join(workdir, relPath))
+					(wallTime, peakRss, status) = runOne(python, script, relPath, workdir)
+					if best is None or wallTime < best['wall']:
+						best = {'wall': wallTime, 'rss_kb': peakRss, 'status': status,
+								'hash': fileHash(os.path.join(workdir, outputOf(relPath)))}
+				files[key] = best
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+
+	aggregate = {'wall': sum(result['wall'] for result in files.values()),
+				'rss_kb': max([0]+[ result['rss_kb'] for result in files.values() ]),
+				'files': len(files),
+				'failures': len([ result for result in files.values() if result['status'] != 0 ])}
+	return {'files': files, 'aggregate': aggregate}
+
+def compare(results, baseline, tolerance, rssTolerance, minTime):
+	"""Returns lists of (key, message) for performance regressions and for output changes."""
+	regressions = []
+	changes = []
+	for (key, result) in sorted(results['files'].items()):
+		reference = baseline['files'].get(key)
+		if reference is None:
+			changes.append((key, "not in baseline"))
+			continue
+		if result['hash'] != reference['hash'] or result['status'] != reference['status']:
+			changes.append((key, "output changed (status "+str(reference['status'])+" -> "+str(result['status'])+")"))
+		# Very short runs are dominated by noise
+		if result['wall'] > reference['wall']*(1+tolerance) and result['wall']-reference['wall'] > minTime:
+			regressions.append((key, "wall time %.3fs -> %.3fs" % (reference['wall'], result['wall'])))
+		if result['rss_kb'] > reference['rss_kb']*(1+rssTolerance):
+			regressions.append((key, "peak RSS %d kB -> %d kB" % (reference['rss_kb'], result['rss_kb'])))
+	for key in sorted(set(baseline['files'])-set(results['files'])):
+		changes.append((key, "missing from this run"))
+
+	reference = baseline['aggregate']
+	result = results['aggregate']
+	if result['wall'] > reference['wall']*(1+tolerance) and result['wall']-reference['wall'] > minTime:
+		regressions.append(("total", "wall time %.3fs -> %.3fs" % (reference['wall'], result['wall'])))
+	return (regressions, changes)
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Throughput regression harness over a local corpus.")
+	parser.add_argument('corpus', help="corpus directory, with BCML/ and CellDesigner/ sub-directories")
+	parser.add_argument('--repeat', type=int, default=1, help="runs per file, the fastest is kept (default: 1)")
+	parser.add_argument('--python', default=sys.executable, help="Python interpreter running the scripts (default: this one)")
+	parser.add_argument('--results', default=None, help="results store to append this run to (JSON lines)")
+	parser.add_argument('--label', default=None, help="label of this run in the results store")
+	parser.add_argument('--baseline', default=None, help="baseline to compare with")
+	parser.add_argument('--save-baseline', default=None, metavar='BASELINE', help="save this run as baseline")
+	parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative wall time increase (default: 0.2)")
+	parser.add_argument('--rss-tolerance', type=float, default=0.1, help="allowed relative peak RSS increase (default: 0.1)")
+	parser.add_argument('--min-time', type=float, default=0.05, help="wall time increases below this many seconds are ignored (default: 0.05)")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+
+	results = runCorpus(args.corpus, args.repeat, args.python)
+	results['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+	results['label'] = args.label
+	aggregate = results['aggregate']
+	print("%d files, %d failures, %.3fs, peak RSS %d kB" % (aggregate['files'], aggregate['failures'], aggregate['wall'], aggregate['rss_kb']))
+
+	if args.results is not None:
+		with open(args.results, 'a') as resultsHandle:
+			resultsHandle.write(json.dumps(results, sort_keys=True)+"\n")
+
+	if args.save_baseline is not None:
+		with open(args.save_baseline, 'w') as baselineHandle:
+			json.dump(results, baselineHandle, indent=1, sort_keys=True)
+
+	exitStatus = 0
+	if args.baseline is not None:
+		with open(args.baseline) as baselineHandle:
+			baseline = json.load(baselineHandle)
+		(regressions, changes) = compare(results, baseline, args.tolerance, args.rss_tolerance, args.min_time)
+		if regressions:
+			exitStatus |= 1
+			print("Performance regressions:")
+			for (key, message) in regressions:
+				print("  "+key+": "+message)
+		if changes:
+			exitStatus |= 2
+			print("Output changes:")
+			for (key, message) in changes:
+				print("  "+key+": "+message)
+		if exitStatus == 0:
+			print("No regression against "+args.baseline)
+	return exitStatus
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
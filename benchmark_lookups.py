@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+# Cost of one lookup in improve_cd_file.py: paths built by pasting ids (parsed again by
+# lxml for every new id) against the precompiled XPath lookups with variables.
+#
+# Example of a command line :
+# $ python benchmark_lookups.py ../DC-ATLAS/CellDesigner/TLR9_cd.xml
+#
+# Every protein and species name of the file is looked up, both ways,
+# several times; the best time per lookup is reported, in microseconds. The cache of parsed
+# paths of find() is emptied before each run, as pasted paths are mostly seen once.
+
+
+# General
+import sys
+import os.path
+import argparse
+import time
+
+import improve_cd_file
+from improve_cd_file import namespaces, lookup, lookupFirst
+
+sbmlNs = '{http://www.sbml.org/sbml/level2/version4}'
+
+def clearPathCache():
+	# In a run of improve_cd_file.py, most pasted paths are seen once: don't let the
+	# cache of parsed paths of find() hide their parsing
+	from lxml import _elementpath
+	_elementpath._cache.clear()
+
+def bestTime(function, values, repeat):
+	"""Best time of 'function' over all the values, in microseconds per call."""
+	times = []
+	for run in range(repeat):
+		clearPathCache()
+		start = time.time()
+		for value in values:
+			function(value)
+		times.append((time.time()-start)*1e6/max(len(values), 1))
+	return min(times)
+
+def measure(cdmlFile, repeat=5):
+	"""(name, number of lookups, time pasting ids, time with the lookups) of each kind of lookup."""
+	cdmlRoot = improve_cd_file.loadEtree().parse(cdmlFile).getroot()
+	proteinIds = [ cdmlProtein.get('id') for cdmlProtein in lookup('proteins', cdmlRoot) ]
+	speciesNames = [ cdmlSpecies.get('name') for cdmlSpecies in lookup('species', cdmlRoot) ]
+	kinds = [('protein', proteinIds,
+				lambda protId: cdmlRoot.find(".//*/celldesigner:protein[@id='"+protId+"']", namespaces),
+				lambda protId: lookupFirst('protein', cdmlRoot, id=protId)),
+			('speciesByName', [ name for name in speciesNames if "'" not in name ],
+				lambda name: cdmlRoot.findall(".//"+sbmlNs+"species[@name='"+name+"']"),
+				lambda name: lookup('speciesByName', cdmlRoot, name=name)),
+			('proteinResidues', proteinIds,
+				lambda protId: cdmlRoot.findall(".//*/celldesigner:protein[@id='"+protId+"']/*/celldesigner:modificationResidue", namespaces),
+				lambda protId: lookup('proteinResidues', cdmlRoot, id=protId))]
+	return [ (name, len(values), bestTime(pasted, values, repeat), bestTime(compiled, values, repeat))
+			for (name, values, pasted, compiled) in kinds ]
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Cost of the lookups of improve_cd_file.py.")
+	parser.add_argument('cdml', help="CellDesigner file")
+	parser.add_argument('--repeat', type=int, default=5, help="runs over all the ids, the best one is kept (default: 5)")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+	print("%-16s %8s %14s %14s" % ("lookup", "ids", "pasted (us)", "compiled (us)"))
+	for (name, nbValues, pastedTime, compiledTime) in measure(args.cdml, args.repeat):
+		print("%-16s %8d %14.1f %14.1f" % (name, nbValues, pastedTime, compiledTime))
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
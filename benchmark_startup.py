@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+# Startup time of the command line paths that should not load libsbml or lxml.
+#
+# Example of a command line :
+# $ python benchmark_startup.py ../DC-ATLAS/BCML/TLR9.xml --max-ms 250
+#
+# Each path is run in a fresh interpreter, several times, and the median wall time is
+# reported: --help, --version, --dry-run, and an --incremental run on a map that was
+# already converted (cache hit). The bare interpreter start is measured as a reference.
+# With --max-ms, the exit status is 1 if one of the paths is slower than that.
+
+
+# General
+import sys
+import os.path
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+def medianTime(command, repeat, workdir):
+	"""Median wall time of a command, in milliseconds."""
+	times = []
+	for run in range(repeat):
+		start = time.time()
+		subprocess.call(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		times.append((time.time()-start)*1000)
+	times.sort()
+	return times[len(times)//2]
+
+def measure(bcmlFile, repeat=11, python=sys.executable):
+	"""Median startup time of each path, by name."""
+	converter = os.path.join(scriptDir, 'bcml_to_sbml.py')
+	workdir = tempfile.mkdtemp(prefix="benchmark_startup_")
+	try:
+		shutil.copy(bcmlFile, workdir)
+		bcmlCopy = os.path.basename(bcmlFile)
+		# First incremental run converts and writes the fingerprint, the next ones are cache hits
+		subprocess.check_call([python, converter, bcmlCopy, '--incremental'], cwd=workdir,
+				stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		paths = [('interpreter', [python, '-c', 'pass']),
+				('help', [python, converter, '--help']),
+				('version', [python, converter, '--version']),
+				('dry-run', [python, converter, bcmlCopy, '--dry-run']),
+				('cache hit', [python, converter, bcmlCopy, '--incremental'])]
+		return dict((name, medianTime(command, repeat, workdir)) for (name, command) in paths)
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Startup time of the fast command line paths of bcml_to_sbml.py.")
+	parser.add_argument('bcml', help="BCML file used for the dry-run and cache hit paths")
+	parser.add_argument('--repeat', type=int, default=11, help="runs per path, the median is kept (default: 11)")
+	parser.add_argument('--python', default=sys.executable, help="Python interpreter running the script (default: this one)")
+	parser.add_argument('--max-ms', type=float, default=None, help="fail if a path takes longer than this many milliseconds")
+	parser.add_argument('--results', default=None, help="results store to append this run to (JSON lines)")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+
+	times = measure(args.bcml, args.repeat, args.python)
+	for name in ['interpreter', 'help', 'version', 'dry-run', 'cache hit']:
+		print("%-12s %8.1f ms" % (name, times[name]))
+
+	if args.results is not None:
+		with open(args.results, 'a') as resultsHandle:
+			resultsHandle.write(json.dumps({'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), 'startup_ms': times}, sort_keys=True)+"\n")
+
+	if args.max_ms is not None:
+		slow = [ name for name in times if name != 'interpreter' and times[name] > args.max_ms ]
+		if slow:
+			print("Slower than "+str(args.max_ms)+" ms: "+", ".join(sorted(slow)))
+			return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
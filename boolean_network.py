@@ -0,0 +1,382 @@
+#!/usr/bin/python
+
+# Simulate a BCML map as a Boolean network.
+#
+# Example of a command line :
+# python boolean_network.py ../DC-ATLAS/BCML/TLR9.xml --samples 1000 --steps 50 --on TLR9
+#
+# Every species is a node. The map is read the same way bcml_to_sbml.py reads it
+# (species ids go through idfy(), OrNode/AndNode are expanded, Sources/Sinks are dropped),
+# and each reaction becomes a Boolean rule:
+# - reactants, necessary stimulations (SBO:0000461) must all be ON;
+#   an OrNode needs one of its members, an AndNode all of them, nested in any way:
+#   (A and B) or C is expanded into the clauses (A or C) and (B or C)
+# - if there are catalysts (SBO:0000013) or stimulators (SBO:0000459), at least one must be ON
+# - modulations (SBO:0000462) have no defined sign and are ignored
+# - any inhibitor (SBO:0000020) ON blocks the reaction; an inhibiting AndNode blocks it when
+#   all its members are ON, an OrNode when one of them is (expanded into terms, e.g.
+#   (A and B) or C gives the terms A and B, and C)
+# Complexes are also formed from their members, following Complex:Logic (And, Or, ? taken as And).
+# A node is ON at the next step if one of the reactions producing it is active. Nodes that are
+# not produced by any reaction (inputs) keep their value. Reactants are not consumed.
+#
+# The rules are compiled into matrices so that thousands of states are updated at once:
+# - C (clauses x nodes):   a clause is true if one of its nodes is ON
+# - A (reactions x clauses): a reaction needs all its clauses
+# - T (terms x nodes):     an inhibiting term is true if all its nodes are ON
+# - B (reactions x terms): a reaction is blocked if one of its terms is true
+# - P (nodes x reactions):  a node is ON if one of its producing reactions is active
+
+
+# General
+import sys
+import os.path
+import re
+import argparse
+
+# For BCML
+import xml.etree.ElementTree as ET
+
+# For the simulation
+import numpy
+
+from bcml_to_sbml import idfy
+
+# Elements defining species in BCML
+speciesTags = ['Macromolecule', 'NucleicAcidFeature', 'SimpleChemical', 'Complex']
+
+def isSourceOrSink(ref):
+	# Same test as in bcml_to_sbml.addReactant/addProduct
+	return re.match("^[Ss][0-9]{1,2}$", str(ref), flags=0) is not None
+
+def readLogicNodes(bcmlRoot):
+	"""Returns dictionaries of AndNode and OrNode IDs to the raw refNodes of their Logic children."""
+	andNodes = {}
+	orNodes = {}
+	for bcmlAndNode in bcmlRoot.iter('AndNode'):
+		andNodes[bcmlAndNode.attrib.get('ID')] = [ bcmlLog.attrib.get('refNode') for bcmlLog in bcmlAndNode.findall('Logic') ]
+	for bcmlOrNode in bcmlRoot.iter('OrNode'):
+		orNodes[bcmlOrNode.attrib.get('ID')] = [ bcmlLog.attrib.get('refNode') for bcmlLog in bcmlOrNode.findall('Logic') ]
+	return (andNodes, orNodes)
+
+def flattenRef(ref, andNodes, orNodes, seen=None):
+	"""All species ids behind a refNode, whatever the logic nodes in between."""
+	if seen is None:
+		seen = set()
+	if ref in seen:
+		return []
+	seen.add(ref)
+	if ref in andNodes or ref in orNodes:
+		species = []
+		for memberRef in andNodes.get(ref, []) + orNodes.get(ref, []):
+			species += flattenRef(memberRef, andNodes, orNodes, seen)
+		return species
+	if ref is None or isSourceOrSink(ref):
+		return []
+	return [idfy(ref)]
+
+def distribute(parts):
+	"""Every combination of one species list from each part, merged: the clauses of an 'or'
+	of lists of clauses, or the terms of an 'and' of lists of terms. Parts without any
+	list (Sources/Sinks only) are left out."""
+	combinations = [[]]
+	for part in parts:
+		if len(part) == 0:
+			continue
+		combinations = [ combination + [ species for species in partList if species not in combination ] for combination in combinations for partList in part ]
+	if combinations == [[]]:
+		return []
+	return combinations
+
+def refClauses(ref, andNodes, orNodes, seen=frozenset()):
+	"""Clauses (lists of species ids, one of which must be ON) needed for a refNode to be satisfied."""
+	if ref in seen:
+		return []
+	if ref in andNodes:
+		clauses = []
+		for memberRef in andNodes[ref]:
+			clauses += refClauses(memberRef, andNodes, orNodes, seen | set([ref]))
+		return clauses
+	if ref in orNodes:
+		return distribute([ refClauses(memberRef, andNodes, orNodes, seen | set([ref])) for memberRef in orNodes[ref] ])
+	species = flattenRef(ref, andNodes, orNodes)
+	if len(species) == 0:
+		return []
+	return [species]
+
+def refTerms(ref, andNodes, orNodes, seen=frozenset()):
+	"""Terms (lists of species ids, all of which must be ON) one of which satisfies a refNode."""
+	if ref in seen:
+		return []
+	if ref in orNodes:
+		terms = []
+		for memberRef in orNodes[ref]:
+			terms += refTerms(memberRef, andNodes, orNodes, seen | set([ref]))
+		return terms
+	if ref in andNodes:
+		return distribute([ refTerms(memberRef, andNodes, orNodes, seen | set([ref])) for memberRef in andNodes[ref] ])
+	return [ [species] for species in flattenRef(ref, andNodes, orNodes) ]
+
+def modifierRef(bcmlModifier):
+	# Stimulation can hold its reference as text (see bcml_to_sbml.addStimulation)
+	ref = bcmlModifier.attrib.get('refNode')
+	if ref is None or ref == '':
+		ref = bcmlModifier.text
+	return ref
+
+def readRules(bcmlRoot):
+	"""Read a BCML map into a list of nodes and a list of rules. A rule is a
+	dictionary with 'id', 'clauses', 'inhibitors' (terms) and 'products'.
+	"""
+
+	(andNodes, orNodes) = readLogicNodes(bcmlRoot)
+	nodes = []
+	rules = []
+
+	for bcmlComp in bcmlRoot.iter('Compartment'):
+
+		# Species, including those nested in complexes
+		for bcmlTag in speciesTags:
+			for bcmlSpecies in bcmlComp.iter(bcmlTag):
+				if bcmlSpecies.attrib.get('cloneref') is None:
+					nodes.append(idfy(str(bcmlSpecies.attrib.get('ID'))))
+
+		# Complex building
+		for bcmlComplex in bcmlComp.iter('Complex'):
+			if bcmlComplex.attrib.get('cloneref') is not None:
+				continue
+			members = []
+			for bcmlMember in bcmlComplex:
+				if bcmlMember.tag not in speciesTags:
+					continue
+				memberRef = bcmlMember.attrib.get('cloneref')
+				if memberRef is None:
+					memberRef = bcmlMember.attrib.get('ID')
+				members.append(idfy(str(memberRef)))
+			if len(members) == 0:
+				continue
+			if bcmlComplex.attrib.get('type') == 'Or':
+				clauses = [members]
+			else:
+				clauses = [ [member] for member in members ]
+			complexId = idfy(str(bcmlComplex.attrib.get('ID')))
+			rules.append({'id': complexId, 'clauses': clauses, 'inhibitors': [], 'products': [complexId]})
+
+		# Reactions
+		for bcmlTag in ['Association', 'Dissociation', 'Process']:
+			for bcmlReaction in bcmlComp.findall(bcmlTag):
+				clauses = []
+				for bcmlReactant in bcmlReaction.findall('Consumption') + bcmlReaction.findall('NecessaryStimulation'):
+					clauses += refClauses(bcmlReactant.attrib.get('refNode'), andNodes, orNodes)
+				# One of the activators, each one possibly a logic node
+				activators = [ refClauses(modifierRef(bcmlModifier), andNodes, orNodes) for bcmlModifier in bcmlReaction.findall('Catalysis') + bcmlReaction.findall('Stimulation') ]
+				clauses += distribute(activators)
+				# Any of the inhibitors, each one possibly a logic node
+				inhibitors = []
+				for bcmlModifier in bcmlReaction.findall('Inhibition'):
+					inhibitors += refTerms(bcmlModifier.attrib.get('refNode'), andNodes, orNodes)
+				products = []
+				for bcmlProduct in bcmlReaction.findall('Production'):
+					products += flattenRef(bcmlProduct.attrib.get('refNode'), andNodes, orNodes)
+				if len(products) == 0:
+					continue
+				rules.append({'id': str(bcmlReaction.attrib.get('ID')), 'clauses': clauses, 'inhibitors': inhibitors, 'products': products})
+
+	# References to undeclared species still become nodes
+	for rule in rules:
+		for clause in rule['clauses']:
+			nodes += clause
+		for term in rule['inhibitors']:
+			nodes += term
+		nodes += rule['products']
+
+	# Remove duplicates, keep first occurrence order
+	seenNodes = set()
+	uniqueNodes = []
+	for node in nodes:
+		if node not in seenNodes:
+			seenNodes.add(node)
+			uniqueNodes.append(node)
+
+	return (uniqueNodes, rules)
+
+
+class BooleanNetwork(object):
+	"""Boolean network compiled into update matrices. States are boolean
+	arrays of shape (number of states, number of nodes).
+	"""
+
+	def __init__(self, nodes, rules):
+		self.nodes = list(nodes)
+		self.rules = rules
+		self.nodeIndex = dict((node, idx) for (idx, node) in enumerate(self.nodes))
+
+		nbNodes = len(self.nodes)
+		nbClauses = sum(len(rule['clauses']) for rule in rules)
+		nbTerms = sum(len(rule['inhibitors']) for rule in rules)
+		nbRules = len(rules)
+
+		clauses = numpy.zeros((nbClauses, nbNodes), dtype=numpy.float32)
+		ruleClauses = numpy.zeros((nbRules, nbClauses), dtype=numpy.float32)
+		terms = numpy.zeros((nbTerms, nbNodes), dtype=numpy.float32)
+		ruleTerms = numpy.zeros((nbRules, nbTerms), dtype=numpy.float32)
+		products = numpy.zeros((nbNodes, nbRules), dtype=numpy.float32)
+
+		clauseIdx = 0
+		termIdx = 0
+		for (ruleIdx, rule) in enumerate(rules):
+			for clause in rule['clauses']:
+				for node in clause:
+					clauses[clauseIdx, self.nodeIndex[node]] = 1
+				ruleClauses[ruleIdx, clauseIdx] = 1
+				clauseIdx += 1
+			for term in rule['inhibitors']:
+				for node in term:
+					terms[termIdx, self.nodeIndex[node]] = 1
+				ruleTerms[ruleIdx, termIdx] = 1
+				termIdx += 1
+			for node in rule['products']:
+				products[self.nodeIndex[node], ruleIdx] = 1
+
+		# Transposed once here, so that each update is a plain product with the states
+		self.clausesT = clauses.T.copy()
+		self.ruleClausesT = ruleClauses.T.copy()
+		self.termsT = terms.T.copy()
+		self.ruleTermsT = ruleTerms.T.copy()
+		self.nbTermNodes = terms.sum(axis=1)
+		self.productsT = products.T.copy()
+		self.nbRuleClauses = ruleClauses.sum(axis=1)
+		# Nodes without any producing reaction keep their value
+		self.isInput = products.sum(axis=1) == 0
+		# Clamped nodes (knock-out/overexpression): value forced at each step
+		self.clampMask = numpy.zeros(nbNodes, dtype=bool)
+		self.clampValues = numpy.zeros(nbNodes, dtype=bool)
+
+	def index(self, node):
+		# Accept both BCML IDs and SBML (idfy'd) ids
+		if node in self.nodeIndex:
+			return self.nodeIndex[node]
+		return self.nodeIndex[idfy(node)]
+
+	def clamp(self, node, value):
+		"""Force 'node' to 'value' (True: overexpression, False: knock-out)."""
+		self.clampMask[self.index(node)] = True
+		self.clampValues[self.index(node)] = value
+
+	def unclamp(self, node=None):
+		if node is None:
+			self.clampMask[:] = False
+		else:
+			self.clampMask[self.index(node)] = False
+
+	def applyClamps(self, states, clamps=None):
+		"""Force clamped nodes to their value. 'clamps' is an optional (mask, values)
+		pair of arrays of shape (nodes) or (states, nodes), added to the network clamps;
+		it allows a different perturbation for each state of a batch.
+		"""
+		if self.clampMask.any():
+			states[:, self.clampMask] = self.clampValues[self.clampMask]
+		if clamps is not None:
+			states = numpy.where(clamps[0], clamps[1], states)
+		return states
+
+	def activeRules(self, states):
+		"""Boolean array (states x rules) of the reactions active in each state."""
+		statesF = states.astype(numpy.float32)
+		# Clause true if one of its nodes is ON
+		clausesTrue = numpy.dot(statesF, self.clausesT) > 0.5
+		# Term true if all its nodes are ON
+		termsTrue = numpy.dot(statesF, self.termsT) > self.nbTermNodes - 0.5
+		# Rule needs all its clauses, and no inhibiting term true
+		satisfied = numpy.dot(clausesTrue.astype(numpy.float32), self.ruleClausesT) > self.nbRuleClauses - 0.5
+		inhibited = numpy.dot(termsTrue.astype(numpy.float32), self.ruleTermsT) > 0.5
+		return satisfied & ~inhibited
+
+	def nextStates(self, states, clamps=None):
+		"""Value of every node after one synchronous update of all nodes."""
+		active = self.activeRules(states)
+		produced = numpy.dot(active.astype(numpy.float32), self.productsT) > 0.5
+		nextStates = numpy.where(self.isInput, states, produced)
+		return self.applyClamps(nextStates, clamps)
+
+	def stepSynchronous(self, states, clamps=None):
+		return self.nextStates(states, clamps)
+
+	def stepAsynchronous(self, states, rng, clamps=None, blockSize=None):
+		"""Update one randomly chosen node in each state. With 'blockSize', the same
+		nodes are chosen in every block of that many states."""
+		if blockSize is None:
+			blockSize = states.shape[0]
+		if blockSize <= 0 or states.shape[0] % blockSize != 0:
+			raise ValueError(str(states.shape[0])+" states can't be split into blocks of "+str(blockSize))
+		updated = self.nextStates(states, clamps)
+		rows = numpy.arange(states.shape[0])
+		chosen = numpy.tile(rng.randint(0, states.shape[1], size=blockSize), states.shape[0]//blockSize)
+		newStates = states.copy()
+		newStates[rows, chosen] = updated[rows, chosen]
+		return self.applyClamps(newStates, clamps)
+
+	def simulate(self, states, steps, mode='synchronous', rng=None, clamps=None, blockSize=None):
+		"""Run 'steps' updates from all 'states' at once. Returns the final
+		states and, for each of them, whether it is a fixed point. With 'blockSize',
+		'states' are blocks of that many states that follow the same asynchronous
+		update order (the draws of a single block, whatever the number of blocks); their
+		number must be a multiple of 'blockSize' (ValueError otherwise).
+		"""
+		if rng is None:
+			rng = numpy.random.RandomState()
+		states = self.applyClamps(numpy.array(states, dtype=bool), clamps)
+		for step in range(steps):
+			if mode == 'synchronous':
+				states = self.stepSynchronous(states, clamps)
+			elif mode == 'asynchronous':
+				states = self.stepAsynchronous(states, rng, clamps, blockSize)
+			else:
+				raise ValueError("Unknown update mode: "+str(mode))
+		isFixedPoint = (self.nextStates(states, clamps) == states).all(axis=1)
+		return (states, isFixedPoint)
+
+	def randomStates(self, nbStates, rng=None):
+		if rng is None:
+			rng = numpy.random.RandomState()
+		return self.applyClamps(rng.randint(0, 2, size=(nbStates, len(self.nodes))).astype(bool))
+
+def compileNetwork(bcmlRoot):
+	(nodes, rules) = readRules(bcmlRoot)
+	return BooleanNetwork(nodes, rules)
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Simulate a BCML map as a Boolean network.")
+	parser.add_argument('bcml', help="BCML file to simulate")
+	parser.add_argument('--samples', type=int, default=1000, help="number of random initial conditions (default: 1000)")
+	parser.add_argument('--steps', type=int, default=50, help="number of updates (default: 50)")
+	parser.add_argument('--mode', choices=['synchronous', 'asynchronous'], default='synchronous', help="update scheme")
+	parser.add_argument('--seed', type=int, default=None, help="seed of the random generator")
+	parser.add_argument('--on', action='append', default=[], metavar='SPECIES', help="clamp a species ON (can be repeated)")
+	parser.add_argument('--off', action='append', default=[], metavar='SPECIES', help="clamp a species OFF (can be repeated)")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+
+	# Open BCML file and parse
+	bcmlRoot = ET.parse(args.bcml).getroot()
+	network = compileNetwork(bcmlRoot)
+	for node in args.on:
+		network.clamp(node, True)
+	for node in args.off:
+		network.clamp(node, False)
+
+	rng = numpy.random.RandomState(args.seed)
+	(states, isFixedPoint) = network.simulate(network.randomStates(args.samples, rng), args.steps, args.mode, rng)
+
+	# Fraction of final states in which each node is ON
+	print("# "+str(len(network.nodes))+" nodes, "+str(len(network.rules))+" rules, "+str(int(isFixedPoint.sum()))+"/"+str(args.samples)+" states at a fixed point")
+	for (node, fractionOn) in zip(network.nodes, states.mean(axis=0)):
+		print(node+"\t"+("%.3f" % fractionOn))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,46 @@
+# Order of the lists in canonical output (--canonical), shared by bcml_to_sbml.py (libsbml
+# documents) and improve_cd_file.py (CellDesigner trees read with lxml), so that both
+# scripts sort the same lists the same way.
+#
+# Entries are sorted by the attributes given for their list, compared with naturalKey
+# ("re2" before "re10"). Only the standard library is used.
+
+
+# General
+import re
+
+sbmlNs = 'http://www.sbml.org/sbml/level2/version4'
+celldesignerNs = 'http://www.sbml.org/2001/ns/celldesigner'
+
+# Lists sorted in canonical output, with the attributes giving the order of their entries
+canonicalLists = {'{%s}listOfCompartments' % sbmlNs: ['id'],
+				'{%s}listOfSpecies' % sbmlNs: ['id'],
+				'{%s}listOfReactions' % sbmlNs: ['id'],
+				'{%s}listOfReactants' % sbmlNs: ['species', 'sboTerm'],
+				'{%s}listOfProducts' % sbmlNs: ['species', 'sboTerm'],
+				'{%s}listOfModifiers' % sbmlNs: ['species', 'sboTerm'],
+				'{%s}listOfCompartmentAliases' % celldesignerNs: ['id'],
+				'{%s}listOfComplexSpeciesAliases' % celldesignerNs: ['id'],
+				'{%s}listOfSpeciesAliases' % celldesignerNs: ['id'],
+				'{%s}listOfProteins' % celldesignerNs: ['id'],
+				'{%s}listOfGenes' % celldesignerNs: ['id'],
+				'{%s}listOfRNAs' % celldesignerNs: ['id'],
+				'{%s}listOfModificationResidues' % celldesignerNs: ['id'],
+				'{%s}listOfModifications' % celldesignerNs: ['residue', 'state'],
+				'{%s}listOfModification' % celldesignerNs: ['modifiers', 'aliases', 'type']}
+
+def sbmlListTag(name):
+	"""Tag of an SBML list in canonicalLists, e.g. sbmlListTag('listOfSpecies')."""
+	return '{%s}%s' % (sbmlNs, name)
+
+def naturalKey(value):
+	"""Sort key putting "re2" before "re10"."""
+	return [ (0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split('([0-9]+)', value) ]
+
+def entryKey(listTag, attribute):
+	"""Sort key of the entries of the list 'listTag' (a key of canonicalLists), or None if
+	it is not sorted. 'attribute(entry, name)' gives an attribute of an entry, '' if unset."""
+	names = canonicalLists.get(listTag)
+	if names is None:
+		return None
+	return lambda entry: [ naturalKey(attribute(entry, name)) for name in names ]
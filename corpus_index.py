@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+# SQLite index of the converted corpus, for queries over all the maps at once.
+#
+# Example of a command line :
+# $ python corpus_index.py update corpus.sqlite ../DC-ATLAS/BCML/to_SBML/
+# $ python corpus_index.py query corpus.sqlite "SELECT DISTINCT m.name FROM participants p
+#     JOIN species s ON s.map_id = p.map_id AND s.id = p.species JOIN maps m ON m.id = p.map_id
+#     JOIN notes n ON n.map_id = s.map_id AND n.element = s.id
+#     WHERE s.name = 'STAT1' AND p.role = 'modifier' AND p.sbo = 20
+#     AND n.category = 'StateVariable' AND n.value LIKE 'P%'"
+#
+# The SBML files written by bcml_to_sbml.py are read as plain XML (no libsbml). Tables:
+# - maps: one row per SBML file, with the content hash it was indexed from
+# - species, reactions: id, name/kind, compartment, SBO term (-1 when unset)
+# - participants: reaction, species, role (reactant, product, modifier) and SBO term
+# - notes: every "Key:Value" line of the notes of species and reactions, with its category
+#   (Finding, MacroModule, StateVariable, UnitOfInformation, Organism, Complex, Reaction...)
+# - annotations: Organism annotations of species (DB, organism, identifier), recognised by
+#   their "DB:ORGANISM:ID" structure, so that any identifier DB is kept
+# A map is only indexed again when the content hash of its SBML file changes.
+
+
+# General
+import sys
+import os
+import os.path
+import argparse
+import hashlib
+import re
+import sqlite3
+import time
+
+# For SBML (plain XML reading is enough, and much faster to load than libsbml)
+import xml.etree.ElementTree as ET
+
+sbmlNs = '{http://www.sbml.org/sbml/level2/version4}'
+
+schema = """
+PRAGMA foreign_keys = ON;
+CREATE TABLE IF NOT EXISTS maps (id INTEGER PRIMARY KEY, name TEXT NOT NULL, path TEXT NOT NULL UNIQUE,
+	content_hash TEXT NOT NULL, indexed_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS species (map_id INTEGER NOT NULL REFERENCES maps(id) ON DELETE CASCADE,
+	id TEXT NOT NULL, name TEXT, compartment TEXT, compartment_name TEXT, sbo INTEGER NOT NULL, PRIMARY KEY (map_id, id));
+CREATE TABLE IF NOT EXISTS reactions (map_id INTEGER NOT NULL REFERENCES maps(id) ON DELETE CASCADE,
+	id TEXT NOT NULL, kind TEXT, sbo INTEGER NOT NULL, PRIMARY KEY (map_id, id));
+CREATE TABLE IF NOT EXISTS participants (map_id INTEGER NOT NULL REFERENCES maps(id) ON DELETE CASCADE,
+	reaction TEXT NOT NULL, species TEXT NOT NULL, role TEXT NOT NULL, sbo INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS notes (map_id INTEGER NOT NULL REFERENCES maps(id) ON DELETE CASCADE,
+	element TEXT NOT NULL, category TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS annotations (map_id INTEGER NOT NULL REFERENCES maps(id) ON DELETE CASCADE,
+	species TEXT NOT NULL, db TEXT NOT NULL, organism TEXT NOT NULL, identifier TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS species_name ON species (name);
+CREATE INDEX IF NOT EXISTS reactions_sbo ON reactions (sbo);
+CREATE INDEX IF NOT EXISTS participants_species ON participants (species, role);
+CREATE INDEX IF NOT EXISTS participants_reaction ON participants (map_id, reaction);
+CREATE INDEX IF NOT EXISTS notes_element ON notes (map_id, element);
+CREATE INDEX IF NOT EXISTS notes_value ON notes (category, value);
+CREATE INDEX IF NOT EXISTS annotations_identifier ON annotations (db, identifier);
+CREATE INDEX IF NOT EXISTS annotations_species ON annotations (map_id, species);
+"""
+
+# Notes keys written by bcml_to_sbml.py with a category of their own; other "Key:Value"
+# lines come from Finding, unless they have the structure of an Organism annotation
+noteCategories = ['MacroModule', 'StateVariable', 'UnitOfInformation', 'Complex', 'Reaction',
+				'Reactant', 'Product', 'Modulation', 'Inhibition', 'Catalysis', 'NecessaryStimulation', 'Stimulation']
+# Organism annotations are written as "DB:ORGANISM:ID", with the organism name in upper case
+# (e.g. "EntrezGeneID:HOMO SAPIENS:3845"), whatever the DB
+annotationLine = re.compile(r'^([^\s:]+):([^:a-z]*):([^\s:]+)$')
+
+def contentHash(sbmlFile):
+	digest = hashlib.sha1()
+	with open(sbmlFile, 'rb') as sbmlHandle:
+		for block in iter(lambda: sbmlHandle.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def mapName(sbmlFile):
+	name = os.path.splitext(os.path.basename(sbmlFile))[0]
+	if name.endswith("_sbml"):
+		name = name[:-len("_sbml")]
+	return name
+
+def sboNumber(sbmlElement):
+	sboTerm = sbmlElement.get('sboTerm')
+	if sboTerm is None:
+		return -1
+	return int(sboTerm.split(':')[-1])
+
+def notesLines(sbmlElement):
+	notesElement = sbmlElement.find(sbmlNs+'notes')
+	if notesElement is None:
+		return []
+	notesText = "".join(notesElement.itertext())
+	return [ line.strip() for line in notesText.split("\n") if ':' in line ]
+
+def classifyNote(line):
+	"""(category, key, value) of a notes line, and the (DB, organism, identifier)
+	annotation it holds, or None."""
+	(key, value) = line.split(':', 1)
+	if key in noteCategories:
+		return ((key, key, value), None)
+	# A Finding value can hold colons too (e.g. "Comment:see fig. 2: left"), but not an
+	# upper case organism followed by an identifier
+	match = annotationLine.match(line)
+	if match is not None:
+		return (('Organism', key, value), match.groups())
+	return (('Finding', key, value), None)
+
+def readMap(sbmlFile):
+	"""Rows of all the tables for one SBML file."""
+	sbmlModel = ET.parse(sbmlFile).getroot().find(sbmlNs+'model')
+	rows = {'species': [], 'reactions': [], 'participants': [], 'notes': [], 'annotations': []}
+	if sbmlModel is None:
+		return rows
+	compartmentNames = dict((sbmlComp.get('id'), sbmlComp.get('name')) for sbmlComp in sbmlModel.iter(sbmlNs+'compartment'))
+
+	def addNotes(sbmlElement, elementId, isSpecies):
+		for line in notesLines(sbmlElement):
+			(note, annotation) = classifyNote(line)
+			rows['notes'].append((elementId,)+note)
+			if isSpecies and annotation is not None:
+				rows['annotations'].append((elementId,)+annotation)
+
+	for sbmlSpecies in sbmlModel.iter(sbmlNs+'species'):
+		speciesId = sbmlSpecies.get('id')
+		rows['species'].append((speciesId, sbmlSpecies.get('name'), sbmlSpecies.get('compartment'),
+				compartmentNames.get(sbmlSpecies.get('compartment')), sboNumber(sbmlSpecies)))
+		addNotes(sbmlSpecies, speciesId, True)
+
+	for sbmlReaction in sbmlModel.iter(sbmlNs+'reaction'):
+		reactionId = sbmlReaction.get('id')
+		kind = None
+		for line in notesLines(sbmlReaction):
+			if line.startswith("Reaction:"):
+				kind = line.split(':', 1)[1]
+				break
+		rows['reactions'].append((reactionId, kind, sboNumber(sbmlReaction)))
+		for (listTag, role) in [('listOfReactants', 'reactant'), ('listOfProducts', 'product'), ('listOfModifiers', 'modifier')]:
+			for sbmlList in sbmlReaction.findall(sbmlNs+listTag):
+				for sbmlReference in sbmlList:
+					rows['participants'].append((reactionId, sbmlReference.get('species'), role, sboNumber(sbmlReference)))
+		addNotes(sbmlReaction, reactionId, False)
+	return rows
+
+def openIndex(indexfile):
+	connection = sqlite3.connect(indexfile)
+	connection.executescript(schema)
+	return connection
+
+def indexMap(connection, sbmlFile):
+	"""Index one SBML file, replacing its previous rows. Returns False if it was
+	already indexed with the same content."""
+	path = os.path.abspath(sbmlFile)
+	digest = contentHash(sbmlFile)
+	previous = connection.execute("SELECT id, content_hash FROM maps WHERE path = ?", (path,)).fetchone()
+	if previous is not None and previous[1] == digest:
+		return False
+	rows = readMap(sbmlFile)
+	# One transaction per map: a failed map leaves the index as it was
+	with connection:
+		if previous is not None:
+			connection.execute("DELETE FROM maps WHERE id = ?", (previous[0],))
+		mapId = connection.execute("INSERT INTO maps (name, path, content_hash, indexed_at) VALUES (?, ?, ?, ?)",
+				(mapName(sbmlFile), path, digest, time.time())).lastrowid
+		connection.executemany("INSERT INTO species VALUES (?, ?, ?, ?, ?, ?)", [ (mapId,)+row for row in rows['species'] ])
+		connection.executemany("INSERT INTO reactions VALUES (?, ?, ?, ?)", [ (mapId,)+row for row in rows['reactions'] ])
+		connection.executemany("INSERT INTO participants VALUES (?, ?, ?, ?, ?)", [ (mapId,)+row for row in rows['participants'] ])
+		connection.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, ?)", [ (mapId,)+row for row in rows['notes'] ])
+		connection.executemany("INSERT INTO annotations VALUES (?, ?, ?, ?, ?)", [ (mapId,)+row for row in rows['annotations'] ])
+	return True
+
+def pruneMaps(connection, keptPaths):
+	"""Remove the maps whose SBML file was not given this time. Returns their number."""
+	removed = [ (mapId,) for (mapId, path) in connection.execute("SELECT id, path FROM maps") if path not in keptPaths ]
+	with connection:
+		connection.executemany("DELETE FROM maps WHERE id = ?", removed)
+	return len(removed)
+
+def listFiles(paths):
+	"""SBML files given directly, or found (as *_sbml.xml) in the given directories."""
+	sbmlFiles = []
+	for path in paths:
+		if os.path.isdir(path):
+			for (dirpath, dirnames, filenames) in os.walk(path):
+				dirnames.sort()
+				sbmlFiles += [ os.path.join(dirpath, filename) for filename in sorted(filenames) if filename.endswith("_sbml.xml") ]
+		else:
+			sbmlFiles.append(path)
+	return sbmlFiles
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="SQLite index of the converted corpus.")
+	subparsers = parser.add_subparsers(dest='command')
+	subparsers.required = True
+	updateParser = subparsers.add_parser('update', help="index new or changed SBML files")
+	updateParser.add_argument('index', help="SQLite database")
+	updateParser.add_argument('sbml', nargs='+', help="SBML files written by bcml_to_sbml.py, or directories of them")
+	updateParser.add_argument('--prune', action='store_true', help="remove the maps that were not given")
+	queryParser = subparsers.add_parser('query', help="run an SQL query on the index")
+	queryParser.add_argument('index', help="SQLite database")
+	queryParser.add_argument('sql', help="SQL query")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+	connection = openIndex(args.index)
+
+	if args.command == 'update':
+		sbmlFiles = listFiles(args.sbml)
+		nbIndexed = 0
+		for sbmlFile in sbmlFiles:
+			if indexMap(connection, sbmlFile):
+				nbIndexed += 1
+		message = str(len(sbmlFiles))+" maps, "+str(nbIndexed)+" indexed, "+str(len(sbmlFiles)-nbIndexed)+" unchanged"
+		if args.prune:
+			message += ", "+str(pruneMaps(connection, set([ os.path.abspath(sbmlFile) for sbmlFile in sbmlFiles ])))+" removed"
+		print(message)
+	else:
+		for row in connection.execute(args.sql):
+			print("\t".join([ str(value) for value in row ]))
+	connection.close()
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,100 @@
+# Errors of a conversion collected element by element, for bcml_to_sbml.py, improve_cd_file.py
+# and improve_cd_batch.py (--error-report REPORT).
+#
+# By default the scripts stop at the first error. With an error report, an element that
+# fails on a defect of the map (a libsbml error, a missing alias or protein reference...)
+# is skipped and recorded with its context, and the conversion goes on with the other
+# elements, so that a corpus run shows all the defects at once. Other exceptions
+# (AttributeError, TypeError, NameError...) are defects of the code: they still stop it. The report is written as JSON:
+# {"files": [{"file": ..., "errors": [{"stage", "element", "id", "line", "error", "message"}]}],
+#  "total": {"files": ..., "errors": ...}}
+# Only the standard library is used.
+
+
+# General
+import json
+import contextlib
+
+class MapError(ValueError):
+	"""Defect of the map being converted, e.g. an element it should have but doesn't."""
+
+# Exceptions raised by defects of the map: libsbml failures are reported with SystemExit
+# (see bcml_to_sbml.check), missing references as KeyError or MapError
+dataErrors = (KeyError, IndexError, ValueError, SystemExit)
+
+def elementId(element):
+	"""ID of a BCML or CellDesigner element, None if it has none. Anything else
+	(e.g. a species name) is its own ID."""
+	if element is None:
+		return None
+	if not hasattr(element, 'get'):
+		return element
+	for attribute in ['ID', 'id', 'species']:
+		if element.get(attribute) is not None:
+			return element.get(attribute)
+	return None
+
+def elementTag(element):
+	if element is None or not hasattr(element, 'tag'):
+		return None
+	# Without the namespace
+	return str(element.tag).split('}')[-1]
+
+class ErrorReport(object):
+	"""Errors of one file: each one with the stage (pass) it happened in, the element
+	that was skipped (tag, ID, line in the file if known) and the exception."""
+
+	def __init__(self, sourcefile):
+		self.file = sourcefile
+		self.errors = []
+
+	def record(self, stage, element, error):
+		message = str(error)
+		if isinstance(error, KeyError):
+			message = "missing "+message
+		self.errors.append({'stage': stage,
+							'element': elementTag(element),
+							'id': elementId(element),
+							'line': getattr(element, 'sourceline', None),
+							'error': type(error).__name__,
+							'message': message})
+
+	def state(self):
+		"""Picklable copy, to be sent back by a worker process."""
+		return {'file': self.file, 'errors': list(self.errors)}
+
+	def lines(self):
+		lines = []
+		for error in self.errors:
+			where = " ".join([ str(part) for part in [error['element'], error['id']] if part is not None ])
+			if error['line'] is not None:
+				where += " (line "+str(error['line'])+")"
+			lines.append(self.file+": "+error['stage']+": "+where+": "+error['error']+": "+error['message'])
+		return lines
+
+def collecting(errors, stage, element=None):
+	"""Context for the conversion of one element: if 'errors' is an ErrorReport, a
+	data error (see dataErrors) raised in it is recorded and the element skipped;
+	otherwise, and for any other exception, it goes through and the conversion stops."""
+	if errors is None:
+		return noErrors()
+	return skipped(errors, stage, element)
+
+@contextlib.contextmanager
+def noErrors():
+	yield
+
+@contextlib.contextmanager
+def skipped(errors, stage, element):
+	try:
+		yield
+	except dataErrors as error:
+		errors.record(stage, element, error)
+
+def writeReport(reportfile, states):
+	"""Write the errors of several files (ErrorReport.state()) as one JSON report."""
+	report = {'files': states,
+			'total': {'files': len(states),
+					'errors': sum([ len(state['errors']) for state in states ])}}
+	with open(reportfile, 'w') as reportHandle:
+		json.dump(report, reportHandle, indent=1, sort_keys=True)
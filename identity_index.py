@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+# Corpus-wide index of species identifiers (Organism annotations of BCML).
+#
+# Filled by bcml_to_sbml.py (--identity-index), one map at a time:
+# $ python bcml_to_sbml.py TLR9.xml --identity-index ../DC-ATLAS/identifiers.json
+# Example of a lookup :
+# $ python identity_index.py ../DC-ATLAS/identifiers.json EntrezGeneID 3845
+#
+# The index is a JSON file:
+# - "identifiers": DB -> ID -> list of occurrences {map, species (SBML id), compartment, organism}
+# - "maps": map -> list of the (DB, ID) it contributed, so that a map can be replaced without
+#   scanning the whole index when it is converted again
+# Several converters can update the index at once: each update holds a lock file
+# (INDEX.lock, POSIX only) from reading the index to replacing it.
+
+
+# General
+import sys
+import os
+import os.path
+import argparse
+import contextlib
+import json
+import tempfile
+
+try:
+	import fcntl
+except ImportError:
+	# Windows: no lock, concurrent updates can lose maps
+	fcntl = None
+
+# For BCML
+import xml.etree.ElementTree as ET
+
+from bcml_to_sbml import idfy, compartmentLabel, organismAnnotations
+
+# Elements defining species in BCML
+speciesTags = ['Macromolecule', 'NucleicAcidFeature', 'SimpleChemical', 'Complex']
+
+def mapName(bcmlFile):
+	return os.path.splitext(os.path.basename(bcmlFile))[0]
+
+def readOccurrences(bcmlRoot):
+	"""All annotated species of a map, as (DB, organism, ID, SBML id, compartment label)."""
+	occurrences = []
+	for bcmlComp in bcmlRoot.iter('Compartment'):
+		bcmlCompLabel = compartmentLabel(bcmlComp)
+		for bcmlTag in speciesTags:
+			# Including species defined inside complexes
+			for bcmlSpecies in bcmlComp.iter(bcmlTag):
+				if bcmlSpecies.attrib.get('cloneref') is not None:
+					continue
+				speciesId = idfy(str(bcmlSpecies.attrib.get('ID')))
+				for (database, organism, identifier) in organismAnnotations(bcmlSpecies):
+					occurrences.append((database, organism, identifier, speciesId, bcmlCompLabel))
+	return occurrences
+
+def loadIndex(indexfile):
+	if not os.path.exists(indexfile):
+		return {'identifiers': {}, 'maps': {}}
+	with open(indexfile) as indexHandle:
+		return json.load(indexHandle)
+
+def saveIndex(index, indexfile):
+	# Write next to the index and rename, so that an interrupted run never leaves a broken
+	# index; the temporary file has a name of its own, not shared with other writers
+	(descriptor, temporaryfile) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(indexfile)),
+			prefix="."+os.path.basename(indexfile)+".", suffix=".tmp")
+	try:
+		with os.fdopen(descriptor, 'w') as indexHandle:
+			json.dump(index, indexHandle, sort_keys=True)
+		os.replace(temporaryfile, indexfile)
+	except:
+		if os.path.exists(temporaryfile):
+			os.remove(temporaryfile)
+		raise
+
+@contextlib.contextmanager
+def lockedIndex(indexfile):
+	"""Hold the lock of the index file, for a read-modify-write of the index."""
+	with open(indexfile+".lock", 'a') as lockHandle:
+		if fcntl is not None:
+			fcntl.flock(lockHandle.fileno(), fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			if fcntl is not None:
+				fcntl.flock(lockHandle.fileno(), fcntl.LOCK_UN)
+
+def removeMap(index, name):
+	for (database, identifier) in index['maps'].pop(name, []):
+		occurrences = index['identifiers'].get(database, {}).get(identifier, [])
+		occurrences[:] = [ occurrence for occurrence in occurrences if occurrence['map'] != name ]
+		if len(occurrences) == 0:
+			index['identifiers'][database].pop(identifier, None)
+			if len(index['identifiers'][database]) == 0:
+				index['identifiers'].pop(database)
+
+def addMap(index, name, occurrences):
+	keys = []
+	for (database, organism, identifier, speciesId, bcmlCompLabel) in occurrences:
+		index['identifiers'].setdefault(database, {}).setdefault(identifier, []).append(
+				{'map': name, 'species': speciesId, 'compartment': bcmlCompLabel, 'organism': organism})
+		if [database, identifier] not in keys:
+			keys.append([database, identifier])
+	index['maps'][name] = keys
+
+def updateMap(indexfile, bcmlFile, occurrences):
+	"""Replace the entries of one map in the index file."""
+	with lockedIndex(indexfile):
+		index = loadIndex(indexfile)
+		removeMap(index, mapName(bcmlFile))
+		addMap(index, mapName(bcmlFile), occurrences)
+		saveIndex(index, indexfile)
+
+def lookup(index, database, identifier, organism=None):
+	occurrences = index['identifiers'].get(database, {}).get(identifier, [])
+	if organism is not None:
+		occurrences = [ occurrence for occurrence in occurrences if occurrence['organism'] == organism.upper() ]
+	return occurrences
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Find where an identifier appears in the converted maps.")
+	parser.add_argument('index', help="JSON index filled by bcml_to_sbml.py --identity-index")
+	parser.add_argument('database', help="annotation DB, e.g. EntrezGeneID")
+	parser.add_argument('identifier', help="identifier in this DB")
+	parser.add_argument('--organism', default=None, help="only occurrences annotated with this organism")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+	index = loadIndex(args.index)
+	occurrences = lookup(index, args.database, args.identifier, args.organism)
+	for occurrence in occurrences:
+		print(occurrence['map']+"\t"+occurrence['species']+"\t"+occurrence['compartment']+"\t"+occurrence['organism'])
+	return 0 if len(occurrences) != 0 else 1
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
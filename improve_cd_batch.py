@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+# Improve all the CellDesigner files of a directory, over a pool of processes.
+#
+# Example of a command line :
+# $ python improve_cd_batch.py ../DC-ATLAS/CellDesigner --output-dir ../DC-ATLAS/modified_CDML --processes 8 --report batch.json
+#
+# Each file is processed by improve_cd_file.py in a worker process. A file that fails
+# (malformed XML, unexpected content...) is reported with its error and does not stop
+# the others. The summary gives the status and time of every file; it is printed, and
+# written as JSON with --report. The exit status is 1 if a file failed (or, with
+# --error-report, if an element was skipped).
+# With --metrics / --metrics-port, the metrics of all files (see metrics.py) are merged
+# as they complete, and served during the run.
+# With --error-report, elements that fail are skipped instead of failing their file, and the
+# errors of all files are written to one JSON report (see error_report.py).
+#
+# With --journal, every file completed without error is appended to a journal (one JSON
+# object per line: input file and hash, output file and hash), synced to disk at once.
+# After an interruption, the same command with --resume skips the files of the journal
+# whose input and output are unchanged, and redoes the others; outputs are written to a
+# temporary file, synced and renamed; the temporary files left by processes that are not
+# running any more on this host are removed.
+# Inputs that would be written to the same output file (same name in different
+# directories) are refused.
+# $ python improve_cd_batch.py ../DC-ATLAS/CellDesigner --journal batch.journal --resume
+
+
+# General
+import sys
+import os
+import os.path
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import time
+import traceback
+
+import improve_cd_file
+import metrics
+import error_report
+
+def listFiles(paths):
+	"""CellDesigner files given directly, or found in the given directories."""
+	cdmlFiles = []
+	for path in paths:
+		if os.path.isdir(path):
+			cdmlFiles += sorted(glob.glob(os.path.join(path, "*.xml")))
+		else:
+			cdmlFiles.append(path)
+	return cdmlFiles
+
+def outputCollisions(cdmlFiles, outputdir=None):
+	"""Output files that several input files would be written to (e.g. files with the
+	same name in different directories), with these input files."""
+	inputs = {}
+	for cdmlFile in cdmlFiles:
+		outputfile = os.path.abspath(improve_cd_file.outputPath(cdmlFile, outputdir))
+		inputs.setdefault(outputfile, set()).add(os.path.abspath(cdmlFile))
+	return dict((outputfile, sorted(cdmlFiles)) for (outputfile, cdmlFiles) in inputs.items() if len(cdmlFiles) > 1)
+
+def fileHash(path):
+	digest = hashlib.sha1()
+	with open(path, 'rb') as fileHandle:
+		for block in iter(lambda: fileHandle.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def readJournal(journalfile):
+	"""Entries of a journal, by input file (the last one wins). A line cut by an
+	interruption is ignored."""
+	completed = {}
+	if not os.path.exists(journalfile):
+		return completed
+	with open(journalfile) as journalHandle:
+		for line in journalHandle:
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				continue
+			completed[entry['file']] = entry
+	return completed
+
+def isCompleted(entry, job):
+	"""True if the journal 'entry' shows that 'job' was already done: same input
+	content, same options, and the output is still the one that was written."""
+	(cdmlFile, outputfile, withMetrics, canonical, withErrors) = job
+	if entry is None or entry['output'] != os.path.abspath(outputfile) or entry['canonical'] != canonical:
+		return False
+	if not os.path.exists(cdmlFile) or not os.path.exists(outputfile):
+		return False
+	return entry['input_hash'] == fileHash(cdmlFile) and entry['output_hash'] == fileHash(outputfile)
+
+def openJournal(journalfile):
+	journalHandle = open(journalfile, 'a+')
+	# A line cut by an interruption is ended, so that it doesn't swallow the next entry
+	journalHandle.seek(0, os.SEEK_END)
+	if journalHandle.tell() > 0:
+		journalHandle.seek(journalHandle.tell()-1)
+		if journalHandle.read(1) != "\n":
+			journalHandle.write("\n")
+	return journalHandle
+
+def appendJournal(journalHandle, result, canonical):
+	# One line per file, on disk before going on: a preemption loses at most the files in progress
+	entry = {'file': os.path.abspath(result['file']), 'input_hash': result['input_hash'],
+			'output': os.path.abspath(result['output']), 'output_hash': fileHash(result['output']),
+			'canonical': canonical, 'time': result['time'], 'completed': time.time()}
+	journalHandle.write(json.dumps(entry, sort_keys=True)+"\n")
+	journalHandle.flush()
+	os.fsync(journalHandle.fileno())
+
+def improveOne(job):
+	"""Worker: improve one file. 'job' is (input file, output file, True to collect
+	metrics, True for canonical output, True to skip the elements that fail). Errors
+	are returned, not raised, so that one file can't stop the batch. The metrics and
+	skipped elements of the file are sent back to the parent process."""
+	(cdmlFile, outputfile, withMetrics, canonical, withErrors) = job
+	collector = None
+	if withMetrics:
+		collector = metrics.Metrics('improve_cd_file')
+	errors = None
+	if withErrors:
+		errors = error_report.ErrorReport(cdmlFile)
+	start = time.time()
+	result = {'file': cdmlFile, 'output': outputfile, 'status': 'ok', 'error': None, 'input_hash': None}
+	try:
+		# Hash of the input that is actually processed, for the journal
+		result['input_hash'] = fileHash(cdmlFile)
+		improve_cd_file.improveFile(cdmlFile, outputfile, collector, collector, canonical, errors)
+	except (Exception, SystemExit) as error:
+		result['status'] = 'failed'
+		result['error'] = traceback.format_exc().strip().split("\n")[-1]
+		result['output'] = None
+		if collector is not None:
+			collector.fail(error)
+		if errors is not None:
+			errors.record("improveFile", None, error)
+	result['time'] = time.time()-start
+	result['errors'] = len(errors.errors) if errors is not None else 0
+	return (result, collector.state() if collector is not None else None, errors.state() if errors is not None else None)
+
+def improveAll(cdmlFiles, outputdir=None, nbProcesses=None, collector=None, canonical=False, errorStates=None, journalfile=None, resume=False):
+	"""Improve the files over a process pool. Returns the summary as a dictionary.
+	Metrics of the files are merged into 'collector' as they complete. If 'errorStates'
+	is a list, elements that fail are skipped, and the errors of each file appended to it.
+	Files completed without error are appended to 'journalfile' if given; with 'resume',
+	the files it shows as completed are not processed again. Raises ValueError if several
+	files would be written to the same output file."""
+	collisions = outputCollisions(cdmlFiles, outputdir)
+	if len(collisions) != 0:
+		raise ValueError("several files would be written to "+", ".join(sorted(collisions)))
+	jobs = [ (cdmlFile, improve_cd_file.outputPath(cdmlFile, outputdir), collector is not None, canonical, errorStates is not None) for cdmlFile in cdmlFiles ]
+	start = time.time()
+	results = []
+	nbPartial = 0
+	if resume:
+		completed = readJournal(journalfile)
+		remainingJobs = []
+		for job in jobs:
+			for partialfile in improve_cd_file.partialOutputs(job[1]):
+				os.remove(partialfile)
+				nbPartial += 1
+			if isCompleted(completed.get(os.path.abspath(job[0])), job):
+				results.append({'file': job[0], 'output': job[1], 'status': 'resumed', 'error': None, 'time': 0.0, 'errors': 0})
+			else:
+				remainingJobs.append(job)
+		jobs = remainingJobs
+	journalHandle = None
+	if journalfile is not None:
+		journalHandle = openJournal(journalfile)
+	pool = multiprocessing.Pool(nbProcesses)
+	try:
+		# Largest files first, so that one of them doesn't finish alone at the end
+		jobs.sort(key=lambda job: -os.path.getsize(job[0]) if os.path.exists(job[0]) else 0)
+		for (result, metricsState, errorState) in pool.imap_unordered(improveOne, jobs):
+			results.append(result)
+			if journalHandle is not None and result['status'] == 'ok' and result['errors'] == 0:
+				appendJournal(journalHandle, result, canonical)
+			if metricsState is not None:
+				collector.merge(metricsState)
+			if errorState is not None:
+				errorStates.append(errorState)
+	finally:
+		pool.close()
+		pool.join()
+		if journalHandle is not None:
+			journalHandle.close()
+	results.sort(key=lambda result: result['file'])
+	return {'files': results,
+			'total': {'files': len(results),
+					'failures': len([ result for result in results if result['status'] == 'failed' ]),
+					'resumed': len([ result for result in results if result['status'] == 'resumed' ]),
+					'partial': nbPartial,
+					'errors': sum([ result['errors'] for result in results ]),
+					'wall': time.time()-start,
+					'cpu': sum(result['time'] for result in results),
+					'processes': nbProcesses or multiprocessing.cpu_count()}}
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Improve a directory of CellDesigner files over a process pool.")
+	parser.add_argument('cdml', nargs='+', help="CellDesigner files, or directories of CellDesigner files")
+	parser.add_argument('--output-dir', default=None,
+			help="directory of the improved files (default: modified_CDML next to the directory of each input file)")
+	parser.add_argument('--processes', type=int, default=None, help="number of worker processes (default: one per CPU)")
+	parser.add_argument('--canonical', action='store_true', help="write the files in canonical form (see improve_cd_file.py)")
+	parser.add_argument('--report', default=None, help="write the summary, with per-file status and timing, to this JSON file")
+	parser.add_argument('--error-report', metavar='REPORT', help="skip the elements that fail instead of failing their file, and write the errors of all files to this JSON report")
+	parser.add_argument('--journal', metavar='JOURNAL', help="append every file completed without error to this journal (JSON lines)")
+	parser.add_argument('--resume', action='store_true', help="skip the files the journal shows as completed, with unchanged input and output")
+	parser.add_argument('--metrics', metavar='FILE', help="write metrics (Prometheus text format) to this file at exit")
+	parser.add_argument('--metrics-port', metavar='PORT', type=int, help="serve metrics (Prometheus text format) on this local port while running")
+	args = parser.parse_args(argv[1:])
+	if args.resume and args.journal is None:
+		parser.error("--resume needs a --journal")
+	# Files of the same name in different directories would overwrite each other
+	for (outputfile, cdmlFiles) in sorted(outputCollisions(listFiles(args.cdml), args.output_dir).items()):
+		parser.error(" and ".join(cdmlFiles)+" would be written to the same file "+outputfile)
+	return args
+
+def main(argv):
+
+	args = parseArguments(argv)
+	cdmlFiles = listFiles(args.cdml)
+	collector = None
+	if args.metrics is not None or args.metrics_port is not None:
+		collector = metrics.Metrics('improve_cd_file')
+		if args.metrics_port is not None:
+			collector.serve(args.metrics_port)
+	errorStates = None
+	if args.error_report is not None:
+		errorStates = []
+	summary = improveAll(cdmlFiles, args.output_dir, args.processes, collector, args.canonical, errorStates, args.journal, args.resume)
+	if collector is not None and args.metrics is not None:
+		collector.write(args.metrics)
+
+	for result in summary['files']:
+		if result['status'] == 'resumed':
+			print("%-8s %8s  %s -> %s" % (result['status'], "", result['file'], result['output']))
+		elif result['status'] == 'ok' and result['errors'] != 0:
+			print("%-8s %7.3fs  %s -> %s (%d elements skipped)" % (result['status'], result['time'], result['file'], result['output'], result['errors']))
+		elif result['status'] == 'ok':
+			print("%-8s %7.3fs  %s -> %s" % (result['status'], result['time'], result['file'], result['output']))
+		else:
+			print("%-8s %7.3fs  %s: %s" % (result['status'], result['time'], result['file'], result['error']))
+	total = summary['total']
+	print("%d files, %d failures, %d errors, %.3fs wall, %.3fs in workers (%d processes)" % (total['files'], total['failures'], total['errors'], total['wall'], total['cpu'], total['processes']))
+	if args.resume:
+		print("%d files already completed, %d partial outputs removed" % (total['resumed'], total['partial']))
+
+	if args.report is not None:
+		with open(args.report, 'w') as reportHandle:
+			json.dump(summary, reportHandle, indent=1, sort_keys=True)
+	if errorStates is not None:
+		error_report.writeReport(args.error_report, sorted(errorStates, key=lambda errorState: errorState['file']))
+	return 1 if total['failures'] != 0 or total['errors'] != 0 else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
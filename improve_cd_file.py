@@ -4,37 +4,299 @@
 # 
 # Example of a command line : 
 # $ python improve_cd_file.py ./DC-SIGN_cd.xml
+#
+# From Python, on a document already parsed with lxml (no file written):
+#	improve_cd_file.improveTree(cdmlTree)
+# or pass by pass, e.g. improve_cd_file.adjustReactions(cdmlTree.getroot())
+# Passes take an optional ErrorReport (see error_report.py): elements that fail are then
+# recorded there and skipped, instead of stopping the whole file.
 
 
 # General
 import sys
+import os
 import os.path
 import re
+import errno
+import socket
+import argparse
+
+from error_report import collecting, MapError
+from canonical_order import naturalKey, entryKey
 
 # For XML
 #sudo pip install lxml
-from lxml import etree
-import lxml.html as lxh
+# (only imported once a file is actually processed, see loadEtree)
+etree = None
 
-def main(argv):
-	
-	# Open CellDesigner XML file and parse
-	cdmlRoot = etree.parse(argv[1]).getroot()
-	
-	# ElementTree needs a list of nested namespaces
-	namespaces = {'sbml': 'http://www.sbml.org/sbml/level2/version4', 'celldesigner': 'http://www.sbml.org/2001/ns/celldesigner'}
-	
-	#####
-	# Adjust CellDesigner parameters
+__version__ = "1.0"
+
+# ElementTree needs a list of nested namespaces
+namespaces = {'sbml': 'http://www.sbml.org/sbml/level2/version4', 'celldesigner': 'http://www.sbml.org/2001/ns/celldesigner'}
+
+def loadEtree():
+	global etree
+	if etree is None:
+		from lxml import etree as loadedEtree
+		etree = loadedEtree
+	return etree
+
+# Every lookup of the passes, by name. Each one is compiled once into an XPath object
+# (see lookup). Ids and names are given as XPath variables ($id...) instead of being
+# pasted into the path, so that any value, quotes included, is matched as it is.
+# "descendant::" is the ".//" of find(), but walks the tree once instead of once per node.
+lookupPaths = {
+	'species': "descendant::sbml:species",
+	'simpleChemicals': "descendant::sbml:species[@sboTerm='SBO:0000247']",
+	'speciesByName': "descendant::sbml:species[@name=$name]",
+	'speciesClass': "descendant::*/celldesigner:class",
+	'proteinReference': "descendant::*/celldesigner:proteinReference",
+	'notes': "descendant::sbml:notes",
+	'state': "descendant::*/celldesigner:state",
+	'listOfModifications': "descendant::*/celldesigner:listOfModifications",
+	'modifications': "descendant::*/celldesigner:modification",
+	'proteins': "descendant::*/celldesigner:protein",
+	'protein': "descendant::*/celldesigner:protein[@id=$id]",
+	'proteinResidues': "descendant::*/celldesigner:protein[@id=$id]/*/celldesigner:modificationResidue",
+	'residueLists': "celldesigner:listOfModificationResidues",
+	'residues': "celldesigner:listOfModificationResidues/celldesigner:modificationResidue",
+	'listOfRNAs': "descendant::*/celldesigner:listOfRNAs",
+	'listOfGenes': "descendant::*/celldesigner:listOfGenes",
+	'speciesAliases': "descendant::celldesigner:speciesAlias",
+	'complexSpeciesAliases': "descendant::celldesigner:complexSpeciesAlias",
+	'listOfComplexSpeciesAliases': "descendant::celldesigner:listOfComplexSpeciesAliases",
+	'aliasPaint': "celldesigner:usualView/celldesigner:paint",
+	'singleLines': "descendant::celldesigner:singleLine",
+	'paints': "descendant::celldesigner:paint",
+	'activity': "descendant::celldesigner:activity",
+	'editPoints': "descendant::celldesigner:editPoints",
+	'transcriptions': "descendant::sbml:reaction[@sboTerm='SBO:0000183']",
+	'reactionType': "descendant::celldesigner:reactionType",
+	'reactionModifications': "sbml:annotation/celldesigner:extension/celldesigner:listOfModification/celldesigner:modification",
+	'modifiers': "sbml:listOfModifiers/sbml:modifierSpeciesReference",
+	'modifierAlias': "sbml:annotation/celldesigner:extension/celldesigner:alias"}
+compiledLookups = {}
+
+def lookup(lookupName, element, **variables):
+	"""Elements found from 'element' by a lookup of lookupPaths, in document order."""
+	compiled = compiledLookups.get(lookupName)
+	if compiled is None:
+		compiled = compiledLookups[lookupName] = loadEtree().XPath(lookupPaths[lookupName], namespaces=namespaces)
+	return compiled(element, **variables)
+
+def lookupFirst(lookupName, element, **variables):
+	"""First element found by lookup(), or None."""
+	found = lookup(lookupName, element, **variables)
+	if len(found) == 0:
+		return None
+	return found[0]
+
+def lookupRequired(lookupName, element, **variables):
+	"""First element found by lookup(), for elements the map must have: raises MapError
+	if there is none."""
+	found = lookup(lookupName, element, **variables)
+	if len(found) == 0:
+		where = str(element.tag).split('}')[-1]
+		if element.get('id') is not None:
+			where += " "+element.get('id')
+		wanted = lookupName+"".join([ " "+name+"="+str(value) for (name, value) in sorted(variables.items()) ])
+		raise MapError("no "+wanted+" in "+where)
+	return found[0]
+
+class ResidueRegistry(object):
+	"""Modification residues of a protein (listOfModificationResidues). Each residue is
+	allocated once: named residues (e.g. P@340) are found by name, unnamed ones by
+	modification state and rank, and a new residue gets the next free id "rsN" and
+	angle N*0.5. write() puts the residues back in the protein, as one list.
+	"""
+
+	def __init__(self, cdmlProtein):
+		self.protein = cdmlProtein
+		self.clear()
+		for cdmlResidue in lookup('residues', cdmlProtein):
+			self.add(cdmlResidue)
+
+	def clear(self):
+		# Residue elements, in allocation order
+		self.residues = []
+		# Id -> name (None if unnamed), name -> id, state -> ids of the unnamed residues by rank
+		self.names = {}
+		self.named = {}
+		self.unnamed = {}
+
+	def add(self, cdmlResidue):
+		residueId = cdmlResidue.get('id')
+		name = cdmlResidue.get('name')
+		self.residues.append(cdmlResidue)
+		self.names[residueId] = name
+		if name is not None:
+			self.named.setdefault(name, residueId)
+		return residueId
+
+	def allocate(self, name=None):
+		number = len(self.residues)+1
+		while "rs"+str(number) in self.names:
+			number += 1
+		cdmlResidue = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'modificationResidue'))
+		cdmlResidue.set('angle', str(number*0.5))
+		cdmlResidue.set('id', "rs"+str(number))
+		cdmlResidue.set('side', 'none')
+		if name is not None:
+			cdmlResidue.set('name', name)
+		return self.add(cdmlResidue)
+
+	def name(self, residueId):
+		"""Name of a residue, None if it is unnamed or unknown."""
+		return self.names.get(residueId)
+
+	def namedResidue(self, name):
+		"""Id of the residue with this name, allocated if needed."""
+		residueId = self.named.get(name)
+		if residueId is None:
+			residueId = self.allocate(name)
+		return residueId
+
+	def unnamedResidue(self, state, rank):
+		"""Id of the rank-th (from 0) unnamed residue with this state, allocated if needed."""
+		residueIds = self.unnamed.setdefault(state, [])
+		while len(residueIds) <= rank:
+			residueIds.append(self.allocate())
+		return residueIds[rank]
+
+	def write(self):
+		for cdmlList in lookup('residueLists', self.protein):
+			self.protein.remove(cdmlList)
+		if len(self.residues) == 0:
+			return
+		cdmlList = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'listOfModificationResidues'))
+		for cdmlResidue in self.residues:
+			cdmlList.append(cdmlResidue)
+		self.protein.append(cdmlList)
+
+class ListChanges(object):
+	"""Removals and insertions planned on the lists of a CellDesigner file (listOfProteins,
+	listOfRNAs...). Removing or appending elements one at a time makes every change walk
+	long sibling lists; instead, apply() rebuilds each affected list once.
+	"""
+
+	def __init__(self):
+		self.removed = set()
+		self.appended = {}
+		# Affected lists, in the order they were first changed
+		self.parents = []
+
+	def touch(self, parent):
+		if parent not in self.appended:
+			self.appended[parent] = []
+			self.parents.append(parent)
+
+	def remove(self, element):
+		self.touch(element.getparent())
+		self.removed.add(element)
+
+	def append(self, parent, element):
+		self.touch(parent)
+		self.appended[parent].append(element)
+
+	def apply(self):
+		for parent in self.parents:
+			parent[:] = [ child for child in parent if child not in self.removed ]+self.appended[parent]
+		self.__init__()
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Improve XML files generated by CellDesigner after a BCML to SBML conversion.")
+	parser.add_argument('cdml', help="CellDesigner file to improve")
+	parser.add_argument('--version', action='version', version='%(prog)s '+__version__)
+	parser.add_argument('--output-dir', default=None,
+			help="directory of the improved file (default: modified_CDML next to the directory of the input file)")
+	parser.add_argument('--canonical', action='store_true',
+			help="write the file in canonical form (lists sorted by id, attributes sorted), so that equivalent files are identical byte for byte")
+	parser.add_argument('--error-report', metavar='REPORT',
+			help="skip the elements that fail instead of stopping at the first one, and write them to this JSON report")
+	parser.add_argument('--memory-report', metavar='REPORT',
+			help="write a JSON report of the memory used by each stage (tracemalloc and RSS)")
+	parser.add_argument('--metrics', metavar='FILE',
+			help="write metrics (Prometheus text format) to this file at exit")
+	parser.add_argument('--metrics-port', metavar='PORT', type=int,
+			help="serve metrics (Prometheus text format) on this local port while running")
+	args = parser.parse_args(argv[1:])
+	if not os.path.isfile(args.cdml):
+		parser.error("cannot read CellDesigner file "+args.cdml)
+	return args
+
+def outputPath(cdmlFile, outputdir=None):
+	if outputdir is None:
+		outputdir = os.path.join(os.path.abspath(os.path.join(os.path.dirname(cdmlFile), os.pardir)), "modified_CDML")
+	return os.path.join(outputdir, os.path.basename(cdmlFile))
+
+def temporaryPath(outputfile):
+	# The output is written under this name, then renamed: an interrupted run never
+	# leaves a truncated file under the final name. The host is part of the name, as
+	# the output directory can be shared by the processes of several hosts.
+	(outputdir, name) = os.path.split(outputfile)
+	return os.path.join(outputdir, "."+name+"."+socket.gethostname()+"."+str(os.getpid())+".tmp")
+
+def isRunning(pid):
+	try:
+		os.kill(pid, 0)
+	except OSError as error:
+		# EPERM: the process exists, but belongs to another user
+		return error.errno == errno.EPERM
+	return True
+
+def partialOutputs(outputfile):
+	"""Temporary files left by interrupted writes of 'outputfile': those of processes
+	of this host that are not running any more. Files still being written by another
+	run, and files of other hosts (whose processes can't be checked), are kept."""
+	(outputdir, name) = os.path.split(outputfile)
+	if not os.path.isdir(outputdir or '.'):
+		return []
+	hostname = socket.gethostname()
+	partialfiles = []
+	for filename in sorted(os.listdir(outputdir or '.')):
+		if not (filename.startswith("."+name+".") and filename.endswith(".tmp")):
+			continue
+		(host, separator, pid) = filename[len("."+name+"."):-len(".tmp")].rpartition(".")
+		if host == hostname and pid.isdigit() and not isRunning(int(pid)):
+			partialfiles.append(os.path.join(outputdir, filename))
+	return partialfiles
+
+class SpeciesLists(object):
+	"""Proteins and species aliases of a CellDesigner file, by id (first occurrence,
+	like find() would). Built once and shared by the species passes, which move
+	species between lists.
+	"""
+
+	def __init__(self, cdmlRoot):
+		self.proteins = {}
+		for cdmlProtein in lookup('proteins', cdmlRoot):
+			self.proteins.setdefault(cdmlProtein.get('id'), cdmlProtein)
+		self.speciesAliases = {}
+		for cdmlSpeciesAlias in lookup('speciesAliases', cdmlRoot):
+			self.speciesAliases.setdefault(cdmlSpeciesAlias.get('species'), cdmlSpeciesAlias)
+
+
+#####
+# Passes: each one changes a parsed CellDesigner document (root element) in place,
+# and can be run on its own
+
+def removeEditPoints(cdmlRoot):
+	"""Remove the edit points CellDesigner adds to reactions."""
 	
 	##### Remove unnecessary points automatically created by CellDesigner
 	# delete [\w]*<celldesigner:editPoints>.*</celldesigner:editPoints>
-	for cdmlEditPoints in cdmlRoot.findall(".//celldesigner:editPoints", namespaces):
+	for cdmlEditPoints in lookup('editPoints', cdmlRoot):
 		cdmlEditPoints.getparent().remove(cdmlEditPoints)
+
+def adjustRnaSpecies(cdmlRoot, speciesLists=None, errors=None):
+	"""Change species representing RNAs (id starting with 'mRNA') to the RNA class."""
 	
-	
-	#####
-	# Adjust species types
+	loadEtree()
+	if speciesLists is None:
+		speciesLists = SpeciesLists(cdmlRoot)
+	proteins = speciesLists.proteins
+	speciesAliases = speciesLists.speciesAliases
+	listChanges = ListChanges()
 	
 	##### Change species representing genes to real type "RNA"
 	# - Remove protein element from list
@@ -78,48 +340,65 @@ def main(argv):
 	#		<celldesigner:info state="empty" angle="-1.5707963267948966"/>
 	#	</celldesigner:speciesAlias>
 	countRNA = 1
-	for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species"):
-		
-		if not cdmlSpecies.get('id').startswith('mRNA'):
-			# Only interested in RNA species
-			continue
-		
-		rnaId = cdmlSpecies.get('id')
-		#print(rnaId)
-		
-		# Change class from PROTEIN to RNA
-		cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
-		cdmlClass.text = "RNA"
-		
-		# Change reference
-		# Delete protein reference
-		cdmlProtRef = cdmlSpecies.find(".//*/celldesigner:proteinReference", namespaces)
-		protId = cdmlProtRef.text
-		cdmlRefParent = cdmlProtRef.getparent()
-		cdmlRefParent.remove(cdmlProtRef)
-		# Add RNA reference
-		newCdmlRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'rnaReference'))
-		newCdmlRef.text = "rn"+str(countRNA)
-		cdmlRefParent.append(newCdmlRef)
-		
-		# Change default colour of its SpeciesAlias
-		cdmlSpeciesAlias = cdmlRoot.find(".//celldesigner:speciesAlias[@species='"+rnaId+"']/celldesigner:usualView/celldesigner:paint", namespaces)
-		cdmlSpeciesAlias.set('color', "ff66ff66")
-		
-		# Remove from list of proteins
-		cdmlListProtRef = cdmlRoot.find(".//*/celldesigner:protein[@id='"+protId+"']", namespaces)
-		cdmlListProtRef.getparent().remove(cdmlListProtRef)
-		
-		# Add to list of RNAs
-		cdmlListRna = cdmlRoot.find(".//*/celldesigner:listOfRNAs", namespaces)
-		newRnaRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'RNA'))
-		# id="rn1" name="IL-8" type="RNA"
-		newRnaRef.set('id', "rn"+str(countRNA))
-		newRnaRef.set('name', cdmlSpecies.attrib.get('name'))
-		newRnaRef.set('type', "RNA")
-		cdmlListRna.append(newRnaRef)
-		
-		countRNA+=1
+	cdmlListRna = None
+	for cdmlSpecies in lookup('species', cdmlRoot):
+		with collecting(errors, "adjustRnaSpecies", cdmlSpecies):
+			
+			if not cdmlSpecies.get('id').startswith('mRNA'):
+				# Only interested in RNA species
+				continue
+			
+			rnaId = cdmlSpecies.get('id')
+			#print(rnaId)
+			
+			# Everything that can be missing is looked up before the species is changed,
+			# so that a skipped species is left as it was
+			cdmlClass = lookupRequired('speciesClass', cdmlSpecies)
+			cdmlProtRef = lookupRequired('proteinReference', cdmlSpecies)
+			protId = cdmlProtRef.text
+			cdmlProtein = proteins[protId]
+			cdmlSpeciesAlias = lookupRequired('aliasPaint', speciesAliases[rnaId])
+			if cdmlListRna is None:
+				cdmlListRna = lookupRequired('listOfRNAs', cdmlRoot)
+			
+			# Change class from PROTEIN to RNA
+			cdmlClass.text = "RNA"
+			
+			# Change reference
+			# Delete protein reference
+			cdmlRefParent = cdmlProtRef.getparent()
+			cdmlRefParent.remove(cdmlProtRef)
+			# Add RNA reference
+			newCdmlRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'rnaReference'))
+			newCdmlRef.text = "rn"+str(countRNA)
+			cdmlRefParent.append(newCdmlRef)
+			
+			# Change default colour of its SpeciesAlias
+			cdmlSpeciesAlias.set('color', "ff66ff66")
+			
+			# Remove from list of proteins
+			listChanges.remove(cdmlProtein)
+			
+			# Add to list of RNAs
+			newRnaRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'RNA'))
+			# id="rn1" name="IL-8" type="RNA"
+			newRnaRef.set('id', "rn"+str(countRNA))
+			newRnaRef.set('name', cdmlSpecies.attrib.get('name'))
+			newRnaRef.set('type', "RNA")
+			listChanges.append(cdmlListRna, newRnaRef)
+			
+			countRNA+=1
+	listChanges.apply()
+
+def adjustGeneSpecies(cdmlRoot, speciesLists=None, errors=None):
+	"""Change species representing genes (id starting with 'gene') to the GENE class."""
+	
+	loadEtree()
+	if speciesLists is None:
+		speciesLists = SpeciesLists(cdmlRoot)
+	proteins = speciesLists.proteins
+	speciesAliases = speciesLists.speciesAliases
+	listChanges = ListChanges()
 	
 	##### Change species representing genes to real type "Gene"
 	# - Remove protein element from list
@@ -149,49 +428,65 @@ def main(argv):
 	#		</celldesigner:usualView>
 	#	</celldesigner:speciesAlias>
 	countGene = 1
-	for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species"):
-		
-		if not cdmlSpecies.get('id').startswith('gene'):
-			# Only interested in gene species
-			continue
-		
-		geneId = cdmlSpecies.get('id')
-		#print(geneId)
-		
-		# Change class from PROTEIN to GENE
-		cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
-		cdmlClass.text = "GENE"
-		
-		# Change reference
-		# Delete protein reference
-		cdmlProtRef = cdmlSpecies.find(".//*/celldesigner:proteinReference", namespaces)
-		protId = cdmlProtRef.text
-		cdmlRefParent = cdmlProtRef.getparent()
-		cdmlRefParent.remove(cdmlProtRef)
-		# Add GENE reference
-		newCdmlRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'geneReference'))
-		newCdmlRef.text = "gn"+str(countGene)
-		cdmlRefParent.append(newCdmlRef)
-		
-		# Change default colour of its SpeciesAlias
-		cdmlSpeciesAlias = cdmlRoot.find(".//celldesigner:speciesAlias[@species='"+geneId+"']/celldesigner:usualView/celldesigner:paint", namespaces)
-		cdmlSpeciesAlias.set('color', "ffffff66")
-		
-		# Remove from list of proteins
-		cdmlListProtRef = cdmlRoot.find(".//*/celldesigner:protein[@id='"+protId+"']", namespaces)
-		cdmlListProtRef.getparent().remove(cdmlListProtRef)
-		
-		# Add to list of RNAs
-		cdmlListGene = cdmlRoot.find(".//*/celldesigner:listOfGenes", namespaces)
-		newGeneRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'gene'))
-		# id="rn1" name="IL-8" type="GENE"
-		newGeneRef.set('id', "gn"+str(countGene))
-		newGeneRef.set('name', cdmlSpecies.attrib.get('name'))
-		newGeneRef.set('type', "GENE")
-		cdmlListGene.append(newGeneRef)
-		
-		countGene +=1
+	cdmlListGene = None
+	for cdmlSpecies in lookup('species', cdmlRoot):
+		with collecting(errors, "adjustGeneSpecies", cdmlSpecies):
+			
+			if not cdmlSpecies.get('id').startswith('gene'):
+				# Only interested in gene species
+				continue
+			
+			geneId = cdmlSpecies.get('id')
+			#print(geneId)
+			
+			# Lookups first, as in adjustRnaSpecies
+			cdmlClass = lookupRequired('speciesClass', cdmlSpecies)
+			cdmlProtRef = lookupRequired('proteinReference', cdmlSpecies)
+			protId = cdmlProtRef.text
+			cdmlProtein = proteins[protId]
+			cdmlSpeciesAlias = lookupRequired('aliasPaint', speciesAliases[geneId])
+			if cdmlListGene is None:
+				cdmlListGene = lookupRequired('listOfGenes', cdmlRoot)
+			
+			# Change class from PROTEIN to GENE
+			cdmlClass.text = "GENE"
+			
+			# Change reference
+			# Delete protein reference
+			cdmlRefParent = cdmlProtRef.getparent()
+			cdmlRefParent.remove(cdmlProtRef)
+			# Add GENE reference
+			newCdmlRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'geneReference'))
+			newCdmlRef.text = "gn"+str(countGene)
+			cdmlRefParent.append(newCdmlRef)
+			
+			# Change default colour of its SpeciesAlias
+			cdmlSpeciesAlias.set('color', "ffffff66")
+			
+			# Remove from list of proteins
+			listChanges.remove(cdmlProtein)
+			
+			# Add to list of genes
+			newGeneRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'gene'))
+			# id="rn1" name="IL-8" type="GENE"
+			newGeneRef.set('id', "gn"+str(countGene))
+			newGeneRef.set('name', cdmlSpecies.attrib.get('name'))
+			newGeneRef.set('type', "GENE")
+			listChanges.append(cdmlListGene, newGeneRef)
+			
+			countGene +=1
+	listChanges.apply()
 
+def adjustComplexSpecies(cdmlRoot, speciesLists=None, errors=None):
+	"""Change species representing complexes (':' in their name) to the COMPLEX class."""
+	
+	loadEtree()
+	if speciesLists is None:
+		speciesLists = SpeciesLists(cdmlRoot)
+	proteins = speciesLists.proteins
+	speciesAliases = speciesLists.speciesAliases
+	listChanges = ListChanges()
+	
 	##### Change species representing complexes to real type "Complex"
 	# - Remove protein element from list
 	# 	element <celldesigner:protein id="pr83" name="IL-8" type="GENERIC"/>
@@ -257,67 +552,83 @@ def main(argv):
 	#				</annotation>
 	#			</speciesReference>
 	#		</listOfReactants>
-	for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species"):
-		
-		if not re.match(".*[:].*", cdmlSpecies.attrib.get('name'), flags=0):
-			# Only interested in Complex species (have a ':' in their name)
-			continue
-		
-		complexId = cdmlSpecies.get('id')
-		#print(cdmlSpecies.get('name'))
-		
-		## Update species
-		# Change species class from PROTEIN to COMPLEX
-		cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
-		cdmlClass.text = "COMPLEX"
-		# Delete protein reference in species
-		cdmlProtRef = cdmlSpecies.find(".//*/celldesigner:proteinReference", namespaces)
-		protId = cdmlProtRef.text
-		cdmlRefParent = cdmlProtRef.getparent()
-		cdmlRefParent.remove(cdmlProtRef)
-		# Replace by name
-		newCdmlRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'name'))
-		newCdmlRef.text = cdmlSpecies.attrib.get('name')
-		cdmlRefParent.append(newCdmlRef)
-		
-		## Remove from list of proteins
-		cdmlListProtRef = cdmlRoot.find(".//*/celldesigner:protein[@id='"+protId+"']", namespaces)
-		cdmlListProtRef.getparent().remove(cdmlListProtRef)
-		
-		## Change location of its SpeciesAlias to the list of ComplexSpeciesAlias
-		# Find SpeciesAlias
-		cdmlSpeciesAlias = cdmlRoot.find(".//celldesigner:speciesAlias[@species='"+complexId+"']", namespaces)
-		# Create new ComplexSpeciesAlias
-		newCxSpeciesAlias = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'complexSpeciesAlias'))
-		# Copy attributes of SpeciesAlias to ComplexSpeciesAlias
-		#  id="sa23" species="Rho_inactive" compartmentAlias="ca2"
-		newCxSpeciesAlias.set('id', cdmlSpeciesAlias.attrib.get('id'))
-		newCxSpeciesAlias.set('species', cdmlSpeciesAlias.attrib.get('species'))
-		newCxSpeciesAlias.set('compartmentAlias', cdmlSpeciesAlias.attrib.get('compartmentAlias'))
-		# Move children of SpeciesAlias to ComplexSpeciesAlias
-		children = list(cdmlSpeciesAlias)
-		for child in children:
-			newCxSpeciesAlias.append(child)
-		# Modify attributes in children celldesigner:singleLine width="2.0" and celldesigner:paint color="fff7f7f7"
-		for singleLine in newCxSpeciesAlias.findall(".//celldesigner:singleLine", namespaces):
-			singleLine.set('width', "2.0")
-		for paint in newCxSpeciesAlias.findall(".//celldesigner:paint", namespaces):
-			paint.set('color', "fff7f7f7")
-		# Append new children
-		#	<celldesigner:backupSize w="0.0" h="0.0"/>
-		#	<celldesigner:backupView state="none"/>
-		newBackupSize = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'backupSize'))
-		newBackupSize.set('w', "0.0")
-		newBackupSize.set('h', "0.0")
-		newCxSpeciesAlias.append(newBackupSize)
-		newBackupView = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'backupView'))
-		newBackupView.set('state', "none")
-		newCxSpeciesAlias.append(newBackupView)
-		# Append the new ComplexSpeciesAlias to corresponding list
-		cdmlListCxSpeciesAlias = cdmlRoot.find(".//celldesigner:listOfComplexSpeciesAliases", namespaces)
-		cdmlListCxSpeciesAlias.append(newCxSpeciesAlias)
-		# Remove older SpeciesAlias
-		cdmlSpeciesAlias.getparent().remove(cdmlSpeciesAlias)
+	cdmlListCxSpeciesAlias = None
+	for cdmlSpecies in lookup('species', cdmlRoot):
+		with collecting(errors, "adjustComplexSpecies", cdmlSpecies):
+			
+			if not re.match(".*[:].*", cdmlSpecies.attrib.get('name'), flags=0):
+				# Only interested in Complex species (have a ':' in their name)
+				continue
+			
+			complexId = cdmlSpecies.get('id')
+			#print(cdmlSpecies.get('name'))
+			
+			# Lookups first, as in adjustRnaSpecies
+			cdmlClass = lookupRequired('speciesClass', cdmlSpecies)
+			cdmlProtRef = lookupRequired('proteinReference', cdmlSpecies)
+			protId = cdmlProtRef.text
+			cdmlProtein = proteins[protId]
+			cdmlSpeciesAlias = speciesAliases[complexId]
+			if cdmlListCxSpeciesAlias is None:
+				cdmlListCxSpeciesAlias = lookupRequired('listOfComplexSpeciesAliases', cdmlRoot)
+			
+			## Update species
+			# Change species class from PROTEIN to COMPLEX
+			cdmlClass.text = "COMPLEX"
+			# Delete protein reference in species
+			cdmlRefParent = cdmlProtRef.getparent()
+			cdmlRefParent.remove(cdmlProtRef)
+			# Replace by name
+			newCdmlRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'name'))
+			newCdmlRef.text = cdmlSpecies.attrib.get('name')
+			cdmlRefParent.append(newCdmlRef)
+			
+			## Remove from list of proteins
+			listChanges.remove(cdmlProtein)
+			
+			## Change location of its SpeciesAlias to the list of ComplexSpeciesAlias
+			del speciesAliases[complexId]
+			# Create new ComplexSpeciesAlias
+			newCxSpeciesAlias = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'complexSpeciesAlias'))
+			# Copy attributes of SpeciesAlias to ComplexSpeciesAlias
+			#  id="sa23" species="Rho_inactive" compartmentAlias="ca2"
+			newCxSpeciesAlias.set('id', cdmlSpeciesAlias.attrib.get('id'))
+			newCxSpeciesAlias.set('species', cdmlSpeciesAlias.attrib.get('species'))
+			newCxSpeciesAlias.set('compartmentAlias', cdmlSpeciesAlias.attrib.get('compartmentAlias'))
+			# Move children of SpeciesAlias to ComplexSpeciesAlias
+			children = list(cdmlSpeciesAlias)
+			for child in children:
+				newCxSpeciesAlias.append(child)
+			# Modify attributes in children celldesigner:singleLine width="2.0" and celldesigner:paint color="fff7f7f7"
+			for singleLine in lookup('singleLines', newCxSpeciesAlias):
+				singleLine.set('width', "2.0")
+			for paint in lookup('paints', newCxSpeciesAlias):
+				paint.set('color', "fff7f7f7")
+			# Append new children
+			#	<celldesigner:backupSize w="0.0" h="0.0"/>
+			#	<celldesigner:backupView state="none"/>
+			newBackupSize = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'backupSize'))
+			newBackupSize.set('w', "0.0")
+			newBackupSize.set('h', "0.0")
+			newCxSpeciesAlias.append(newBackupSize)
+			newBackupView = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'backupView'))
+			newBackupView.set('state', "none")
+			newCxSpeciesAlias.append(newBackupView)
+			# Append the new ComplexSpeciesAlias to corresponding list
+			listChanges.append(cdmlListCxSpeciesAlias, newCxSpeciesAlias)
+			# Remove older SpeciesAlias
+			listChanges.remove(cdmlSpeciesAlias)
+	listChanges.apply()
+
+def adjustSimpleChemicalSpecies(cdmlRoot, speciesLists=None, errors=None):
+	"""Change simple chemicals (SBO term 247) to the SIMPLE_MOLECULE class."""
+	
+	loadEtree()
+	if speciesLists is None:
+		speciesLists = SpeciesLists(cdmlRoot)
+	proteins = speciesLists.proteins
+	speciesAliases = speciesLists.speciesAliases
+	listChanges = ListChanges()
 	
 	##### Change species representing simple chemicals to real type "SimpleChemical"
 	# These species are identified by SBO term 247. They don't have a specific list.
@@ -328,34 +639,39 @@ def main(argv):
 	#		<celldesigner:name>s212</celldesigner:name>
 	#	</celldesigner:speciesIdentity>
 	# - Remove from protein list.
-	for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species[@sboTerm='SBO:0000247']"):
-		
-		chemId = cdmlSpecies.get('id')
-		#print(geneId)
-		
-		# Change default colour of its SpeciesAlias
-		cdmlSpeciesAlias = cdmlRoot.find(".//celldesigner:speciesAlias[@species='"+chemId+"']/celldesigner:usualView/celldesigner:paint", namespaces)
-		cdmlSpeciesAlias.set('color', "ffccff66")
-
-		## Update species
-		# Change species class from PROTEIN to COMPLEX
-		cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
-		cdmlClass.text = "SIMPLE_MOLECULE"
-		# Delete protein reference in species
-		cdmlProtRef = cdmlSpecies.find(".//*/celldesigner:proteinReference", namespaces)
-		protId = cdmlProtRef.text
-		cdmlRefParent = cdmlProtRef.getparent()
-		cdmlRefParent.remove(cdmlProtRef)
-		# Replace by name
-		newCdmlRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'name'))
-		newCdmlRef.text = cdmlSpecies.attrib.get('name')
-		cdmlRefParent.append(newCdmlRef)
-		
-		# Remove from list of proteins
-		cdmlListProtRef = cdmlRoot.find(".//*/celldesigner:protein[@id='"+protId+"']", namespaces)
-		cdmlListProtRef.getparent().remove(cdmlListProtRef)
-	
-	
+	for cdmlSpecies in lookup('simpleChemicals', cdmlRoot):
+		with collecting(errors, "adjustSimpleChemicalSpecies", cdmlSpecies):
+			
+			chemId = cdmlSpecies.get('id')
+			#print(geneId)
+			
+			# Lookups first, as in adjustRnaSpecies
+			cdmlSpeciesAlias = lookupRequired('aliasPaint', speciesAliases[chemId])
+			cdmlClass = lookupRequired('speciesClass', cdmlSpecies)
+			cdmlProtRef = lookupRequired('proteinReference', cdmlSpecies)
+			protId = cdmlProtRef.text
+			cdmlProtein = proteins[protId]
+			
+			# Change default colour of its SpeciesAlias
+			cdmlSpeciesAlias.set('color', "ffccff66")
+
+			## Update species
+			# Change species class from PROTEIN to COMPLEX
+			cdmlClass.text = "SIMPLE_MOLECULE"
+			# Delete protein reference in species
+			cdmlRefParent = cdmlProtRef.getparent()
+			cdmlRefParent.remove(cdmlProtRef)
+			# Replace by name
+			newCdmlRef = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'name'))
+			newCdmlRef.text = cdmlSpecies.attrib.get('name')
+			cdmlRefParent.append(newCdmlRef)
+			
+			# Remove from list of proteins
+			listChanges.remove(cdmlProtein)
+	listChanges.apply()
+
+def adjustActivity(cdmlRoot, errors=None):
+	"""Set the activity of proteins and complexes from the StateVariable of their notes."""
 	
 	#####
 	# Adjust species parameters
@@ -364,37 +680,45 @@ def main(argv):
 	# - Depending on what is in the species/complex notes, set activity to active/inactive in the corresponding alias
 	#	<celldesigner:complexSpeciesAlias id="a435" species="s188" compartmentAlias="ca3">
 	#		<celldesigner:activity>active</celldesigner:activity>
-	for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species"):
-	
-		# Complex or protein ?
-		cdmlClassText = cdmlSpecies.find(".//*/celldesigner:class", namespaces).text
-		if not cdmlClassText == "COMPLEX" and not cdmlClassText == "PROTEIN":
-			continue
-		
-		# Get its ID
-		speciesId = cdmlSpecies.get('id')
+	# (Complex)speciesAliases by species, first occurrence
+	aliases = {'PROTEIN': {}, 'COMPLEX': {}}
+	for cdmlSpeciesAlias in lookup('speciesAliases', cdmlRoot):
+		aliases['PROTEIN'].setdefault(cdmlSpeciesAlias.get('species'), cdmlSpeciesAlias)
+	for cdmlSpeciesAlias in lookup('complexSpeciesAliases', cdmlRoot):
+		aliases['COMPLEX'].setdefault(cdmlSpeciesAlias.get('species'), cdmlSpeciesAlias)
+	for cdmlSpecies in lookup('species', cdmlRoot):
+		with collecting(errors, "adjustActivity", cdmlSpecies):
 		
-		# Find activation state in notes "StateVariable:(in)active"
-		notesElement = cdmlSpecies.find(".//{http://www.sbml.org/sbml/level2/version4}notes")
-		if notesElement is not None:
-			# Extract note text
-			notesText = "".join([x for x in notesElement.itertext()]).strip()
-			# Try to find StateVariable:inactive or StateVariable:active in the notes
-			matches = re.search("StateVariable:([i]?[n]?active)", notesText)
-			# If we have a match
-			if matches:
-				#print(speciesId+" "+cdmlClassText+" "+matches.group(1))
-				# Find corresponding (complex)speciesAlias
-				aliasElement = None
-				# If we have a protein
-				if cdmlClassText == "PROTEIN":
-					aliasElement = cdmlRoot.find(".//celldesigner:speciesAlias[@species='"+speciesId+"']", namespaces)
-				# Else (necessarily a complex)
-				else:
-					aliasElement =  cdmlRoot.find(".//celldesigner:complexSpeciesAlias[@species='"+speciesId+"']", namespaces)
-				#Find celldesigner:activity
-				activeElement = aliasElement.find(".//celldesigner:activity", namespaces)
-				activeElement.text = matches.group(1)
+			# Complex or protein ?
+			cdmlClassText = lookupRequired('speciesClass', cdmlSpecies).text
+			if not cdmlClassText == "COMPLEX" and not cdmlClassText == "PROTEIN":
+				continue
+			
+			# Get its ID
+			speciesId = cdmlSpecies.get('id')
+			
+			# Find activation state in notes "StateVariable:(in)active"
+			notesElement = lookupFirst('notes', cdmlSpecies)
+			if notesElement is not None:
+				# Extract note text
+				notesText = "".join([x for x in notesElement.itertext()]).strip()
+				# Try to find StateVariable:inactive or StateVariable:active in the notes
+				matches = re.search("StateVariable:([i]?[n]?active)", notesText)
+				# If we have a match
+				if matches:
+					#print(speciesId+" "+cdmlClassText+" "+matches.group(1))
+					# Find corresponding (complex)speciesAlias
+					aliasElement = aliases[cdmlClassText].get(speciesId)
+					if aliasElement is None:
+						raise MapError("no alias of species "+speciesId)
+					#Find celldesigner:activity
+					activeElement = lookupRequired('activity', aliasElement)
+					activeElement.text = matches.group(1)
+
+def adjustModifications(cdmlRoot, errors=None):
+	"""Add the modification residues and states of proteins from the StateVariable of their notes."""
+	
+	loadEtree()
 	
 	##### Adjust modifications
 	# - For proteins only, depending on what is in the species notes, 
@@ -455,156 +779,125 @@ def main(argv):
 	modifsDict = {'P': 'phosphorylated',
 					'AC': 'acetylated',
 					'UB': 'ubiquitinated' }
-	for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species"):
-	
-		# Complex or protein ?
-		# Cannot do it in the findall() above, because it implies two namespaces?!
-		cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
-		if cdmlClass is None or cdmlClass.text != 'PROTEIN':
-			continue
-		#print cdmlSpecies.attrib.get('id')
+	# Residue registry of each protein, by id
+	registries = {}
+	for cdmlSpecies in lookup('species', cdmlRoot):
+		with collecting(errors, "adjustModifications", cdmlSpecies):
 		
-		# Extract the notes
-		notesElement = cdmlSpecies.find(".//{http://www.sbml.org/sbml/level2/version4}notes")
-		if notesElement is None:
-			continue
-		
-		# Extract note text
-		notesText = "".join([x for x in notesElement.itertext()]).strip()
-		#print(notesText)
-		
-		# Create containers for the positions and numbers of modifications
-		modifs_pos = list()
-		modifs_nb = list()
-		
-		# Find PTM information in notes "StateVariable:" but not if saying "(in)active" or opened/closed
-		# Try to find StateVariable:... in the notes. Matches are returned in the order that they are found in the text.
-		for match in re.finditer("StateVariable:([\S@]+)", notesText):
-			matchedState = match.group(1)
+			# Complex or protein ?
+			# Cannot do it in the findall() above, because it implies two namespaces?!
+			cdmlClass = lookupFirst('speciesClass', cdmlSpecies)
+			if cdmlClass is None or cdmlClass.text != 'PROTEIN':
+				continue
+			#print cdmlSpecies.attrib.get('id')
 			
-			# Not interested in active/inactive state
-			if matchedState.endswith("active"):
+			# Extract the notes
+			notesElement = lookupFirst('notes', cdmlSpecies)
+			if notesElement is None:
 				continue
+			
+			# Extract note text
+			notesText = "".join([x for x in notesElement.itertext()]).strip()
+			#print(notesText)
+			
+			# Create containers for the positions and numbers of modifications
+			modifs_pos = list()
+			modifs_nb = list()
+			
+			# Find PTM information in notes "StateVariable:" but not if saying "(in)active" or opened/closed
+			# Try to find StateVariable:... in the notes. Matches are returned in the order that they are found in the text.
+			for match in re.finditer("StateVariable:([\S@]+)", notesText):
+				matchedState = match.group(1)
+				
+				# Not interested in active/inactive state
+				if matchedState.endswith("active"):
+					continue
 
-			# Not interested in open state
-			if re.match("opened", matchedState) or re.match("closed", matchedState):
+				# Not interested in open state
+				if re.match("opened", matchedState) or re.match("closed", matchedState):
+					continue
+				#print(matchedState)
+				
+				# Notes similar to P@340 or p@341 or UB@63 (most of cases) or P@TYR15 (dectin2)
+				if re.match("[\w]{1,2}@[\w\d]+", matchedState):
+					# Store element: (modif, position)
+					for matchpos in re.finditer("([\w]{1,2})@([\w\d]+)", matchedState):
+						modifs_pos.append((matchpos.group(1).upper(), str(matchpos.group(2))))
+				else:
+					# Notes similar to 2P or 4p
+					if re.match("[\d]{1,2}[\w]+", matchedState):
+						# Store element: (modif, number)
+						for matchpos in re.finditer("([\d]{1,2})([\w]+)", matchedState):
+							modifs_nb.append((matchpos.group(2).upper(), int(matchpos.group(1))))
+					# Notes similar to AC, Ac or ac
+					else:
+						# Store element: (modif, 1)
+						modifs_nb.append((matchedState.upper(), 1))
+			
+			# Check that we indeed got modifications (otherwise it's no use adding supplementary empty elements)
+			if len(modifs_nb)==0 and len(modifs_pos)==0:
 				continue
-			#print(matchedState)
+
+			# With the modifications found, create new elements, first in protein element; then in species
+			#print(modifs_pos)
+			#print(modifs_nb)
+			
+			# Get the protein reference to modify
+			cdmlProtRef = lookupRequired('proteinReference', cdmlSpecies).text			
+			# Residues of the protein, shared by all its species
+			if cdmlProtRef not in registries:
+				registries[cdmlProtRef] = ResidueRegistry(lookupRequired('protein', cdmlRoot, id=cdmlProtRef))
+			residues = registries[cdmlProtRef]
 			
-			# Notes similar to P@340 or p@341 or UB@63 (most of cases) or P@TYR15 (dectin2)
-			if re.match("[\w]{1,2}@[\w\d]+", matchedState):
-				# Store element: (modif, position)
-				for matchpos in re.finditer("([\w]{1,2})@([\w\d]+)", matchedState):
-					modifs_pos.append((matchpos.group(1).upper(), str(matchpos.group(2))))
+			# For species element speciesIdentity
+			# Find the 'state' element
+			cdmlSpeState = lookupFirst('state', cdmlSpecies)
+			# If none, add one
+			if cdmlSpeState is None:
+				cdmlSpeState = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'state'))
+				cdmlClass.getparent().append(cdmlSpeState)
+			# Find the list of modifications
+			cdmlSpeListModifs = lookupFirst('listOfModifications', cdmlSpeState)
+			# If no list of modifs can be found, add one
+			if cdmlSpeListModifs is None:
+				cdmlSpeListModifs = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'listOfModifications'))
+				cdmlSpeState.append(cdmlSpeListModifs)
+			
+			# (residue id, state) of each modification of the species
+			speciesModifs = []
+			if len(modifs_nb)!=0:
+				# Example: [('P', 2), ('AC', 1)]
+				for (modifType, modifNb) in modifs_nb:
+					state = modifsDict[modifType]
+					# Positions of this type, e.g. [338, 341] for 'P' in [('P', 338), ('AC', 12), ('P', 341)]:
+					# the first modifications of the type are on these named residues, the others unnamed
+					positions = [ position for (posType, position) in modifs_pos if posType == modifType ]
+					for rank in range(modifNb):
+						if rank < len(positions):
+							speciesModifs.append((residues.namedResidue(modifType+"@"+positions[rank]), state))
+						else:
+							speciesModifs.append((residues.unnamedResidue(state, rank-len(positions)), state))
+			
+			# Case where only the modification position was defined
+			# i.e only the [('P', 338), ('P', 340), ('P', 341)] array was filled 
+			#  (even if it's not supposed to be, there are cases...)
 			else:
-				# Notes similar to 2P or 4p
-				if re.match("[\d]{1,2}[\w]+", matchedState):
-					# Store element: (modif, number)
-					for matchpos in re.finditer("([\d]{1,2})([\w]+)", matchedState):
-						modifs_nb.append((matchpos.group(2).upper(), int(matchpos.group(1))))
-				# Notes similar to AC, Ac or ac
-				else:
-					# Store element: (modif, 1)
-					modifs_nb.append((matchedState.upper(), 1))
-		
-		# Check that we indeed got modifications (otherwise it's no use adding supplementary empty elements)
-		if len(modifs_nb)==0 and len(modifs_pos)==0:
-			continue
-
-		# With the modifications found, create new elements, first in protein element; then in species
-		#print(modifs_pos)
-		#print(modifs_nb)
-		
-		# Get the protein reference to modify
-		cdmlProtRef = cdmlSpecies.find(".//*/celldesigner:proteinReference", namespaces).text			
-		# Find corresponding protein element
-		cdmlProtElmt = cdmlRoot.find(".//*/celldesigner:protein[@id='"+cdmlProtRef+"']", namespaces)
-		# Check if it has a list of modifications
-		cdmlProtListModifs = cdmlProtElmt.find(".//*/celldesigner:listOfModificationResidues", namespaces)
-		# If no list of modifs can be found, add one
-		if cdmlProtListModifs is None:
-			cdmlProtListModifs = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'listOfModificationResidues'))
-			cdmlProtElmt.append(cdmlProtListModifs)
-		
-		# For species element speciesIdentity
-		# Find the 'state' element
-		cdmlSpeState = cdmlSpecies.find(".//*/celldesigner:state", namespaces)
-		# If none, add one
-		if cdmlSpeState is None:
-			cdmlSpeState = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'state'))
-			cdmlClass.getparent().append(cdmlSpeState)
-		# Find the list of modifications
-		cdmlSpeListModifs = cdmlSpeState.find(".//*/celldesigner:listOfModifications", namespaces)
-		# If no list of modifs can be found, add one
-		if cdmlSpeListModifs is None:
-			cdmlSpeListModifs = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'listOfModifications'))
-			cdmlSpeState.append(cdmlSpeListModifs)
-		
-		modifIndex = 1
-		if len(modifs_nb)!=0:
-			# Example: [('P', 2), ('AC', 1)]
-			for aModifType in modifs_nb:
-			
-				modifPosIdx = 0
-			
-				# Will loop twice for 'P', once for 'AC', etc.
-				for aModifNb in range(aModifType[1]):
-					# Append to protein
-					cdmlProtNewModif = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'modificationResidue'))
-					cdmlProtNewModif.set('angle', str(modifIndex*0.5))
-					cdmlProtNewModif.set('id', "rs"+str(modifIndex))
-					cdmlProtNewModif.set('side', 'none')
-					# Example of content of modifs_pos: [('P', 338), ('P', 340), ('P', 341)]
-					# Here, we're looking for the next tuple in modifs_pos such as (aModifType[0], any_number)
-					# i.e corresponding to the same modification type as current
-					# Then adjust the name of the added modification
-					# Increase index to look at the next one during next iteration
-					while modifPosIdx < len(modifs_pos):
-						if modifs_pos[modifPosIdx][0]==aModifType[0]:
-							cdmlProtNewModif.set('name', aModifType[0]+"@"+str(modifs_pos[modifPosIdx][1]))
-							modifPosIdx+=1
-							break
-						modifPosIdx+=1
-					# Append element to parent
-					cdmlProtListModifs.append(cdmlProtNewModif)
-				
-					# Append to species
-					cdmlSpeNewModif = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'modification'))
-					cdmlSpeNewModif.set('residue', "rs"+str(modifIndex))
-					cdmlSpeNewModif.set('state', modifsDict[aModifType[0]])
-					# Append element to parent
-					cdmlSpeListModifs.append(cdmlSpeNewModif)
-				
-					# Increase index
-					modifIndex+=1
-		
-		# Case where only the modification position was defined
-		# i.e only the [('P', 338), ('P', 340), ('P', 341)] array was filled 
-		#  (even if it's not supposed to be, there are cases...)
-		else:
-			for modifPosIdx in range(len(modifs_pos)):
-				# Append to protein
-				cdmlProtNewModif = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'modificationResidue'))
-				cdmlProtNewModif.set('angle', str(modifIndex*0.5))
-				cdmlProtNewModif.set('id', "rs"+str(modifIndex))
-				cdmlProtNewModif.set('side', 'none')
-				cdmlProtNewModif.set('name', modifs_pos[modifPosIdx][0]+"@"+str(modifs_pos[modifPosIdx][1]))
-				# Append element to parent
-				cdmlProtListModifs.append(cdmlProtNewModif)
-				
-				# Append to species
+				for (modifType, position) in modifs_pos:
+					speciesModifs.append((residues.namedResidue(modifType+"@"+position), modifsDict[modifType]))
+			
+			# Append to species
+			for (residueId, state) in speciesModifs:
 				cdmlSpeNewModif = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'modification'))
-				cdmlSpeNewModif.set('residue', "rs"+str(modifIndex))
-				cdmlSpeNewModif.set('state', modifsDict[modifs_pos[modifPosIdx][0]])
-				# Append element to parent
+				cdmlSpeNewModif.set('residue', residueId)
+				cdmlSpeNewModif.set('state', state)
 				cdmlSpeListModifs.append(cdmlSpeNewModif)
-
-				# Increase index
-				modifIndex+=1
 		
+	# Write the residues of the modified proteins
+	for residues in registries.values():
+		residues.write()
 
-	##### Adjust complex elements
-	
+def adjustReactions(cdmlRoot, errors=None):
+	"""Set the type of transcriptions and of reaction modifiers."""
 	
 	#####
 	# Adjust reactions
@@ -612,10 +905,11 @@ def main(argv):
 	##### Adjust transcription reaction to correct reaction type
 	# Only interested in transcription reactions, tagged with SBO term 183
 	# Just need to adjust reaction type and set it to TRANSCRIPTION
-	for cdmlReaction in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}reaction[@sboTerm='SBO:0000183']"):
-		
-		reacType = cdmlReaction.find(".//celldesigner:reactionType", namespaces)
-		reacType.text = "TRANSCRIPTION"
+	for cdmlReaction in lookup('transcriptions', cdmlRoot):
+		with collecting(errors, "adjustReactions", cdmlReaction):
+			
+			reacType = lookupRequired('reactionType', cdmlReaction)
+			reacType.text = "TRANSCRIPTION"
 
 	##### In reactions, adjust modifiers to the correct type using SBO terms
 	#   BCML 					SBML 					SBO term
@@ -643,17 +937,43 @@ def main(argv):
 					'SBO:0000459': 'PHYSICAL_STIMULATION',
 					'SBO:0000461': 'TRIGGER'
 					}
-	for cdmlReaction in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}reaction"):
-		
-		for cdmlModifier in cdmlReaction.findall(".//{http://www.sbml.org/sbml/level2/version4}modifierSpeciesReference"):
-			# For each reaction, loop through all modifiers
-			# adjust corresponding modification
-			cdmlModification = cdmlReaction.find(".//celldesigner:modification", namespaces)
-			cdmlModification.set('type', modifierDict[cdmlModifier.attrib.get('sboTerm')])
-	
-
-
+	# Each modifier is paired with the modification drawn for its alias (or, failing that,
+	# for its species), so that every modification of a reaction gets its own type
+	for cdmlReaction in cdmlRoot.iter("{http://www.sbml.org/sbml/level2/version4}reaction"):
+		with collecting(errors, "adjustReactions", cdmlReaction):
+			
+			# Modifications of the reaction, by alias and by species
+			# (both attributes are comma-separated lists for modifiers combined by logic gates)
+			modificationsByAlias = {}
+			modificationsBySpecies = {}
+			for cdmlModification in lookup('reactionModifications', cdmlReaction):
+				for alias in cdmlModification.attrib.get('aliases', '').split(','):
+					modificationsByAlias.setdefault(alias, []).append(cdmlModification)
+				for species in cdmlModification.attrib.get('modifiers', '').split(','):
+					modificationsBySpecies.setdefault(species, []).append(cdmlModification)
+			
+			pairedModifications = set()
+			for cdmlModifier in lookup('modifiers', cdmlReaction):
+				modificationType = modifierDict.get(cdmlModifier.attrib.get('sboTerm'))
+				if modificationType is None:
+					continue
+				cdmlAlias = lookupFirst('modifierAlias', cdmlModifier)
+				alias = None if cdmlAlias is None else (cdmlAlias.text or '')
+				candidates = modificationsByAlias.get(alias, [])
+				if len(candidates) == 0:
+					candidates = modificationsBySpecies.get(cdmlModifier.attrib.get('species'), [])
+				# The same species can modify a reaction twice: first modification not yet paired
+				for cdmlModification in candidates:
+					if cdmlModification not in pairedModifications:
+						pairedModifications.add(cdmlModification)
+						cdmlModification.set('type', modificationType)
+						break
 
+def mergeDuplicatedSpecies(cdmlRoot, errors=None):
+	"""Merge the proteins of species that only differ by their state."""
+	
+	loadEtree()
+	
 	##### Merge duplicated species
 
 	# Find all species representing the same species (same name, different id) but in different states
@@ -675,289 +995,367 @@ def main(argv):
 	
 	# Build a dictionary with all species (proteins), and counts
 	speciesDict = {}
-	for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species"):
-	
-		# Complex or protein ?
-		# Cannot do it in the findall() above, because it implies two namespaces?!
-		cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
-		if cdmlClass is None or cdmlClass.text != 'PROTEIN':
-			continue
-		# Get name of the species
-		currentName = cdmlSpecies.attrib.get('name')
-		# Check if it already exists in the dictionary
-		if not speciesDict.has_key(currentName):
-			speciesDict[currentName] = 0
-		# Increment count for that name
-		speciesDict[currentName] = speciesDict[currentName]+1
-	
-	#print(str(speciesDict))
-
-	# Loop through all species+count
-	for (spName,spNumber) in speciesDict.iteritems():
-		#print(spName+"  "+str(spNumber))
+	for cdmlSpecies in lookup('species', cdmlRoot):
+		with collecting(errors, "mergeDuplicatedSpecies", cdmlSpecies):
 		
-		# If we have no duplicated elements, skip
-		if spNumber == 1:
-			#print("\tOK!")
-			continue
-
-		# For all species with more than one count
-		# Find reference protein, and count number of modifications
-		protDict = {}
-		for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species[@name='"+spName+"']"):
-		
-			# Protein ?
+			# Complex or protein ?
 			# Cannot do it in the findall() above, because it implies two namespaces?!
-			cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
+			cdmlClass = lookupFirst('speciesClass', cdmlSpecies)
 			if cdmlClass is None or cdmlClass.text != 'PROTEIN':
 				continue
-
-			protReference = cdmlSpecies.find(".//*/celldesigner:proteinReference", namespaces)
-			modifsOfRefProtein = cdmlRoot.findall(".//*/celldesigner:protein[@id='"+protReference.text+"']/*/celldesigner:modificationResidue", namespaces)
-			protDict[protReference.text] = len(modifsOfRefProtein)
+			# Get name of the species
+			currentName = cdmlSpecies.attrib.get('name')
+			# Increment count for that name
+			speciesDict[currentName] = speciesDict.get(currentName, 0)+1
 		
-		#print("\tNb of modifications: "+str(protDict))
-		maxModifs = max(protDict.values())
-		protsWithMaxModifs = [ key for key in protDict.keys() if protDict[key] == maxModifs]
-		#print("\tProts with max values: "+str(protsWithMaxModifs))
-		
-		# Easy cases (and most common, luckily): 
-		# - multiple species with no modifications: just take any protein reference (the first one)
-		# - only one protein reference had one modification, update all to reference this one
-		if maxModifs == 0 or (maxModifs == 1 and len(protsWithMaxModifs) == 1):
-		
-			protWithMaxModifs = protsWithMaxModifs[0]
-			
-			# Change all species to point to this protein reference, and delete other protein references
-			for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species[@name='"+spName+"']"):
-		
-				# Protein ?
-				# Cannot do it in the findall() above, because it implies two namespaces?!
-				cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
-				if cdmlClass is None or cdmlClass.text != 'PROTEIN':
-					continue
-				
-				# Get protein reference
-				protReference = cdmlSpecies.find(".//*/celldesigner:proteinReference", namespaces)
-				# Skip this loop if reference is already correct		
-				if protReference.text == protWithMaxModifs:
-					continue
-					
-				#print("\tUpdate "+cdmlSpecies.attrib.get('id')+" and delete "+protReference.text)
-				
-				# Delete old protein reference entity
-				cdmlRefProt = cdmlRoot.find(".//*/celldesigner:protein[@id='"+protReference.text+"']", namespaces)
-				cdmlRefParent = cdmlRefProt.getparent()
-				cdmlRefParent.remove(cdmlRefProt)
-				
-				# Update reference in species
-				protReference.text = protWithMaxModifs
-				
-			#print("\tOK!")
+	#print(str(speciesDict))
 
-				
-		# More complex case: gather all modifications into one reference protein
-		#
- 		#			<celldesigner:protein id="pr98" name="NF-kBp65" type="GENERIC">
- 		#				<celldesigner:listOfModificationResidues>
- 		#					<celldesigner:modificationResidue angle="0.5" id="rs1" side="none" name="P@536"/>
- 		#					<celldesigner:modificationResidue angle="1.0" id="rs2" side="none" name="P@276"/>
- 		#					<celldesigner:modificationResidue angle="1.5" id="rs3" side="none"/>
- 		#				</celldesigner:listOfModificationResidues>
- 		#			</celldesigner:protein>
-		#	
- 		#				<celldesigner:speciesIdentity>
- 		#					<celldesigner:class>PROTEIN</celldesigner:class>
- 		#					<celldesigner:proteinReference>pr98</celldesigner:proteinReference>
- 		#					<celldesigner:state>
- 		#						<celldesigner:listOfModifications>
- 		#							<celldesigner:modification residue="rs1" state="phosphorylated"/>
- 		#							<celldesigner:modification residue="rs2" state="phosphorylated"/>
- 		#							<celldesigner:modification residue="rs3" state="acetylated"/>
- 		#						</celldesigner:listOfModifications>
- 		#					</celldesigner:state>
- 		#				</celldesigner:speciesIdentity>
-		else:
-			
-			modifsList = {}
-			# Not all modifications will have an associated name. Need to keep track to how many max unnamed modifications there are. 
-			maxUnnamedModifs = {}
-			
-			# Go through all proteins and list all modifications found
-			for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species[@name='"+spName+"']"):
+	# Loop through all species+count
+	for (spName,spNumber) in sorted(speciesDict.items()):
+		with collecting(errors, "mergeDuplicatedSpecies", spName):
+			#print(spName+"  "+str(spNumber))
+			
+			# If we have no duplicated elements, skip
+			if spNumber == 1:
+				#print("\tOK!")
+				continue
 
+			# For all species with more than one count
+			# Find reference protein, and count number of modifications
+			protDict = {}
+			for cdmlSpecies in lookup('speciesByName', cdmlRoot, name=spName):
+			
 				# Protein ?
 				# Cannot do it in the findall() above, because it implies two namespaces?!
-				cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
+				cdmlClass = lookupFirst('speciesClass', cdmlSpecies)
 				if cdmlClass is None or cdmlClass.text != 'PROTEIN':
 					continue
+
+				protReference = lookupRequired('proteinReference', cdmlSpecies)
+				modifsOfRefProtein = lookup('proteinResidues', cdmlRoot, id=protReference.text)
+				protDict[protReference.text] = len(modifsOfRefProtein)
+			
+			#print("\tNb of modifications: "+str(protDict))
+			maxModifs = max(protDict.values())
+			# Smallest id first, so that the kept reference doesn't depend on the order of the file
+			protsWithMaxModifs = sorted([ key for key in protDict if protDict[key] == maxModifs], key=naturalKey)
+			#print("\tProts with max values: "+str(protsWithMaxModifs))
+			
+			# Easy cases (and most common, luckily): 
+			# - multiple species with no modifications: just take any protein reference (the first one)
+			# - only one protein reference had one modification, update all to reference this one
+			if maxModifs == 0 or (maxModifs == 1 and len(protsWithMaxModifs) == 1):
+			
+				protWithMaxModifs = protsWithMaxModifs[0]
 				
-				# Get protein reference in species entity
-				protReference = cdmlSpecies.find(".//*/celldesigner:proteinReference", namespaces)
-				# Get list of modifications in species entity
-				modifications = cdmlSpecies.findall(".//*/celldesigner:modification", namespaces)
-				
-				unnamedModifsCount = {}
-				
-				for modifInSpecies in modifications:
+				# Change all species to point to this protein reference, and delete other protein references
+				for cdmlSpecies in lookup('speciesByName', cdmlRoot, name=spName):
+			
+					# Protein ?
+					# Cannot do it in the findall() above, because it implies two namespaces?!
+					cdmlClass = lookupFirst('speciesClass', cdmlSpecies)
+					if cdmlClass is None or cdmlClass.text != 'PROTEIN':
+						continue
 					
-					# Get modification in protein entity
-					modifInRefProtein = cdmlRoot.find(".//*/celldesigner:protein[@id='"+protReference.text+"']/*/celldesigner:modificationResidue[@id='"+modifInSpecies.attrib.get('residue')+"']", namespaces)
+					# Get protein reference
+					protReference = lookupRequired('proteinReference', cdmlSpecies)
+					# Skip this loop if reference is already correct		
+					if protReference.text == protWithMaxModifs:
+						continue
+						
+					#print("\tUpdate "+cdmlSpecies.attrib.get('id')+" and delete "+protReference.text)
 					
-					#residue = modifInSpecies.attrib.get('residue')
-					state = modifInSpecies.attrib.get('state')
-					name = modifInRefProtein.attrib.get('name')
-					#print("State: "+state+" name: "+str(name))
+					# Delete old protein reference entity
+					cdmlRefProt = lookupRequired('protein', cdmlRoot, id=protReference.text)
+					cdmlRefParent = cdmlRefProt.getparent()
+					cdmlRefParent.remove(cdmlRefProt)
 					
-					# If modification doesn't have a name, add it to the unnamed counter
-					if name is None:
-						if unnamedModifsCount.has_key(state):
-							unnamedModifsCount[state] += 1
-						else:
-							unnamedModifsCount[state] = 1
-					# If it has a name, just list it
-					else:
-						modifsList[name] = state
+					# Update reference in species
+					protReference.text = protWithMaxModifs
 					
-					#print("Updated unnamedModifsCount: "+str(unnamedModifsCount.items()))
-					#print("Updated modifsList: "+str(modifsList.items()))
-			
-				# Store max count of each unnamed modification type
-				for (modifState,modifCount) in unnamedModifsCount.iteritems():
-					if not maxUnnamedModifs.has_key(modifState):
-						maxUnnamedModifs[modifState] = modifCount
-					else:
-						if maxUnnamedModifs[modifState] < modifCount:
-							maxUnnamedModifs[modifState] = modifCount
-			
-			# We now have a counter of all unnamed modifications
-			maxUnnamedModifs = maxUnnamedModifs.items()
-			#print(maxUnnamedModifs)
-			# And a list of named ones
-			modifsList = modifsList.items()
-			#print(modifsList)
-			# Now we need to create one protein having all modifications 
-			# and change the residue/id of all modifications for the corresponding species
-			
-			# Total unnamed modifications
-			totalCountUnnamedModifs = 0
-			for (modifState,counter) in maxUnnamedModifs: totalCountUnnamedModifs+=counter
-			
-			# Get one protein name, to become our new reference protein
-			newRefProtElement = protsWithMaxModifs[0]
-			
-			# Change the reference protein and residue/id of all modifications for the corresponding species
-			# Go through all proteins and list all modifications found
-			for cdmlSpecies in cdmlRoot.findall(".//{http://www.sbml.org/sbml/level2/version4}species[@name='"+spName+"']"):
+				#print("\tOK!")
 
-				# Protein ?
-				# Cannot do it in the findall() above, because it implies two namespaces?!
-				cdmlClass = cdmlSpecies.find(".//*/celldesigner:class", namespaces)
-				if cdmlClass is None or cdmlClass.text != 'PROTEIN':
-					continue
+					
+			# More complex case: gather all modifications into one reference protein
+			#
+	 		#			<celldesigner:protein id="pr98" name="NF-kBp65" type="GENERIC">
+	 		#				<celldesigner:listOfModificationResidues>
+	 		#					<celldesigner:modificationResidue angle="0.5" id="rs1" side="none" name="P@536"/>
+	 		#					<celldesigner:modificationResidue angle="1.0" id="rs2" side="none" name="P@276"/>
+	 		#					<celldesigner:modificationResidue angle="1.5" id="rs3" side="none"/>
+	 		#				</celldesigner:listOfModificationResidues>
+	 		#			</celldesigner:protein>
+			#	
+	 		#				<celldesigner:speciesIdentity>
+	 		#					<celldesigner:class>PROTEIN</celldesigner:class>
+	 		#					<celldesigner:proteinReference>pr98</celldesigner:proteinReference>
+	 		#					<celldesigner:state>
+	 		#						<celldesigner:listOfModifications>
+	 		#							<celldesigner:modification residue="rs1" state="phosphorylated"/>
+	 		#							<celldesigner:modification residue="rs2" state="phosphorylated"/>
+	 		#							<celldesigner:modification residue="rs3" state="acetylated"/>
+	 		#						</celldesigner:listOfModifications>
+	 		#					</celldesigner:state>
+	 		#				</celldesigner:speciesIdentity>
+			else:
 				
-				# Change protein reference in species entity (but remember old value)
-				protReference = cdmlSpecies.find(".//*/celldesigner:proteinReference", namespaces)
-				# Cannot do the modifications on the fly or the file will be screwed up!
+				# Residues of the current reference proteins, to find the name of the residue of each modification
+				oldRegistries = {}
+				# Not all modifications will have an associated name. Need to keep track to how many max unnamed modifications
+				# there are, for each state (states and names in the order they are found)
+				maxUnnamedModifs = {}
+				unnamedStates = []
+				modifNames = []
+				seenNames = set()
+				
+				# Go through all proteins and list all modifications found
+				proteinSpecies = []
+				for cdmlSpecies in lookup('speciesByName', cdmlRoot, name=spName):
 
+					# Protein ?
+					# Cannot do it in the findall() above, because it implies two namespaces?!
+					cdmlClass = lookupFirst('speciesClass', cdmlSpecies)
+					if cdmlClass is None or cdmlClass.text != 'PROTEIN':
+						continue
+					
+					# Get protein reference in species entity
+					protReference = lookupRequired('proteinReference', cdmlSpecies)
+					if protReference.text not in oldRegistries:
+						oldRegistries[protReference.text] = ResidueRegistry(lookupRequired('protein', cdmlRoot, id=protReference.text))
+					proteinSpecies.append((cdmlSpecies, protReference, oldRegistries[protReference.text]))
 					
-				# Get list of modifications in species entity
-				modifications = cdmlSpecies.findall(".//*/celldesigner:modification", namespaces)
+					unnamedModifsCount = {}
+					for modifInSpecies in lookup('modifications', cdmlSpecies):
+						state = modifInSpecies.attrib.get('state')
+						name = oldRegistries[protReference.text].name(modifInSpecies.attrib.get('residue'))
+						# If modification doesn't have a name, add it to the unnamed counter
+						if name is None:
+							unnamedModifsCount[state] = unnamedModifsCount.get(state, 0)+1
+							if state not in maxUnnamedModifs:
+								maxUnnamedModifs[state] = 0
+								unnamedStates.append(state)
+							maxUnnamedModifs[state] = max(maxUnnamedModifs[state], unnamedModifsCount[state])
+						# If it has a name, just list it
+						elif name not in seenNames:
+							seenNames.add(name)
+							modifNames.append(name)
 				
-				# Keep track of how many unnamed have been used for each modif type, for each species
-				currentUsedModifs = {}
+				# Get one protein name, to become our new reference protein
+				newRefProtElement = protsWithMaxModifs[0]
 				
-				# Only need to change the species as the proteins will be deleted, and it would anyway screw up the references
-				for modifInSpecies in modifications:
+				# Its residues are all the modifications found: unnamed ones first, then named ones
+				newResidues = ResidueRegistry(lookupRequired('protein', cdmlRoot, id=newRefProtElement))
+				newResidues.clear()
+				for state in unnamedStates:
+					for rank in range(maxUnnamedModifs[state]):
+						newResidues.unnamedResidue(state, rank)
+				for name in modifNames:
+					newResidues.namedResidue(name)
+				
+				# Change the reference protein and residue/id of all modifications for the corresponding species
+				for (cdmlSpecies, protReference, oldResidues) in proteinSpecies:
 					
-					# Get modification in protein entity
-					modifInRefProtein = cdmlRoot.find(".//*/celldesigner:protein[@id='"+protReference.text+"']/*/celldesigner:modificationResidue[@id='"+modifInSpecies.attrib.get('residue')+"']", namespaces)
+					# Keep track of how many unnamed have been used for each modif type, for each species
+					currentUsedModifs = {}
+					for modifInSpecies in lookup('modifications', cdmlSpecies):
+						state = modifInSpecies.attrib.get('state')
+						name = oldResidues.name(modifInSpecies.attrib.get('residue'))
+						if name is None:
+							rank = currentUsedModifs.get(state, 0)
+							currentUsedModifs[state] = rank+1
+							modifInSpecies.set('residue', newResidues.unnamedResidue(state, rank))
+						else:
+							modifInSpecies.set('residue', newResidues.namedResidue(name))
 					
-					#residue = modifInSpecies.attrib.get('residue')
-					state = modifInSpecies.attrib.get('state')
-					name = modifInRefProtein.attrib.get('name')
+					# Delete referenced protein if it's not the newly chosen common reference
+					if not (protReference.text == newRefProtElement):
+						oldRefProtein = lookupFirst('protein', cdmlRoot, id=protReference.text)
+						if oldRefProtein is not None:
+							oldRefProtein.getparent().remove(oldRefProtein)
 					
-					# Unnamed modif
-					if name is None:
-						indexUnnamedState = 0
-						maxCountUnnamedState = 0
-						for (modifState,counter) in maxUnnamedModifs:
-							if modifState == state: 
-								maxCountUnnamedState = counter
-								if currentUsedModifs.has_key(state):
-									currentUsedModifs[state] += 1
-								else:
-									currentUsedModifs[state] = 1
-								break
-							indexUnnamedState += counter
-						modifInSpecies.set('residue', 'rs'+str(indexUnnamedState+currentUsedModifs[state])) 
-						#print(protReference.text+" State "+state+", name "+str(name)+", new residue/id: "+'rs'+str(indexUnnamedState+currentUsedModifs[state]))
-					else:
-						currentPos = 0
-						for (aModifName,aModifState) in modifsList:
-							currentPos +=1
-							if aModifName == name and aModifState == state: 
-								break
-						modifInSpecies.set('residue', 'rs'+str(totalCountUnnamedModifs+currentPos)) 
-						#print(protReference.text+" State "+state+", name "+name+", new residue/id: "+'rs'+str(totalCountUnnamedModifs+currentPos))
-				
-				# Delete referenced protein if it's not the newly chosen common reference
-				if not (protReference.text == newRefProtElement):
-					oldRefProtein = cdmlRoot.find(".//*/celldesigner:protein[@id='"+protReference.text+"']", namespaces)
-					cdmlRefParent = oldRefProtein.getparent()
-					cdmlRefParent.remove(oldRefProtein)
+					# Finally update reference in species to newly chosen protein
+					protReference.text = newRefProtElement
 				
-				# Finally update reference in species to newly chosen protein
-				protReference.text = newRefProtElement
-								
-			# Update newly chosen protein so that it has all modifications
-			newRefProtein = cdmlRoot.find(".//*/celldesigner:protein[@id='"+newRefProtElement+"']", namespaces)
-			# Delete old list of modifs
-			oldListOfModifs = newRefProtein.find(".//*/celldesigner:listOfModificationResidues", namespaces)
-			if oldListOfModifs is not None:
-				newRefProtein.remove(oldListOfModifs)
-				# Add new list
-				newListOfModifs = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'listOfModificationResidues'))
-				newRefProtein.append(newListOfModifs)
-			
-				# Add all modifications to the newly chosen protein
-				modifIndex = 1
-				# Add unnamed modifications first
-				for (modifState,counter) in maxUnnamedModifs:
-					# Create new element
-					cdmlProtNewModif = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'modificationResidue'))
-					cdmlProtNewModif.set('angle', str(modifIndex*0.5))
-					cdmlProtNewModif.set('id', "rs"+str(modifIndex))
-					cdmlProtNewModif.set('side', 'none')
-					cdmlProtNewModif.set('name', modifs_pos[modifPosIdx][0]+"@"+str(modifs_pos[modifPosIdx][1]))
-					# Append element to parent
-					cdmlProtListModifs.append(cdmlProtNewModif)
-					modifIndex+=1
-				
-				# Do the same for named modifications, without resetting the index to 0
-				for (modifName,state) in modifsList:
-					# Create new element
-					cdmlProtNewModif = etree.Element('{%s}%s' % (namespaces['celldesigner'], 'modificationResidue'))
-					cdmlProtNewModif.set('angle', str(modifIndex*0.5))
-					cdmlProtNewModif.set('id', "rs"+str(modifIndex))
-					cdmlProtNewModif.set('side', 'none')
-					cdmlProtNewModif.set('name', modifName)
-					# Append element to parent
-					cdmlProtListModifs.append(cdmlProtNewModif)
-					modifIndex+=1
+				# Update newly chosen protein so that it has all modifications
+				newResidues.write()
 
-				
+def improveTree(cdmlTree, profiler=None, errors=None):
+	"""Run all the passes, in order, on a parsed CellDesigner document (lxml
+	ElementTree or root element). The document is changed in place and returned.
+	Elements that fail are skipped and recorded in 'errors' if given.
+	"""
 	
+	loadEtree()
+	cdmlRoot = cdmlTree.getroot() if hasattr(cdmlTree, 'getroot') else cdmlTree
+	
+	#####
+	# Adjust CellDesigner parameters
+	removeEditPoints(cdmlRoot)
+	if profiler is not None:
+		profiler.endStage("remove edit points")
+	
+	#####
+	# Adjust species types
+	speciesLists = SpeciesLists(cdmlRoot)
+	adjustRnaSpecies(cdmlRoot, speciesLists, errors)
+	if profiler is not None:
+		profiler.endStage("RNA species")
+	adjustGeneSpecies(cdmlRoot, speciesLists, errors)
+	if profiler is not None:
+		profiler.endStage("gene species")
+	adjustComplexSpecies(cdmlRoot, speciesLists, errors)
+	if profiler is not None:
+		profiler.endStage("complex species")
+	adjustSimpleChemicalSpecies(cdmlRoot, speciesLists, errors)
+	if profiler is not None:
+		profiler.endStage("simple chemical species")
+	
+	#####
+	# Adjust species parameters
+	adjustActivity(cdmlRoot, errors)
+	if profiler is not None:
+		profiler.endStage("activity")
+	adjustModifications(cdmlRoot, errors)
+	if profiler is not None:
+		profiler.endStage("modifications")
+	
+	#####
+	# Adjust reactions
+	adjustReactions(cdmlRoot, errors)
+	if profiler is not None:
+		profiler.endStage("reactions")
+	
+	mergeDuplicatedSpecies(cdmlRoot, errors)
+	if profiler is not None:
+		profiler.endStage("merge duplicated species")
+	
+	return cdmlTree
+
+def canonicalize(cdmlRoot):
+	"""Put a document in canonical form, so that equivalent files are identical byte for
+	byte once written with pretty_print: entries of the lists of canonical_order.canonicalLists sorted,
+	attributes sorted by name, whitespace-only text removed."""
+	# Listed first: sorting the children of an element while iterating would lose the walk
+	for element in list(cdmlRoot.iter()):
+		if element.text is not None and element.text.strip() == '':
+			element.text = None
+		if element.tail is not None and element.tail.strip() == '':
+			element.tail = None
+		if callable(element.tag):
+			# Comment or processing instruction
+			continue
+		attributes = sorted(element.attrib.items())
+		element.attrib.clear()
+		for (name, value) in attributes:
+			element.set(name, value)
+		sortKey = entryKey(element.tag, lambda child, name: '' if callable(child.tag) else child.get(name, ''))
+		if sortKey is not None:
+			element[:] = sorted(element, key=sortKey)
+
+def recordMetrics(metrics, cdmlRoot):
+	"""Count the species, reactions and modifiers of a document by SBO term."""
+	from metrics import sboLabel
+	for cdmlSpecies in cdmlRoot.iter("{http://www.sbml.org/sbml/level2/version4}species"):
+		metrics.inc('bcml_species_total', sbo=sboLabel(cdmlSpecies.get('sboTerm')))
+	for cdmlReaction in cdmlRoot.iter("{http://www.sbml.org/sbml/level2/version4}reaction"):
+		metrics.inc('bcml_reactions_total', sbo=sboLabel(cdmlReaction.get('sboTerm')))
+	for cdmlModifier in cdmlRoot.iter("{http://www.sbml.org/sbml/level2/version4}modifierSpeciesReference"):
+		metrics.inc('bcml_modifiers_total', sbo=sboLabel(cdmlModifier.get('sboTerm')))
+
+def improveFile(cdmlFile, outputfile, profiler=None, metrics=None, canonical=False, errors=None):
+	"""Improve one CellDesigner file and write the result to 'outputfile', in canonical
+	form if 'canonical' (see canonicalize). Successful files are counted in 'metrics'
+	if given (see metrics.py), elements that fail are recorded in 'errors' if given."""
+	
+	loadEtree()
+	
+	# Open CellDesigner XML file and parse
+	cdmlTree = etree.parse(cdmlFile)
+	if profiler is not None:
+		profiler.endStage("parse CellDesigner")
+	
+	improveTree(cdmlTree, profiler, errors)
+	if canonical:
+		canonicalize(cdmlTree.getroot())
 	
 	##### Print modified XML in file
 	
 	# Print SBML in file
-	outputdir = os.path.join(os.path.abspath(os.path.join(os.path.dirname(argv[1]), os.pardir)), "modified_CDML")
-	if not os.path.exists(outputdir):
-		os.makedirs(outputdir)
-	outputfile = os.path.join(outputdir, os.path.basename(argv[1]))
-	etree.ElementTree(cdmlRoot).write(outputfile, pretty_print=True, xml_declaration=True, encoding='utf-8')
+	outputdir = os.path.dirname(outputfile)
+	if outputdir != '' and not os.path.exists(outputdir):
+		try:
+			os.makedirs(outputdir)
+		except OSError:
+			# Created meanwhile by another process of a batch
+			if not os.path.isdir(outputdir):
+				raise
+	temporaryfile = temporaryPath(outputfile)
+	try:
+		with open(temporaryfile, 'wb') as outputHandle:
+			cdmlTree.write(outputHandle, pretty_print=True, xml_declaration=True, encoding='utf-8')
+			# On disk before the rename, and before a batch journals the file as completed
+			outputHandle.flush()
+			os.fsync(outputHandle.fileno())
+		os.replace(temporaryfile, outputfile)
+	except:
+		if os.path.exists(temporaryfile):
+			os.remove(temporaryfile)
+		raise
+	if profiler is not None:
+		profiler.endStage("write CellDesigner")
+	
+	if metrics is not None:
+		metrics.inc('bcml_files_processed_total')
+		metrics.inc('bcml_bytes_read_total', os.path.getsize(cdmlFile))
+		metrics.inc('bcml_bytes_written_total', os.path.getsize(outputfile))
+		recordMetrics(metrics, cdmlTree.getroot())
+
+def main(argv):
+	
+	args = parseArguments(argv)
+	
+	collector = None
+	if args.metrics is not None or args.metrics_port is not None:
+		import metrics
+		collector = metrics.Metrics('improve_cd_file')
+		if args.metrics_port is not None:
+			collector.serve(args.metrics_port)
+	
+	profiler = None
+	if args.memory_report is not None:
+		import memory_profile
+		profiler = memory_profile.MemoryProfiler()
+	
+	stages = profiler
+	if collector is not None:
+		stages = metrics.StageObservers([profiler, collector])
+	
+	errors = None
+	if args.error_report is not None:
+		import error_report
+		errors = error_report.ErrorReport(args.cdml)
+	
+	try:
+		improveFile(args.cdml, outputPath(args.cdml, args.output_dir), stages, collector, args.canonical, errors)
+	except (Exception, SystemExit) as error:
+		if collector is not None:
+			collector.fail(error)
+			if args.metrics is not None:
+				collector.write(args.metrics)
+		raise
+	
+	if profiler is not None:
+		profiler.write(args.memory_report)
+	if collector is not None and args.metrics is not None:
+		collector.write(args.metrics)
+	
+	if errors is not None:
+		error_report.writeReport(args.error_report, [errors.state()])
+		for line in errors.lines():
+			sys.stderr.write(line+"\n")
+		if len(errors.errors) != 0:
+			return 1
 	
 
 if __name__ == "__main__":
-	main(sys.argv)
+	sys.exit(main(sys.argv))
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+# In-silico knock-out / overexpression screen of a BCML map.
+#
+# Example of a command line :
+# python knockout_screen.py ../DC-ATLAS/BCML/TLR9.xml --pairs --processes 8
+#
+# Every Macromolecule of the map is knocked out (clamped OFF) and overexpressed (clamped ON),
+# alone or, with --pairs, together with each other single perturbation. The regulatory logic
+# is the one of boolean_network.py, read from the BCML file. The same random initial conditions
+# are simulated with and without each perturbation, and the effect on a species is the change
+# of the fraction of final states in which it is ON. In asynchronous mode, they also follow the
+# same random update order, so that effects don't depend on --chunk or --processes.
+#
+# Perturbations are simulated in chunks, each chunk as one batch of states (one block of
+# initial conditions per perturbation), over a process pool. Workers send their final states
+# back bit-packed.
+#
+# The result is a sparse (perturbations x species) effect matrix, stored in COO form in a
+# .npz file: 'rows', 'cols', 'data', 'shape', with 'perturbations' and 'species' as labels.
+
+
+# General
+import sys
+import os.path
+import argparse
+import itertools
+import multiprocessing
+
+# For BCML
+import xml.etree.ElementTree as ET
+
+# For the simulation
+import numpy
+
+from bcml_to_sbml import idfy
+from boolean_network import compileNetwork
+
+# Simulation set up once in each worker process
+workerNetwork = None
+workerInitialStates = None
+workerSettings = None
+
+def initWorker(bcmlFile, initialStates, settings):
+	global workerNetwork, workerInitialStates, workerSettings
+	workerNetwork = compileNetwork(ET.parse(bcmlFile).getroot())
+	workerInitialStates = initialStates
+	workerSettings = settings
+
+def simulateChunk(chunk):
+	"""Simulate a chunk of perturbations as one batch. 'chunk' is (index of its
+	first perturbation, list of perturbations), a perturbation being a list of
+	(node index, clamped value). Returns the index and the bit-packed final states.
+	"""
+	(chunkStart, perturbations) = chunk
+	nbSamples = workerInitialStates.shape[0]
+	nbNodes = workerInitialStates.shape[1]
+
+	states = numpy.tile(workerInitialStates, (len(perturbations), 1))
+	clampMask = numpy.zeros(states.shape, dtype=bool)
+	clampValues = numpy.zeros(states.shape, dtype=bool)
+	for (pertIdx, perturbation) in enumerate(perturbations):
+		rows = slice(pertIdx*nbSamples, (pertIdx+1)*nbSamples)
+		for (nodeIdx, value) in perturbation:
+			clampMask[rows, nodeIdx] = True
+			clampValues[rows, nodeIdx] = value
+
+	# Every perturbation follows the asynchronous update order of the reference run (same
+	# seed, drawn for one block of initial conditions): effects don't depend on the chunks
+	rng = numpy.random.RandomState(workerSettings['seed'])
+	(finalStates, isFixedPoint) = workerNetwork.simulate(states, workerSettings['steps'], workerSettings['mode'], rng, (clampMask, clampValues), nbSamples)
+	return (chunkStart, numpy.packbits(finalStates, axis=1))
+
+def listPerturbations(bcmlRoot, network, pairs):
+	"""Single perturbations of every Macromolecule, and all pairs of them on different species if 'pairs'."""
+	macromolecules = []
+	for bcmlMacromol in bcmlRoot.iter('Macromolecule'):
+		if bcmlMacromol.attrib.get('cloneref') is None:
+			nodeId = idfy(str(bcmlMacromol.attrib.get('ID')))
+			if nodeId in network.nodeIndex and nodeId not in macromolecules:
+				macromolecules.append(nodeId)
+
+	singles = []
+	for nodeId in macromolecules:
+		singles.append(((nodeId, False),))
+		singles.append(((nodeId, True),))
+
+	perturbations = list(singles)
+	if pairs:
+		for (first, second) in itertools.combinations(singles, 2):
+			if first[0][0] != second[0][0]:
+				perturbations.append(first+second)
+	return perturbations
+
+def perturbationLabel(perturbation):
+	return "+".join([ nodeId+(":OE" if value else ":KO") for (nodeId, value) in perturbation ])
+
+def screen(bcmlFile, pairs=False, samples=64, steps=50, mode='synchronous', seed=0, processes=None, chunkSize=16, threshold=0.0):
+	"""Run the screen. Returns (perturbation labels, species ids, rows, cols, data)
+	of the sparse effect matrix.
+	"""
+
+	bcmlRoot = ET.parse(bcmlFile).getroot()
+	network = compileNetwork(bcmlRoot)
+	perturbations = listPerturbations(bcmlRoot, network, pairs)
+	nbNodes = len(network.nodes)
+
+	# Same initial conditions for all perturbations
+	rng = numpy.random.RandomState(seed)
+	initialStates = network.randomStates(samples, rng)
+	settings = {'steps': steps, 'mode': mode, 'seed': seed}
+
+	# Reference run, without perturbation
+	(baseStates, isFixedPoint) = network.simulate(initialStates, steps, mode, numpy.random.RandomState(seed))
+	baseCounts = baseStates.sum(axis=0)
+
+	indexedPerturbations = [ [ (network.nodeIndex[nodeId], value) for (nodeId, value) in perturbation ] for perturbation in perturbations ]
+	chunks = [ (start, indexedPerturbations[start:start+chunkSize]) for start in range(0, len(indexedPerturbations), chunkSize) ]
+
+	if processes == 1:
+		initWorker(bcmlFile, initialStates, settings)
+		results = map(simulateChunk, chunks)
+		pool = None
+	else:
+		pool = multiprocessing.Pool(processes, initWorker, (bcmlFile, initialStates, settings))
+		results = pool.imap_unordered(simulateChunk, chunks)
+
+	rows = []
+	cols = []
+	data = []
+	for (chunkStart, packedStates) in results:
+		finalStates = numpy.unpackbits(packedStates, axis=1)[:, :nbNodes]
+		nbChunkPerturbations = finalStates.shape[0] // samples
+		counts = finalStates.reshape((nbChunkPerturbations, samples, nbNodes)).sum(axis=1)
+		effects = (counts - baseCounts) / float(samples)
+		for pertIdx in range(nbChunkPerturbations):
+			perturbation = indexedPerturbations[chunkStart+pertIdx]
+			changed = numpy.nonzero(numpy.abs(effects[pertIdx]) > threshold)[0]
+			# Perturbed species themselves are not effects
+			perturbedNodes = set(nodeIdx for (nodeIdx, value) in perturbation)
+			for nodeIdx in changed:
+				if nodeIdx in perturbedNodes:
+					continue
+				rows.append(chunkStart+pertIdx)
+				cols.append(nodeIdx)
+				data.append(effects[pertIdx, nodeIdx])
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+	labels = [ perturbationLabel(perturbation) for perturbation in perturbations ]
+	return (labels, network.nodes, numpy.array(rows, dtype=numpy.int32), numpy.array(cols, dtype=numpy.int32), numpy.array(data, dtype=numpy.float32))
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Knock-out / overexpression screen of a BCML map.")
+	parser.add_argument('bcml', help="BCML file to screen")
+	parser.add_argument('--pairs', action='store_true', help="also screen all pairs of perturbations")
+	parser.add_argument('--samples', type=int, default=64, help="number of random initial conditions (default: 64)")
+	parser.add_argument('--steps', type=int, default=50, help="number of updates (default: 50)")
+	parser.add_argument('--mode', choices=['synchronous', 'asynchronous'], default='synchronous', help="update scheme")
+	parser.add_argument('--seed', type=int, default=0, help="seed of the random generator (default: 0)")
+	parser.add_argument('--processes', type=int, default=None, help="number of worker processes (default: number of CPUs)")
+	parser.add_argument('--chunk', type=int, default=16, help="perturbations simulated together by a worker (default: 16)")
+	parser.add_argument('--threshold', type=float, default=0.0, help="minimum change of the ON fraction reported (default: 0)")
+	parser.add_argument('--output', default=None, help="output .npz file (default: <BCML file>_screen.npz)")
+	parser.add_argument('--tsv', default=None, help="also write the effects as a tab-separated file")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+
+	(labels, species, rows, cols, data) = screen(args.bcml, args.pairs, args.samples, args.steps, args.mode, args.seed, args.processes, args.chunk, args.threshold)
+
+	outputfile = args.output
+	if outputfile is None:
+		outputfile = os.path.splitext(args.bcml)[0]+"_screen.npz"
+	numpy.savez_compressed(outputfile, rows=rows, cols=cols, data=data, shape=numpy.array([len(labels), len(species)]),
+			perturbations=numpy.array(labels), species=numpy.array(species))
+
+	if args.tsv is not None:
+		with open(args.tsv, 'w') as tsvHandle:
+			tsvHandle.write("perturbation\tspecies\teffect\n")
+			for (row, col, value) in zip(rows, cols, data):
+				tsvHandle.write(labels[row]+"\t"+species[col]+"\t"+("%.3f" % value)+"\n")
+
+	print(str(len(labels))+" perturbations, "+str(len(species))+" species, "+str(len(data))+" effects written to "+outputfile)
+
+
+if __name__ == "__main__":
+	main(sys.argv)
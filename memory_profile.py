@@ -0,0 +1,96 @@
+# Per-stage memory accounting for bcml_to_sbml.py and improve_cd_file.py.
+#
+# At each stage boundary, a snapshot is taken of the Python heap (tracemalloc) and of the
+# process RSS. Growth is attributed to the stage that just ended, with the allocation sites
+# that grew the most. Memory allocated by C/C++ libraries (libsbml model, lxml tree) is not
+# seen by tracemalloc, only in the RSS: comparing both shows which side a stage grows.
+# The report is written as JSON.
+
+
+# General
+import os
+import json
+import time
+import resource
+import tracemalloc
+
+def currentRss():
+	"""Resident set size of this process, in kB."""
+	try:
+		with open('/proc/self/statm') as statmHandle:
+			residentPages = int(statmHandle.read().split()[1])
+		return residentPages*os.sysconf('SC_PAGE_SIZE')//1024
+	except (IOError, OSError, ValueError):
+		# Not Linux: only the peak is available
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def peakRss():
+	"""Peak resident set size of this process so far, in kB (Linux unit)."""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Allocations made by the profiling itself are left out
+profilerFilters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+
+class MemoryProfiler(object):
+	"""Collects memory snapshots at stage boundaries. Stages are consecutive:
+	endStage(name) closes the stage that started at the previous boundary.
+	"""
+
+	def __init__(self, nbFrames=1, nbTopSites=10):
+		self.nbTopSites = nbTopSites
+		self.stages = []
+		tracemalloc.start(nbFrames)
+		self.startTime = time.time()
+		self.lastTime = self.startTime
+		self.lastSnapshot = tracemalloc.take_snapshot().filter_traces(profilerFilters)
+		self.lastTraced = tracemalloc.get_traced_memory()[0]
+		self.startRss = currentRss()
+		self.lastRss = self.startRss
+
+	def endStage(self, name):
+		now = time.time()
+		snapshot = tracemalloc.take_snapshot().filter_traces(profilerFilters)
+		(tracedCurrent, tracedPeak) = tracemalloc.get_traced_memory()
+		rss = currentRss()
+
+		topSites = []
+		for statDiff in snapshot.compare_to(self.lastSnapshot, 'lineno')[:self.nbTopSites]:
+			if statDiff.size_diff == 0:
+				continue
+			frame = statDiff.traceback[0]
+			topSites.append({'site': frame.filename+":"+str(frame.lineno),
+							'size_diff_kb': statDiff.size_diff//1024,
+							'count_diff': statDiff.count_diff})
+
+		self.stages.append({'stage': name,
+							'duration': now-self.lastTime,
+							'traced_kb': tracedCurrent//1024,
+							'traced_growth_kb': (tracedCurrent-self.lastTraced)//1024,
+							'traced_peak_kb': tracedPeak//1024,
+							'rss_kb': rss,
+							'rss_growth_kb': rss-self.lastRss,
+							'rss_peak_kb': peakRss(),
+							'top_allocations': topSites})
+
+		# Peak of the next stage only
+		if hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+		self.lastTime = now
+		self.lastSnapshot = snapshot
+		self.lastTraced = tracedCurrent
+		self.lastRss = rss
+
+	def report(self):
+		return {'stages': self.stages,
+				'total': {'duration': self.lastTime-self.startTime,
+						'rss_start_kb': self.startRss,
+						'rss_end_kb': self.lastRss,
+						'rss_peak_kb': peakRss(),
+						'largest_rss_growth': max(self.stages, key=lambda stage: stage['rss_growth_kb'])['stage'] if self.stages else None,
+						'largest_traced_peak': max(self.stages, key=lambda stage: stage['traced_peak_kb'])['stage'] if self.stages else None}}
+
+	def write(self, reportfile):
+		tracemalloc.stop()
+		with open(reportfile, 'w') as reportHandle:
+			json.dump(self.report(), reportHandle, indent=1)
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# Convert several BCML maps into one SBML atlas.
+#
+# Example of a command line :
+# python merge_maps.py -o DC-ATLAS_sbml.xml ../DC-ATLAS/BCML/*.xml
+#
+# Each map is converted with bcml_to_sbml.py, then added to the atlas:
+# - species are deduplicated on a canonical signature: class (BCML element), label, state
+#   variables, units of information (gene, mRNA...) and compartment label; complexes use the signatures of their members and
+#   their logic instead of a label. A species keeps its id unless another species already
+#   uses it in the atlas, in which case it is prefixed by the map name.
+# - compartments are shared by label, reactions are always kept; their ids are prefixed by
+#   the map name (re1 -> TLR9_re1), as they restart in every map.
+# Everything is looked up in dictionaries, so the cost grows linearly with the corpus.
+
+
+# General
+import sys
+import os.path
+import re
+import argparse
+
+# For BCML
+import xml.etree.ElementTree as ET
+
+# For SBML (libsbml is loaded by bcml_to_sbml.py once a map is converted)
+import bcml_to_sbml
+from bcml_to_sbml import idfy, compartmentLabel, check, loadLibsbml
+
+# Elements defining species in BCML
+speciesTags = ['Macromolecule', 'NucleicAcidFeature', 'SimpleChemical', 'Complex']
+
+def speciesSignatures(bcmlRoot):
+	"""Canonical signature of every species of a map, by SBML id."""
+
+	elements = {}
+	for bcmlComp in bcmlRoot.iter('Compartment'):
+		bcmlCompLabel = compartmentLabel(bcmlComp)
+		for bcmlTag in speciesTags:
+			for bcmlSpecies in bcmlComp.iter(bcmlTag):
+				if bcmlSpecies.attrib.get('cloneref') is None:
+					elements[bcmlSpecies.attrib.get('ID')] = (bcmlSpecies, bcmlCompLabel)
+
+	signatures = {}
+
+	def signature(bcmlId, visiting):
+		if bcmlId in signatures:
+			return signatures[bcmlId]
+		if bcmlId not in elements or bcmlId in visiting:
+			return ('?', str(bcmlId))
+		(bcmlSpecies, bcmlCompLabel) = elements[bcmlId]
+		stateVariables = sorted([ bcmlStateVariable.attrib.get('label').strip() for bcmlStateVariable in bcmlSpecies.findall('StateVariable') if bcmlStateVariable.attrib.get('label', '').strip() != '' ])
+		# The gene and the mRNA of a NucleicAcidFeature share their label
+		unitsOfInformation = sorted([ tuple([ str(bcmlUnitOfInfo.attrib.get(name)) for name in ['prefix', 'label', 'term'] ]) for bcmlUnitOfInfo in bcmlSpecies.findall('UnitOfInformation') ])
+		if bcmlSpecies.tag == 'Complex':
+			visiting.add(bcmlId)
+			members = []
+			for bcmlMember in bcmlSpecies:
+				if bcmlMember.tag in speciesTags:
+					memberId = bcmlMember.attrib.get('cloneref')
+					if memberId is None:
+						memberId = bcmlMember.attrib.get('ID')
+					members.append(signature(memberId, visiting))
+			visiting.discard(bcmlId)
+			label = (str(bcmlSpecies.attrib.get('type')), tuple(sorted(members, key=repr)))
+		else:
+			label = bcmlSpecies.attrib.get('label')
+			if label is None or label == '':
+				label = bcmlSpecies.attrib.get('cloneref')
+		signatures[bcmlId] = (bcmlSpecies.tag, label, tuple(stateVariables), tuple(unitsOfInformation), bcmlCompLabel)
+		return signatures[bcmlId]
+
+	return dict((idfy(str(bcmlId)), signature(bcmlId, set())) for bcmlId in elements)
+
+# Notes lines referencing species ids, to be renamed along with the species
+notesReferencePattern = re.compile("^((?:Complex:(?:MacroMolecule|Complex|SimpleChemical)|Reactant|Product|Modulation|Inhibition|Catalysis|NecessaryStimulation|Stimulation):)(\\S+)$", re.MULTILINE)
+
+def renameNotes(sbmlElement, speciesIds):
+	if not sbmlElement.isSetNotes():
+		return
+	notes = sbmlElement.getNotesString()
+	renamed = notesReferencePattern.sub(lambda match: match.group(1)+speciesIds.get(match.group(2), match.group(2)), notes)
+	if renamed != notes:
+		check( sbmlElement.setNotes(renamed),				"Rename notes")
+
+class Atlas(object):
+	"""SBML document gathering several maps."""
+
+	def __init__(self, modelName):
+		self.document = bcml_to_sbml.createDocument(modelName)
+		self.model = self.document.getModel()
+		# Hash maps: compartment label -> id, species signature -> id, and used ids
+		self.compartments = {}
+		self.species = {}
+		self.usedIds = set()
+		self.prefixes = set()
+
+	def mapPrefix(self, mapName):
+		prefix = idfy(os.path.splitext(os.path.basename(mapName))[0])
+		uniquePrefix = prefix
+		counter = 2
+		while uniquePrefix in self.prefixes:
+			uniquePrefix = prefix+"_"+str(counter)
+			counter += 1
+		self.prefixes.add(uniquePrefix)
+		return uniquePrefix
+
+	def addMap(self, bcmlRoot, mapName):
+		"""Convert a parsed BCML map and add it to the atlas. Returns the number
+		of species that were already in the atlas."""
+
+		prefix = self.mapPrefix(mapName)
+		mapModel = bcml_to_sbml.convert(bcmlRoot, mapName).getModel()
+		signatures = speciesSignatures(bcmlRoot)
+
+		# Compartments, shared by label
+		compartmentIds = {}
+		for sbmlComp in mapModel.getListOfCompartments():
+			label = sbmlComp.getName()
+			if label not in self.compartments:
+				newComp = sbmlComp.clone()
+				check( newComp.setId(prefix+"_"+sbmlComp.getId()),			"Set compartment Id")
+				check( self.model.addCompartment(newComp),					"Add compartment")
+				self.compartments[label] = newComp.getId()
+			compartmentIds[sbmlComp.getId()] = self.compartments[label]
+
+		# Species, deduplicated by signature
+		speciesIds = {}
+		newSpecies = []
+		nbDuplicates = 0
+		for sbmlSpecies in mapModel.getListOfSpecies():
+			localId = sbmlSpecies.getId()
+			speciesSignature = signatures.get(localId)
+			if speciesSignature is None:
+				# Not found in BCML (should not happen): never merged
+				speciesSignature = ('?', prefix, localId)
+			if speciesSignature in self.species:
+				speciesIds[localId] = self.species[speciesSignature]
+				nbDuplicates += 1
+				continue
+			atlasId = localId
+			if atlasId in self.usedIds:
+				atlasId = prefix+"_"+localId
+			self.usedIds.add(atlasId)
+			self.species[speciesSignature] = atlasId
+			speciesIds[localId] = atlasId
+			newSpecies.append(sbmlSpecies)
+
+		for sbmlSpecies in newSpecies:
+			atlasSpecies = sbmlSpecies.clone()
+			check( atlasSpecies.setId(speciesIds[sbmlSpecies.getId()]),					"Set ID")
+			check( atlasSpecies.setCompartment(compartmentIds[sbmlSpecies.getCompartment()]),	"Set compartment")
+			renameNotes(atlasSpecies, speciesIds)
+			check( self.model.addSpecies(atlasSpecies),									"Add species")
+
+		# Reactions, namespaced by map
+		for sbmlReaction in mapModel.getListOfReactions():
+			atlasReaction = sbmlReaction.clone()
+			check( atlasReaction.setId(prefix+"_"+sbmlReaction.getId()),				"Set ID")
+			for sbmlReferences in [atlasReaction.getListOfReactants(), atlasReaction.getListOfProducts(), atlasReaction.getListOfModifiers()]:
+				for sbmlReference in sbmlReferences:
+					if sbmlReference.getSpecies() in speciesIds:
+						check( sbmlReference.setSpecies(speciesIds[sbmlReference.getSpecies()]),	"Set Reference")
+			renameNotes(atlasReaction, speciesIds)
+			check( self.model.addReaction(atlasReaction),								"Add reaction")
+
+		return nbDuplicates
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Convert several BCML maps into one SBML atlas.")
+	parser.add_argument('bcml', nargs='+', help="BCML files to merge")
+	parser.add_argument('-o', '--output', required=True, help="SBML file to write")
+	parser.add_argument('--name', default="atlas", help="name of the merged model (default: atlas)")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+
+	atlas = Atlas(args.name)
+	for bcmlFile in args.bcml:
+		nbDuplicates = atlas.addMap(ET.parse(bcmlFile).getroot(), bcmlFile)
+		print(bcmlFile+": "+str(nbDuplicates)+" species already in the atlas")
+
+	outputdir = os.path.dirname(args.output)
+	if outputdir != '' and not os.path.exists(outputdir):
+		os.makedirs(outputdir)
+	loadLibsbml().writeSBMLToFile(atlas.document, args.output)
+	print(str(atlas.model.getNumSpecies())+" species, "+str(atlas.model.getNumReactions())+" reactions in "+args.output)
+
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,199 @@
+# Conversion metrics in the Prometheus text format, for bcml_to_sbml.py, improve_cd_file.py
+# and improve_cd_batch.py (--metrics FILE, --metrics-port PORT).
+#
+# - bcml_files_processed_total, bcml_failures_total (by cause: exception type)
+# - bcml_species_total, bcml_reactions_total, bcml_modifiers_total (by SBO term)
+# - bcml_stage_seconds: histogram of the duration of each stage
+# - bcml_bytes_read_total, bcml_bytes_written_total
+# All samples are labelled with the script. The metrics can be served over HTTP on a local
+# port while the script runs, and/or written to a file at exit (e.g. for the textfile
+# collector of node_exporter). Only the standard library is used.
+
+
+# General
+import os
+import tempfile
+import time
+import threading
+
+try:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+# Name -> (type, help)
+metricTypes = {'bcml_files_processed_total': ('counter', "Files processed successfully."),
+				'bcml_failures_total': ('counter', "Files that could not be processed, by cause."),
+				'bcml_species_total': ('counter', "Species written, by SBO term."),
+				'bcml_reactions_total': ('counter', "Reactions written, by SBO term."),
+				'bcml_modifiers_total': ('counter', "Reaction modifiers written, by SBO term."),
+				'bcml_stage_seconds': ('histogram', "Duration of the processing stages."),
+				'bcml_bytes_read_total': ('counter', "Bytes of input files read."),
+				'bcml_bytes_written_total': ('counter', "Bytes of output files written.")}
+
+# Upper bounds of the histogram buckets, in seconds
+stageBuckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+def escapeLabel(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatLabels(labels, extra=None):
+	pairs = list(labels)+([extra] if extra is not None else [])
+	if len(pairs) == 0:
+		return ""
+	return "{"+",".join([ name+'="'+escapeLabel(value)+'"' for (name, value) in pairs ])+"}"
+
+def formatValue(value):
+	if value == int(value):
+		return str(int(value))
+	return repr(float(value))
+
+def sboLabel(sboTerm):
+	"""SBO term label of an element, 'none' when it has none."""
+	if sboTerm is None or sboTerm == '':
+		return 'none'
+	return sboTerm
+
+class Metrics(object):
+	"""Counters and histograms of one script. Samples are keyed by metric name and
+	sorted label pairs. Like MemoryProfiler, it can be given as the 'profiler' of
+	the conversion functions: endStage(name) records the duration of the stage
+	that ended.
+	"""
+
+	def __init__(self, script):
+		self.script = script
+		self.counters = {}
+		# (name, labels) -> [count per bucket, sum, count]
+		self.histograms = {}
+		self.lock = threading.Lock()
+		self.lastTime = time.time()
+		self.server = None
+
+	def key(self, name, labels):
+		labels = dict(labels)
+		labels['script'] = self.script
+		return (name, tuple(sorted(labels.items())))
+
+	def inc(self, name, value=1, **labels):
+		key = self.key(name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0)+value
+
+	def observe(self, name, value, **labels):
+		key = self.key(name, labels)
+		with self.lock:
+			if key not in self.histograms:
+				self.histograms[key] = [[0]*len(stageBuckets), 0.0, 0]
+			histogram = self.histograms[key]
+			for (idx, bound) in enumerate(stageBuckets):
+				if value <= bound:
+					histogram[0][idx] += 1
+			histogram[1] += value
+			histogram[2] += 1
+
+	def restartStages(self):
+		self.lastTime = time.time()
+
+	def endStage(self, name):
+		now = time.time()
+		self.observe('bcml_stage_seconds', now-self.lastTime, stage=name)
+		self.lastTime = now
+
+	def fail(self, error):
+		self.inc('bcml_failures_total', cause=type(error).__name__)
+
+	def state(self):
+		"""Picklable copy of the samples, to be merged in another process."""
+		with self.lock:
+			return (dict(self.counters), dict((key, [list(histogram[0]), histogram[1], histogram[2]]) for (key, histogram) in self.histograms.items()))
+
+	def merge(self, state):
+		(counters, histograms) = state
+		with self.lock:
+			for (key, value) in counters.items():
+				self.counters[key] = self.counters.get(key, 0)+value
+			for (key, (buckets, total, count)) in histograms.items():
+				if key not in self.histograms:
+					self.histograms[key] = [[0]*len(stageBuckets), 0.0, 0]
+				histogram = self.histograms[key]
+				histogram[0] = [ mine+theirs for (mine, theirs) in zip(histogram[0], buckets) ]
+				histogram[1] += total
+				histogram[2] += count
+
+	def render(self):
+		"""All samples in the Prometheus text exposition format."""
+		(counters, histograms) = self.state()
+		lines = []
+		for name in sorted(metricTypes):
+			(metricType, helpText) = metricTypes[name]
+			if metricType == 'counter':
+				samples = sorted([ (labels, value) for ((sampleName, labels), value) in counters.items() if sampleName == name ])
+			else:
+				samples = sorted([ (labels, value) for ((sampleName, labels), value) in histograms.items() if sampleName == name ])
+			if len(samples) == 0:
+				continue
+			lines.append("# HELP "+name+" "+helpText)
+			lines.append("# TYPE "+name+" "+metricType)
+			for (labels, value) in samples:
+				if metricType == 'counter':
+					lines.append(name+formatLabels(labels)+" "+formatValue(value))
+				else:
+					(buckets, total, count) = value
+					for (bound, bucketCount) in zip(stageBuckets, buckets):
+						lines.append(name+"_bucket"+formatLabels(labels, ('le', repr(bound)))+" "+str(bucketCount))
+					lines.append(name+"_bucket"+formatLabels(labels, ('le', "+Inf"))+" "+str(count))
+					lines.append(name+"_sum"+formatLabels(labels)+" "+repr(total))
+					lines.append(name+"_count"+formatLabels(labels)+" "+str(count))
+		return "\n".join(lines)+"\n"
+
+	def write(self, metricsfile):
+		# Write next to the file and rename, so that a collector never reads half a file;
+		# the temporary file has a name of its own, not shared with other writers
+		(descriptor, temporaryfile) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(metricsfile)),
+				prefix="."+os.path.basename(metricsfile)+".", suffix=".tmp")
+		try:
+			with os.fdopen(descriptor, 'w') as metricsHandle:
+				metricsHandle.write(self.render())
+			os.replace(temporaryfile, metricsfile)
+		except:
+			if os.path.exists(temporaryfile):
+				os.remove(temporaryfile)
+			raise
+
+	def serve(self, port, host='127.0.0.1'):
+		"""Serve the metrics over HTTP (any path) from a background thread."""
+		metrics = self
+
+		class MetricsHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.render().encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = HTTPServer((host, port), MetricsHandler)
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def close(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+
+class StageObservers(object):
+	"""Forwards stage boundaries to several observers (memory profiler, metrics)."""
+
+	def __init__(self, observers):
+		self.observers = [ observer for observer in observers if observer is not None ]
+
+	def endStage(self, name):
+		for observer in self.observers:
+			observer.endStage(name)
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+
+# Answer reachability and shortest path queries on a converted map.
+#
+# Example of a command line :
+# python pathway_query.py ../DC-ATLAS/BCML/to_SBML/TLR9_sbml.xml TLR9 IL-8
+#
+# A species A reaches a species B if there is a chain of reactions from A to B, each
+# step going from a reactant or modifier of a reaction to one of its products.
+# The index is built once per SBML file produced by bcml_to_sbml.py and stored next
+# to it (_reach.npz):
+# - the transitive closure, one bitset row per species (computed on the strongly
+#   connected components, in reverse topological order). A species only reaches itself
+#   if it is on a cycle.
+# - the species graph in CSR form (indptr, indices, with the reaction of each edge), in
+#   which shortest paths are found by a breadth-first search at query time
+# It is only rebuilt when the content hash of the SBML file changes.
+
+
+# General
+import sys
+import os.path
+import argparse
+import hashlib
+
+# For SBML (plain XML reading is enough, and much faster to load than libsbml)
+import xml.etree.ElementTree as ET
+
+import numpy
+
+sbmlNs = '{http://www.sbml.org/sbml/level2/version4}'
+
+def contentHash(sbmlFile):
+	digest = hashlib.sha1()
+	with open(sbmlFile, 'rb') as sbmlHandle:
+		for block in iter(lambda: sbmlHandle.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def readSpeciesGraph(sbmlFile):
+	"""Returns species ids, species names and the edges (source, target, reaction id)
+	between species of an SBML file."""
+	sbmlRoot = ET.parse(sbmlFile).getroot()
+	speciesIds = []
+	speciesNames = []
+	for sbmlSpecies in sbmlRoot.iter(sbmlNs+'species'):
+		speciesIds.append(sbmlSpecies.get('id'))
+		speciesNames.append(sbmlSpecies.get('name', ''))
+	declared = set(speciesIds)
+
+	edges = []
+	for sbmlReaction in sbmlRoot.iter(sbmlNs+'reaction'):
+		inputs = []
+		for listTag in ['listOfReactants', 'listOfModifiers']:
+			for sbmlList in sbmlReaction.findall(sbmlNs+listTag):
+				inputs += [ sbmlRef.get('species') for sbmlRef in sbmlList ]
+		outputs = []
+		for sbmlList in sbmlReaction.findall(sbmlNs+'listOfProducts'):
+			outputs += [ sbmlRef.get('species') for sbmlRef in sbmlList ]
+		for source in inputs:
+			for target in outputs:
+				if source in declared and target in declared:
+					edges.append((source, target, sbmlReaction.get('id')))
+	return (speciesIds, speciesNames, edges)
+
+def stronglyConnectedComponents(nbNodes, successors):
+	"""Iterative Tarjan algorithm. Components are returned in reverse topological
+	order (a component comes after all the components it reaches)."""
+	index = [-1]*nbNodes
+	lowlink = [0]*nbNodes
+	onStack = [False]*nbNodes
+	stack = []
+	components = []
+	counter = 0
+	for root in range(nbNodes):
+		if index[root] != -1:
+			continue
+		work = [(root, 0)]
+		while work:
+			(node, childPos) = work.pop()
+			if childPos == 0:
+				index[node] = counter
+				lowlink[node] = counter
+				counter += 1
+				stack.append(node)
+				onStack[node] = True
+			recurse = False
+			children = successors[node]
+			while childPos < len(children):
+				child = children[childPos]
+				childPos += 1
+				if index[child] == -1:
+					work.append((node, childPos))
+					work.append((child, 0))
+					recurse = True
+					break
+				elif onStack[child]:
+					lowlink[node] = min(lowlink[node], index[child])
+			if recurse:
+				continue
+			if lowlink[node] == index[node]:
+				component = []
+				while True:
+					member = stack.pop()
+					onStack[member] = False
+					component.append(member)
+					if member == node:
+						break
+				components.append(component)
+			if work:
+				parent = work[-1][0]
+				lowlink[parent] = min(lowlink[parent], lowlink[node])
+	return components
+
+def buildIndex(sbmlFile):
+	"""Compute the reachability index of an SBML file, as a dictionary of arrays."""
+
+	(speciesIds, speciesNames, edges) = readSpeciesGraph(sbmlFile)
+	nbNodes = len(speciesIds)
+	nodeIndex = dict((speciesId, idx) for (idx, speciesId) in enumerate(speciesIds))
+
+	# One edge per pair of species, with the first reaction linking them
+	successors = [ [] for idx in range(nbNodes) ]
+	edgeReactions = [ [] for idx in range(nbNodes) ]
+	seenEdges = set()
+	for (source, target, reactionId) in edges:
+		if (source, target) in seenEdges:
+			continue
+		seenEdges.add((source, target))
+		successors[nodeIndex[source]].append(nodeIndex[target])
+		edgeReactions[nodeIndex[source]].append(reactionId)
+
+	# Transitive closure on the condensation: Python integers as bitsets
+	components = stronglyConnectedComponents(nbNodes, successors)
+	componentOf = [0]*nbNodes
+	for (componentIdx, component) in enumerate(components):
+		for node in component:
+			componentOf[node] = componentIdx
+	# Species reached by a component (through at least one reaction), and the same plus its members
+	componentReach = [0]*len(components)
+	componentClosure = [0]*len(components)
+	for (componentIdx, component) in enumerate(components):
+		members = 0
+		reach = 0
+		cyclic = len(component) > 1
+		for node in component:
+			members |= 1 << node
+			for child in successors[node]:
+				if componentOf[child] != componentIdx:
+					reach |= componentClosure[componentOf[child]]
+				elif child == node:
+					cyclic = True
+		# Members reach each other (and themselves) only around a cycle
+		if cyclic:
+			reach |= members
+		componentReach[componentIdx] = reach
+		componentClosure[componentIdx] = reach | members
+
+	rowBytes = (nbNodes+7)//8
+	closure = numpy.zeros((nbNodes, rowBytes), dtype=numpy.uint8)
+	for node in range(nbNodes):
+		closure[node] = numpy.frombuffer(componentReach[componentOf[node]].to_bytes(rowBytes, 'little'), dtype=numpy.uint8)
+
+	indptr = numpy.zeros(nbNodes+1, dtype=numpy.int32)
+	indptr[1:] = numpy.cumsum([ len(children) for children in successors ])
+	return {'content_hash': numpy.array(contentHash(sbmlFile)),
+			'ids': numpy.array(speciesIds),
+			'names': numpy.array(speciesNames),
+			'closure': closure,
+			'indptr': indptr,
+			'indices': numpy.array([ child for children in successors for child in children ], dtype=numpy.int32),
+			'edge_reactions': numpy.array([ reactionId for reactions in edgeReactions for reactionId in reactions ], dtype=str)}
+
+def indexPath(sbmlFile):
+	return os.path.splitext(sbmlFile)[0]+"_reach.npz"
+
+
+class ReachabilityIndex(object):
+	"""Precomputed reachability and shortest paths between the species of a map."""
+
+	def __init__(self, arrays):
+		self.contentHash = str(arrays['content_hash'])
+		self.ids = [ str(speciesId) for speciesId in arrays['ids'] ]
+		self.names = [ str(name) for name in arrays['names'] ]
+		self.closure = arrays['closure']
+		self.indptr = arrays['indptr']
+		self.indices = arrays['indices']
+		self.edgeReactions = arrays['edge_reactions']
+		self.nodeIndex = dict((speciesId, idx) for (idx, speciesId) in enumerate(self.ids))
+		self.byName = {}
+		for (idx, name) in enumerate(self.names):
+			self.byName.setdefault(name, []).append(idx)
+
+	def resolve(self, species):
+		"""Indexes of the species with this id, or else this name."""
+		if species in self.nodeIndex:
+			return [self.nodeIndex[species]]
+		return self.byName.get(species, [])
+
+	def reachesIdx(self, source, target):
+		return (int(self.closure[source, target >> 3]) >> (target & 7)) & 1 == 1
+
+	def reaches(self, source, target):
+		for sourceIdx in self.resolve(source):
+			for targetIdx in self.resolve(target):
+				if self.reachesIdx(sourceIdx, targetIdx):
+					return True
+		return False
+
+	def shortestPath(self, source, target):
+		"""Shortest path as a list of (species id, reaction id leading to the next species),
+		the last reaction being None. Returns None if 'target' can't be reached."""
+		sources = self.resolve(source)
+		targets = set(self.resolve(target))
+		if not any(self.reachesIdx(sourceIdx, targetIdx) for sourceIdx in sources for targetIdx in targets):
+			return None
+		# Breadth-first search from all the sources at once, over the CSR graph. A species
+		# is only reached through a reaction, so a source is a target only around a cycle.
+		parents = {}
+		frontier = list(sources)
+		while frontier:
+			newFrontier = []
+			for node in frontier:
+				for edge in range(self.indptr[node], self.indptr[node+1]):
+					child = int(self.indices[edge])
+					if child in parents:
+						continue
+					parents[child] = (node, edge)
+					if child in targets:
+						return self.pathTo(child, parents, set(sources))
+					newFrontier.append(child)
+			frontier = newFrontier
+		return None
+
+	def pathTo(self, targetIdx, parents, sources):
+		path = [(self.ids[targetIdx], None)]
+		node = targetIdx
+		while True:
+			(parent, edge) = parents[node]
+			path.append((self.ids[parent], str(self.edgeReactions[edge])))
+			node = parent
+			if node in sources:
+				break
+		path.reverse()
+		return path
+
+def loadIndex(sbmlFile, rebuild=False):
+	"""Load the index of 'sbmlFile', building it first if it doesn't exist or
+	the SBML file changed since it was built."""
+	indexfile = indexPath(sbmlFile)
+	if not rebuild and os.path.exists(indexfile):
+		arrays = numpy.load(indexfile)
+		# Indexes with a dense next hop matrix (no CSR graph) are rebuilt
+		if 'indptr' in arrays.files and str(arrays['content_hash']) == contentHash(sbmlFile):
+			return ReachabilityIndex(arrays)
+	arrays = buildIndex(sbmlFile)
+	numpy.savez(indexfile, **arrays)
+	return ReachabilityIndex(arrays)
+
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Reachability and shortest path queries on a converted map.")
+	parser.add_argument('sbml', help="SBML file produced by bcml_to_sbml.py")
+	parser.add_argument('source', help="species id or name")
+	parser.add_argument('target', help="species id or name")
+	parser.add_argument('--rebuild', action='store_true', help="rebuild the index even if the map didn't change")
+	return parser.parse_args(argv[1:])
+
+def main(argv):
+
+	args = parseArguments(argv)
+	index = loadIndex(args.sbml, args.rebuild)
+
+	for species in [args.source, args.target]:
+		if len(index.resolve(species)) == 0:
+			raise SystemExit('Unknown species: ' + species + '.')
+
+	path = index.shortestPath(args.source, args.target)
+	if path is None:
+		print(args.source+" does not reach "+args.target)
+		return 1
+	print(args.source+" reaches "+args.target+" in "+str(len(path)-1)+" reaction(s)")
+	print("".join([ speciesId+(" --"+reactionId+"--> " if reactionId is not None else "") for (speciesId, reactionId) in path ]))
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
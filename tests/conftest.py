@@ -0,0 +1,5 @@
+# The scripts are plain modules at the root of the repository
+import os.path
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,127 @@
+# Conversion of a small BCML map (fixtures/small_bcml.xml) with bcml_to_sbml.py: incremental
+# patching against a full conversion, and broken elements skipped with --error-report.
+
+import os.path
+import shutil
+import json
+import xml.etree.ElementTree as ET
+
+import pytest
+
+libsbml = pytest.importorskip('libsbml')
+
+import bcml_to_sbml
+
+fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'small_bcml.xml')
+
+def copyFixture(directory, name='map.xml'):
+	directory.mkdir(exist_ok=True)
+	bcmlFile = str(directory / name)
+	shutil.copy(fixture, bcmlFile)
+	return bcmlFile
+
+def editBcml(bcmlFile, old, new):
+	with open(bcmlFile) as bcmlHandle:
+		content = bcmlHandle.read()
+	assert old in content
+	with open(bcmlFile, 'w') as bcmlHandle:
+		bcmlHandle.write(content.replace(old, new))
+
+def run(bcmlFile, *options):
+	bcml_to_sbml.main(['bcml_to_sbml.py', bcmlFile]+list(options))
+	return bcml_to_sbml.outputPath(bcmlFile)
+
+def content(sbmlFile):
+	"""Species ids, and reactions as (SBO term, reactants, products, modifiers) whatever their id."""
+	sbmlModel = libsbml.readSBMLFromFile(sbmlFile).getModel()
+	species = sorted([ sbmlSpecies.getId() for sbmlSpecies in sbmlModel.getListOfSpecies() ])
+	reactions = []
+	for sbmlReaction in sbmlModel.getListOfReactions():
+		reactions.append((sbmlReaction.getSBOTerm(),
+				tuple(sorted([ sbmlReference.getSpecies() for sbmlReference in sbmlReaction.getListOfReactants() ])),
+				tuple(sorted([ sbmlReference.getSpecies() for sbmlReference in sbmlReaction.getListOfProducts() ])),
+				tuple(sorted([ (sbmlReference.getSpecies(), sbmlReference.getSBOTerm()) for sbmlReference in sbmlReaction.getListOfModifiers() ]))))
+	return (species, sorted(reactions))
+
+def fullConversion(tmp_path, editedBcml):
+	"""Content of the full conversion of a copy of 'editedBcml', in its own directory."""
+	bcmlFile = str(tmp_path / 'full' / 'map.xml')
+	os.makedirs(os.path.dirname(bcmlFile))
+	shutil.copy(editedBcml, bcmlFile)
+	return content(run(bcmlFile))
+
+def test_incremental_update_matches_a_full_conversion(tmp_path):
+	bcmlFile = copyFixture(tmp_path / 'inc')
+	run(bcmlFile, '--incremental')
+	editBcml(bcmlFile, '<Catalysis refNode="ATP"/>', '<Catalysis refNode="IkB"/>')
+	editBcml(bcmlFile, '<Macromolecule ID="X1" label="X1"/>', '<Macromolecule ID="X1" label="X1"/><Macromolecule ID="X2" label="X2"/>')
+	sbmlFile = run(bcmlFile, '--incremental')
+	assert content(sbmlFile) == fullConversion(tmp_path, bcmlFile)
+
+def test_full_conversion_removes_the_fingerprint(tmp_path):
+	bcmlFile = copyFixture(tmp_path / 'inc')
+	sbmlFile = run(bcmlFile, '--incremental')
+	assert os.path.exists(bcml_to_sbml.fingerprintPath(sbmlFile))
+	run(bcmlFile)
+	assert not os.path.exists(bcml_to_sbml.fingerprintPath(sbmlFile))
+	# The next incremental run converts in full: no duplicated reaction
+	editBcml(bcmlFile, '<Process ID="p2">', '<Process ID="p2b">')
+	run(bcmlFile, '--incremental')
+	assert content(sbmlFile) == fullConversion(tmp_path, bcmlFile)
+
+def test_edited_sbml_is_not_patched(tmp_path):
+	bcmlFile = copyFixture(tmp_path / 'inc')
+	sbmlFile = run(bcmlFile, '--incremental')
+	# The SBML is replaced behind the fingerprint's back, by one without reactions
+	document = libsbml.readSBMLFromFile(sbmlFile)
+	while document.getModel().getNumReactions() > 0:
+		document.getModel().removeReaction(0)
+	libsbml.writeSBMLToFile(document, sbmlFile)
+	run(bcmlFile, '--incremental')
+	assert content(sbmlFile) == fullConversion(tmp_path, bcmlFile)
+
+def test_removed_species_still_referenced_falls_back_to_a_full_conversion(tmp_path):
+	bcmlFile = copyFixture(tmp_path / 'inc')
+	sbmlFile = run(bcmlFile, '--incremental')
+	# IkB is referenced by p1 and p5, which don't change: they can't be patched
+	editBcml(bcmlFile, '<Macromolecule ID="IkB" label="IkB"/>', '')
+	with open(bcml_to_sbml.fingerprintPath(sbmlFile)) as fingerprintHandle:
+		fingerprint = json.load(fingerprintHandle)
+	document = libsbml.readSBMLFromFile(sbmlFile)
+	assert bcml_to_sbml.updateIncrementally(ET.parse(bcmlFile).getroot(), document, fingerprint) is None
+	run(bcmlFile, '--incremental')
+	assert content(sbmlFile) == fullConversion(tmp_path, bcmlFile)
+
+def test_broken_reactions_are_skipped_and_rolled_back(tmp_path):
+	bcmlFile = copyFixture(tmp_path / 'err')
+	# Transcription without NecessaryStimulation, Stimulation without reference (fails once
+	# the reactants and products are added), Modulation without refNode
+	editBcml(bcmlFile, '<NecessaryStimulation refNode="and1"/>', '')
+	editBcml(bcmlFile, '<Stimulation refNode="TLR9_MYD88"/>', '<Stimulation/>')
+	editBcml(bcmlFile, '<Modulation refNode="CpG"/>', '<Modulation/>')
+	reportfile = str(tmp_path / 'report.json')
+	assert bcml_to_sbml.main(['bcml_to_sbml.py', bcmlFile, '--error-report', reportfile]) == 1
+
+	with open(reportfile) as reportHandle:
+		report = json.load(reportHandle)
+	assert sorted([ (error['stage'], error['id'], error['error']) for error in report['files'][0]['errors'] ]) == \
+			[('reactions', 'p1', 'SystemExit'), ('reactions', 'p2', 'MapError'), ('reactions', 'p3', 'MapError')]
+
+	# Same SBML as the map without these reactions: nothing is left of the failed ones
+	expectedBcml = copyFixture(tmp_path / 'expected')
+	for reactionId in ['p1', 'p2', 'p3']:
+		bcmlTree = ET.parse(expectedBcml)
+		for bcmlComp in bcmlTree.getroot().iter('Compartment'):
+			for bcmlProcess in bcmlComp.findall('Process'):
+				if bcmlProcess.get('ID') == reactionId:
+					bcmlComp.remove(bcmlProcess)
+		bcmlTree.write(expectedBcml)
+	assert content(bcml_to_sbml.outputPath(bcmlFile)) == content(run(expectedBcml))
+
+def test_code_errors_are_not_collected(tmp_path, monkeypatch):
+	bcmlFile = copyFixture(tmp_path / 'err')
+	def brokenInhibition(*args):
+		raise AttributeError("defect of the converter")
+	monkeypatch.setattr(bcml_to_sbml, 'addInhibition', brokenInhibition)
+	with pytest.raises(AttributeError):
+		bcml_to_sbml.main(['bcml_to_sbml.py', bcmlFile, '--error-report', str(tmp_path / 'report.json')])
@@ -0,0 +1,60 @@
+# Boolean rules read from small BCML maps by boolean_network.py, and their simulation.
+
+import xml.etree.ElementTree as ET
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from boolean_network import readRules, compileNetwork
+
+def bcmlMap(content):
+	return ET.fromstring('<BCML><Map><Compartment ID="comp1" label="Cytoplasm">'
+			'<Macromolecule ID="A" label="A"/><Macromolecule ID="B" label="B"/><Macromolecule ID="C" label="C"/>'
+			'<Macromolecule ID="D" label="D"/><Macromolecule ID="X" label="X"/>'
+			+content+'</Compartment></Map></BCML>')
+
+def ruleOf(bcmlRoot, ruleId):
+	(nodes, rules) = readRules(bcmlRoot)
+	return [ rule for rule in rules if rule['id'] == ruleId ][0]
+
+def nextValue(network, on, node):
+	"""Value of 'node' after one synchronous update from the state where only 'on' are ON."""
+	state = numpy.zeros((1, len(network.nodes)), dtype=bool)
+	for onNode in on:
+		state[0, network.nodeIndex[onNode]] = True
+	return bool(network.stepSynchronous(state)[0, network.nodeIndex[node]])
+
+nestedStimulation = ('<AndNode ID="and1"><Logic refNode="A"/><Logic refNode="B"/></AndNode>'
+		'<OrNode ID="or1"><Logic refNode="and1"/><Logic refNode="C"/></OrNode>'
+		'<Process ID="p1"><Consumption refNode="D"/><Production refNode="X"/><NecessaryStimulation refNode="or1"/></Process>')
+
+def test_and_under_or_is_expanded_into_clauses():
+	assert ruleOf(bcmlMap(nestedStimulation), 'p1')['clauses'] == [['D'], ['A', 'C'], ['B', 'C']]
+	network = compileNetwork(bcmlMap(nestedStimulation))
+	assert nextValue(network, ['D', 'A', 'B'], 'X')
+	assert nextValue(network, ['D', 'C'], 'X')
+	# Not A or B or C
+	assert not nextValue(network, ['D', 'A'], 'X')
+	assert not nextValue(network, ['D', 'B'], 'X')
+
+nestedInhibition = ('<AndNode ID="and1"><Logic refNode="A"/><Logic refNode="B"/></AndNode>'
+		'<OrNode ID="or1"><Logic refNode="and1"/><Logic refNode="C"/></OrNode>'
+		'<Process ID="p1"><Consumption refNode="D"/><Production refNode="X"/><Inhibition refNode="or1"/></Process>')
+
+def test_inhibiting_and_node_needs_all_its_members():
+	assert ruleOf(bcmlMap(nestedInhibition), 'p1')['inhibitors'] == [['A', 'B'], ['C']]
+	network = compileNetwork(bcmlMap(nestedInhibition))
+	assert nextValue(network, ['D'], 'X')
+	assert nextValue(network, ['D', 'A'], 'X')
+	assert not nextValue(network, ['D', 'A', 'B'], 'X')
+	assert not nextValue(network, ['D', 'C'], 'X')
+
+def test_asynchronous_blocks_must_divide_the_states():
+	network = compileNetwork(bcmlMap(nestedStimulation))
+	states = network.randomStates(10, numpy.random.RandomState(0))
+	with pytest.raises(ValueError):
+		network.simulate(states, 5, 'asynchronous', numpy.random.RandomState(0), blockSize=4)
+	# Two blocks of 5 states follow the same update order
+	(finalStates, isFixedPoint) = network.simulate(numpy.vstack([states[:5], states[:5]]), 5, 'asynchronous', numpy.random.RandomState(0), blockSize=5)
+	assert (finalStates[:5] == finalStates[5:]).all()
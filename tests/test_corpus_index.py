@@ -0,0 +1,59 @@
+# SQLite index of converted maps with corpus_index.py: classification of the notes lines,
+# and maps indexed again only when their SBML file changed.
+
+import os
+
+import corpus_index
+from corpus_index import classifyNote, openIndex, indexMap
+
+sbmlTemplate = """<?xml version="1.0" encoding="UTF-8"?>
+<sbml xmlns="http://www.sbml.org/sbml/level2/version4" level="2" version="4">
+  <model id="map">
+    <listOfCompartments><compartment id="comp1" name="Cytoplasm"/></listOfCompartments>
+    <listOfSpecies>
+      <species id="s1" name="%s" compartment="comp1" sboTerm="SBO:0000245">
+        <notes><p xmlns="http://www.w3.org/1999/xhtml">EntrezGeneID:HOMO SAPIENS:3845
+MGI:MUS MUSCULUS:96680
+PMID:12345
+StateVariable:P@507</p></notes>
+      </species>
+    </listOfSpecies>
+  </model>
+</sbml>
+"""
+
+def writeMap(sbmlFile, name):
+	with open(sbmlFile, 'w') as sbmlHandle:
+		sbmlHandle.write(sbmlTemplate % name)
+
+def test_annotations_are_recognised_by_their_structure():
+	assert classifyNote("EntrezGeneID:HOMO SAPIENS:3845") == (('Organism', 'EntrezGeneID', 'HOMO SAPIENS:3845'), ('EntrezGeneID', 'HOMO SAPIENS', '3845'))
+	# Any DB, not only a known one
+	assert classifyNote("MGI:MUS MUSCULUS:96680")[1] == ('MGI', 'MUS MUSCULUS', '96680')
+	# Finding values with colons
+	assert classifyNote("Comment:see fig. 2: left") == (('Finding', 'Comment', 'see fig. 2: left'), None)
+	assert classifyNote("PMID:12345") == (('Finding', 'PMID', '12345'), None)
+	assert classifyNote("UnitOfInformation:label:mRNA") == (('UnitOfInformation', 'UnitOfInformation', 'label:mRNA'), None)
+
+def test_unchanged_maps_are_not_indexed_again(tmp_path, monkeypatch):
+	for name in ['a', 'b']:
+		writeMap(str(tmp_path / (name+'_sbml.xml')), 'STAT1')
+	indexfile = str(tmp_path / 'corpus.sqlite')
+	assert corpus_index.main(['corpus_index.py', 'update', indexfile, str(tmp_path)]) == 0
+
+	# Only the changed map is read again
+	writeMap(str(tmp_path / 'b_sbml.xml'), 'STAT3')
+	readFiles = []
+	readMap = corpus_index.readMap
+	def recordedReadMap(sbmlFile):
+		readFiles.append(os.path.basename(sbmlFile))
+		return readMap(sbmlFile)
+	monkeypatch.setattr(corpus_index, 'readMap', recordedReadMap)
+	connection = openIndex(indexfile)
+	assert [ indexMap(connection, str(tmp_path / (name+'_sbml.xml'))) for name in ['a', 'b'] ] == [False, True]
+	assert readFiles == ['b_sbml.xml']
+
+	assert sorted(connection.execute("SELECT m.name, s.name FROM species s JOIN maps m ON m.id = s.map_id")) == [('a', 'STAT1'), ('b', 'STAT3')]
+	assert sorted(connection.execute("SELECT m.name, a.db FROM annotations a JOIN maps m ON m.id = a.map_id")) == \
+			[('a', 'EntrezGeneID'), ('a', 'MGI'), ('b', 'EntrezGeneID'), ('b', 'MGI')]
+	connection.close()
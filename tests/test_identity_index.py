@@ -0,0 +1,47 @@
+# Corpus-wide identifier index of identity_index.py: maps replaced on update, and updates
+# of the same index file by several processes at once.
+
+import os
+import os.path
+import multiprocessing
+
+from identity_index import updateMap, loadIndex, lookup
+
+def occurrences(mapNumber, version=0):
+	return [ ('EntrezGeneID', 'HOMO SAPIENS', str(3845+version), 's'+str(mapNumber), 'Cytoplasm'),
+			('UniProt', 'HOMO SAPIENS', 'P'+str(mapNumber), 's'+str(mapNumber), 'Cytoplasm') ]
+
+def updateMaps(job):
+	(indexfile, mapNumbers) = job
+	for version in range(3):
+		for mapNumber in mapNumbers:
+			updateMap(indexfile, 'map'+str(mapNumber)+'.xml', occurrences(mapNumber, version))
+
+def test_map_entries_are_replaced(tmp_path):
+	indexfile = str(tmp_path / 'identifiers.json')
+	updateMap(indexfile, 'TLR9.xml', occurrences(1))
+	updateMap(indexfile, 'TLR9.xml', occurrences(1, 1))
+	index = loadIndex(indexfile)
+	assert lookup(index, 'EntrezGeneID', '3845') == []
+	assert lookup(index, 'EntrezGeneID', '3846', 'Homo sapiens') == [{'map': 'TLR9', 'species': 's1', 'compartment': 'Cytoplasm', 'organism': 'HOMO SAPIENS'}]
+	assert index['maps'] == {'TLR9': [['EntrezGeneID', '3846'], ['UniProt', 'P1']]}
+
+def test_concurrent_updates_keep_every_map(tmp_path):
+	indexfile = str(tmp_path / 'identifiers.json')
+	nbProcesses = 4
+	jobs = [ (indexfile, range(process*5, (process+1)*5)) for process in range(nbProcesses) ]
+	pool = multiprocessing.Pool(nbProcesses)
+	try:
+		pool.map(updateMaps, jobs)
+	finally:
+		pool.close()
+		pool.join()
+
+	index = loadIndex(indexfile)
+	assert sorted(index['maps']) == sorted([ 'map'+str(mapNumber) for mapNumber in range(nbProcesses*5) ])
+	# Only the last version of every map is left
+	assert sorted(index['identifiers']['EntrezGeneID']) == ['3847']
+	assert len(lookup(index, 'EntrezGeneID', '3847')) == nbProcesses*5
+	assert sorted(index['identifiers']['UniProt']) == sorted([ 'P'+str(mapNumber) for mapNumber in range(nbProcesses*5) ])
+	# No temporary file left behind
+	assert sorted(os.listdir(str(tmp_path))) == ['identifiers.json', 'identifiers.json.lock']
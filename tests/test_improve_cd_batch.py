@@ -0,0 +1,77 @@
+# Batches of CellDesigner files with improve_cd_batch.py: resume from the journal, removal
+# of the temporary files of interrupted writes, and inputs that would overwrite each other.
+
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import sys
+
+import pytest
+
+etree = pytest.importorskip('lxml.etree')
+
+import improve_cd_batch
+import improve_cd_file
+
+fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'small_cd.xml')
+
+def copyFixture(path):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	shutil.copy(fixture, path)
+	return path
+
+def finishedPid():
+	"""Id of a process that is not running any more."""
+	process = subprocess.Popen([sys.executable, '-c', 'pass'])
+	process.wait()
+	return process.pid
+
+def statuses(summary):
+	return dict((os.path.basename(result['file']), result['status']) for result in summary['files'])
+
+def test_resume_skips_journaled_files_and_removes_partial_outputs(tmp_path):
+	cdmlFiles = [ copyFixture(str(tmp_path / 'in' / name)) for name in ['a.xml', 'b.xml'] ]
+	outputdir = str(tmp_path / 'out')
+	journalfile = str(tmp_path / 'batch.journal')
+	summary = improve_cd_batch.improveAll(cdmlFiles, outputdir, 1, journalfile=journalfile)
+	assert statuses(summary) == {'a.xml': 'ok', 'b.xml': 'ok'}
+	assert sorted(improve_cd_batch.readJournal(journalfile)) == sorted([ os.path.abspath(cdmlFile) for cdmlFile in cdmlFiles ])
+
+	# b.xml changed since, and the writes of a.xml were interrupted on this host and another one
+	with open(cdmlFiles[1], 'a') as cdmlHandle:
+		cdmlHandle.write("\n")
+	deadPid = str(finishedPid())
+	stale = os.path.join(outputdir, ".a.xml."+socket.gethostname()+"."+deadPid+".tmp")
+	running = os.path.join(outputdir, ".a.xml."+socket.gethostname()+"."+str(os.getpid())+".tmp")
+	otherHost = os.path.join(outputdir, ".a.xml.otherhost."+deadPid+".tmp")
+	for partialfile in [stale, running, otherHost]:
+		open(partialfile, 'w').close()
+
+	summary = improve_cd_batch.improveAll(cdmlFiles, outputdir, 1, journalfile=journalfile, resume=True)
+	assert statuses(summary) == {'a.xml': 'resumed', 'b.xml': 'ok'}
+	assert summary['total']['partial'] == 1
+	assert not os.path.exists(stale)
+	assert os.path.exists(running) and os.path.exists(otherHost)
+
+	# The output of a.xml was modified: it is improved again
+	with open(os.path.join(outputdir, 'a.xml'), 'a') as outputHandle:
+		outputHandle.write("\n")
+	summary = improve_cd_batch.improveAll(cdmlFiles, outputdir, 1, journalfile=journalfile, resume=True)
+	assert statuses(summary) == {'a.xml': 'ok', 'b.xml': 'resumed'}
+
+def test_temporary_path_names_the_host_and_process():
+	assert os.path.basename(improve_cd_file.temporaryPath('out/a.xml')) == ".a.xml."+socket.gethostname()+"."+str(os.getpid())+".tmp"
+
+def test_inputs_with_the_same_name_are_refused(tmp_path):
+	cdmlFiles = [ copyFixture(str(tmp_path / directory / 'map.xml')) for directory in ['x', 'y'] ]
+	outputdir = str(tmp_path / 'out')
+	assert list(improve_cd_batch.outputCollisions(cdmlFiles, outputdir).values()) == [cdmlFiles]
+	with pytest.raises(ValueError):
+		improve_cd_batch.improveAll(cdmlFiles, outputdir, 1)
+	with pytest.raises(SystemExit):
+		improve_cd_batch.main(['improve_cd_batch.py', str(tmp_path / 'x'), str(tmp_path / 'y'), '--output-dir', outputdir])
+	assert not os.path.exists(outputdir)
+	# The same file given twice is not a collision
+	assert improve_cd_batch.outputCollisions([cdmlFiles[0], cdmlFiles[0]], outputdir) == {}
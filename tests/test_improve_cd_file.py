@@ -0,0 +1,137 @@
+# Passes of improve_cd_file.py on a small CellDesigner file (fixtures/small_cd.xml):
+# IRAK4 modifies re1 twice (stimulation and inhibition, same alias), tra2 transcribes
+# geneIL_8 into mRNAIL_8.
+
+import os.path
+
+import pytest
+
+etree = pytest.importorskip('lxml.etree')
+
+import improve_cd_file
+from improve_cd_file import improveTree, lookup, ListChanges, ResidueRegistry, adjustModifications, mergeDuplicatedSpecies, namespaces
+from error_report import ErrorReport
+
+fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'small_cd.xml')
+
+def cd(tag):
+	return '{%s}%s' % (namespaces['celldesigner'], tag)
+
+def sbml(tag):
+	return '{%s}%s' % (namespaces['sbml'], tag)
+
+@pytest.fixture
+def improvedRoot():
+	return improveTree(etree.parse(fixture)).getroot()
+
+def speciesById(cdmlRoot, speciesId):
+	return [ cdmlSpecies for cdmlSpecies in lookup('species', cdmlRoot) if cdmlSpecies.get('id') == speciesId ][0]
+
+def reactionById(cdmlRoot, reactionId):
+	return [ cdmlReaction for cdmlReaction in cdmlRoot.iter(sbml('reaction')) if cdmlReaction.get('id') == reactionId ][0]
+
+def test_rna_and_gene_species_leave_the_list_of_proteins(improvedRoot):
+	assert [ cdmlProtein.get('id') for cdmlProtein in improvedRoot.iter(cd('protein')) ] == ['pr1', 'pr2', 'pr3']
+	assert [ (cdmlRna.get('id'), cdmlRna.get('name'), cdmlRna.get('type')) for cdmlRna in improvedRoot.iter(cd('RNA')) ] == [('rn1', 'IL-8', 'RNA')]
+	assert [ (cdmlGene.get('id'), cdmlGene.get('name'), cdmlGene.get('type')) for cdmlGene in improvedRoot.iter(cd('gene')) ] == [('gn1', 'IL-8', 'GENE')]
+
+	mRna = speciesById(improvedRoot, 'mRNAIL_8')
+	assert mRna.find('.//'+cd('class')).text == 'RNA'
+	assert mRna.find('.//'+cd('rnaReference')).text == 'rn1'
+	assert mRna.find('.//'+cd('proteinReference')) is None
+	gene = speciesById(improvedRoot, 'geneIL_8')
+	assert gene.find('.//'+cd('class')).text == 'GENE'
+	assert gene.find('.//'+cd('geneReference')).text == 'gn1'
+
+	colours = dict((cdmlAlias.get('species'), cdmlAlias.find(cd('usualView')+'/'+cd('paint')).get('color')) for cdmlAlias in improvedRoot.iter(cd('speciesAlias')))
+	assert colours['mRNAIL_8'] == 'ff66ff66'
+	assert colours['geneIL_8'] == 'ffffff66'
+	assert colours['IRAK4'] == 'ffccffcc'
+
+def test_modifiers_of_the_same_species_get_their_own_type(improvedRoot):
+	re1 = reactionById(improvedRoot, 're1')
+	assert [ cdmlModification.get('type') for cdmlModification in re1.iter(cd('modification')) ] == ['PHYSICAL_STIMULATION', 'INHIBITION']
+
+def test_transcription_type_and_modulation(improvedRoot):
+	tra2 = reactionById(improvedRoot, 'tra2')
+	assert tra2.find('.//'+cd('reactionType')).text == 'TRANSCRIPTION'
+	assert [ cdmlModification.get('type') for cdmlModification in tra2.iter(cd('modification')) ] == ['MODULATION']
+
+def test_list_changes_keep_the_order_of_the_list():
+	improve_cd_file.loadEtree()
+	cdmlList = etree.Element(cd('listOfProteins'))
+	for protId in ['pr1', 'pr2', 'pr3']:
+		etree.SubElement(cdmlList, cd('protein'), id=protId)
+	listChanges = ListChanges()
+	listChanges.remove(cdmlList[1])
+	listChanges.append(cdmlList, etree.Element(cd('protein'), id='pr4'))
+	# Nothing changes before apply()
+	assert [ child.get('id') for child in cdmlList ] == ['pr1', 'pr2', 'pr3']
+	listChanges.apply()
+	assert [ child.get('id') for child in cdmlList ] == ['pr1', 'pr3', 'pr4']
+
+def test_skipped_species_is_left_unchanged():
+	cdmlTree = etree.parse(fixture)
+	# mRNAIL_8 loses its alias: the RNA pass must skip it without touching it
+	for cdmlAlias in list(cdmlTree.getroot().iter(cd('speciesAlias'))):
+		if cdmlAlias.get('id') == 'sa5':
+			cdmlAlias.getparent().remove(cdmlAlias)
+	errors = ErrorReport(fixture)
+	cdmlRoot = improveTree(cdmlTree, errors=errors).getroot()
+
+	assert [ (error['stage'], error['id'], error['error']) for error in errors.errors ] == [('adjustRnaSpecies', 'mRNAIL_8', 'KeyError')]
+	mRna = speciesById(cdmlRoot, 'mRNAIL_8')
+	assert mRna.find('.//'+cd('class')).text == 'PROTEIN'
+	assert mRna.find('.//'+cd('proteinReference')).text == 'pr5'
+	assert mRna.find('.//'+cd('rnaReference')) is None
+	assert [ cdmlProtein.get('id') for cdmlProtein in cdmlRoot.iter(cd('protein')) ] == ['pr1', 'pr2', 'pr3', 'pr5']
+	assert list(cdmlRoot.iter(cd('RNA'))) == []
+	# The other species are still converted
+	assert speciesById(cdmlRoot, 'geneIL_8').find('.//'+cd('geneReference')).text == 'gn1'
+
+# Three STAT1 species, each with its own protein, phosphorylated on named or unnamed residues
+stat1Species = [('STAT1_a', 'pr11', "StateVariable:P@727"), ('STAT1_b', 'pr12', "StateVariable:P@701\nStateVariable:P@727"),
+		('STAT1_c', 'pr10', "StateVariable:2P")]
+
+def stat1Map():
+	proteins = "".join([ '<celldesigner:protein id="%s" name="STAT1" type="GENERIC"/>' % protId for (speciesId, protId, notes) in stat1Species ])
+	species = "".join([ '<species id="%s" name="STAT1" compartment="c1"><notes><html xmlns="http://www.w3.org/1999/xhtml"><body>%s</body></html></notes>'
+			'<annotation><celldesigner:extension><celldesigner:speciesIdentity><celldesigner:class>PROTEIN</celldesigner:class>'
+			'<celldesigner:proteinReference>%s</celldesigner:proteinReference></celldesigner:speciesIdentity></celldesigner:extension></annotation></species>' % (speciesId, notes, protId)
+			for (speciesId, protId, notes) in stat1Species ])
+	return etree.fromstring(('<sbml xmlns="%s" xmlns:celldesigner="%s" level="2" version="4"><model><annotation><celldesigner:extension>'
+			'<celldesigner:listOfProteins>%s</celldesigner:listOfProteins></celldesigner:extension></annotation>'
+			'<listOfSpecies>%s</listOfSpecies></model></sbml>' % (namespaces['sbml'], namespaces['celldesigner'], proteins, species)).encode('utf-8'))
+
+def residueNames(cdmlRoot, speciesId):
+	"""Names of the residues (None if unnamed) of the modifications of a species, looked up in its protein."""
+	cdmlSpecies = speciesById(cdmlRoot, speciesId)
+	residues = ResidueRegistry(lookup('protein', cdmlRoot, id=cdmlSpecies.find('.//'+cd('proteinReference')).text)[0])
+	return sorted([ (str(residues.name(cdmlModification.get('residue'))), cdmlModification.get('state')) for cdmlModification in cdmlSpecies.iter(cd('modification')) ])
+
+def test_residue_registry_allocates_each_residue_once():
+	improve_cd_file.loadEtree()
+	residues = ResidueRegistry(etree.Element(cd('protein'), id='pr1'))
+	assert residues.namedResidue('P@727') == residues.namedResidue('P@727') == 'rs1'
+	assert [ residues.unnamedResidue('phosphorylated', rank) for rank in [0, 1, 0] ] == ['rs2', 'rs3', 'rs2']
+	assert residues.unnamedResidue('acetylated', 0) == 'rs4'
+	assert (residues.name('rs1'), residues.name('rs2')) == ('P@727', None)
+
+def test_merged_protein_keeps_the_residues_of_the_modification_pass():
+	improve_cd_file.loadEtree()
+	cdmlRoot = stat1Map()
+	adjustModifications(cdmlRoot)
+	expected = dict((speciesId, residueNames(cdmlRoot, speciesId)) for (speciesId, protId, notes) in stat1Species)
+	assert expected['STAT1_b'] == [('P@701', 'phosphorylated'), ('P@727', 'phosphorylated')]
+	assert expected['STAT1_c'] == [('None', 'phosphorylated'), ('None', 'phosphorylated')]
+
+	mergeDuplicatedSpecies(cdmlRoot)
+	# One protein left, with every residue once, and the same modifications for every species
+	assert [ cdmlProtein.get('id') for cdmlProtein in cdmlRoot.iter(cd('protein')) ] == ['pr10']
+	residueIds = [ cdmlResidue.get('id') for cdmlResidue in cdmlRoot.iter(cd('modificationResidue')) ]
+	assert len(residueIds) == len(set(residueIds)) == 4
+	for (speciesId, protId, notes) in stat1Species:
+		assert speciesById(cdmlRoot, speciesId).find('.//'+cd('proteinReference')).text == 'pr10'
+		assert residueNames(cdmlRoot, speciesId) == expected[speciesId], speciesId
+	# The two unnamed modifications of STAT1_c are on two residues
+	assert len(set([ cdmlModification.get('residue') for cdmlModification in speciesById(cdmlRoot, 'STAT1_c').iter(cd('modification')) ])) == 2
@@ -0,0 +1,52 @@
+# Knock-out / overexpression screen of a small BCML map (fixtures/small_bcml.xml) with
+# knockout_screen.py: effects against runs of boolean_network.py with the same seed, and
+# results that don't depend on how perturbations are split over chunks and processes.
+
+import os.path
+import xml.etree.ElementTree as ET
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from boolean_network import compileNetwork
+from knockout_screen import screen
+
+fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'small_bcml.xml')
+
+def effects(result):
+	(labels, species, rows, cols, data) = result
+	return sorted([ (labels[row], species[col], round(float(value), 6)) for (row, col, value) in zip(rows, cols, data) ])
+
+def clampedRun(network, initialStates, steps, mode, seed, perturbation):
+	"""Fraction of final states in which each node is ON, 'perturbation' clamped."""
+	clampMask = numpy.zeros(initialStates.shape, dtype=bool)
+	clampValues = numpy.zeros(initialStates.shape, dtype=bool)
+	for (nodeId, value) in perturbation:
+		clampMask[:, network.nodeIndex[nodeId]] = True
+		clampValues[:, network.nodeIndex[nodeId]] = value
+	(finalStates, isFixedPoint) = network.simulate(initialStates, steps, mode, numpy.random.RandomState(seed), (clampMask, clampValues))
+	return finalStates.sum(axis=0) / float(initialStates.shape[0])
+
+@pytest.mark.parametrize('mode', ['synchronous', 'asynchronous'])
+def test_effects_match_the_reference_run_for_the_same_seed(mode):
+	(samples, steps, seed) = (40, 20, 3)
+	(labels, species, rows, cols, data) = screen(fixture, False, samples, steps, mode, seed, 1, 5)
+	assert len(data) > 0
+
+	network = compileNetwork(ET.parse(fixture).getroot())
+	initialStates = network.randomStates(samples, numpy.random.RandomState(seed))
+	reference = clampedRun(network, initialStates, steps, mode, seed, [])
+	for (row, label) in enumerate(labels):
+		(nodeId, kind) = label.split(':')
+		expected = clampedRun(network, initialStates, steps, mode, seed, [(nodeId, kind == 'OE')]) - reference
+		expected[network.nodeIndex[nodeId]] = 0
+		found = numpy.zeros(len(species))
+		found[cols[rows == row]] = data[rows == row]
+		assert numpy.allclose(found, expected, atol=1e-6), label
+
+def test_effects_do_not_depend_on_chunks_and_processes():
+	reference = effects(screen(fixture, True, 24, 15, 'asynchronous', 7, 1, 1))
+	assert len(reference) > 0
+	assert effects(screen(fixture, True, 24, 15, 'asynchronous', 7, 1, 7)) == reference
+	assert effects(screen(fixture, True, 24, 15, 'asynchronous', 7, 2, 16)) == reference
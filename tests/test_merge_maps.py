@@ -0,0 +1,50 @@
+# Several BCML maps merged into one SBML atlas with merge_maps.py: canonical species
+# signatures, and species deduplicated on them across maps.
+
+import os.path
+import xml.etree.ElementTree as ET
+
+import pytest
+
+libsbml = pytest.importorskip('libsbml')
+
+from merge_maps import speciesSignatures, Atlas
+
+fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'small_bcml.xml')
+
+def fixtureMap(*edits):
+	with open(fixture) as bcmlHandle:
+		content = bcmlHandle.read()
+	for (old, new) in edits:
+		assert old in content
+		content = content.replace(old, new)
+	return ET.fromstring(content.encode('utf-8'))
+
+def test_species_signatures():
+	signatures = speciesSignatures(fixtureMap())
+	assert signatures['MYD88'] == ('Macromolecule', 'MYD88', ('2P', 'P@12'), (), 'Cytoplasm')
+	# Same label, other state variables or units of information
+	assert signatures['IRAK4'] != signatures['IRAK4_p']
+	assert signatures['geneIL_8'] == ('NucleicAcidFeature', 'IL-8', (), (('None', 'gene', 'None'),), 'Nucleus')
+	assert signatures['geneIL_8'] != signatures['mRNAIL_8']
+	# Complexes are described by their members (clones by the species they clone), not their id
+	tlr9 = signatures['TLR9']
+	assert signatures['clonecx'] == ('Complex', ('And', tuple(sorted([tlr9, signatures['X1']], key=repr))), (), (), 'Cytoplasm')
+	assert signatures['TLR9_MYD88'][1][1] == tuple(sorted([signatures['TLR9_c'], signatures['MYD88_c'], signatures['sub1']], key=repr))
+
+def test_species_are_merged_on_their_signature():
+	atlas = Atlas('atlas')
+	assert atlas.addMap(fixtureMap(), 'first.xml') == 0
+	# The same map, where TLR9 has another id and IkB another label
+	second = fixtureMap(('ID="TLR9" label="TLR9"', 'ID="TLR9bis" label="TLR9"'), ('cloneref="TLR9"', 'cloneref="TLR9bis"'),
+			('refNode="TLR9"', 'refNode="TLR9bis"'), ('label="IkB"', 'label="IkBa"'))
+	nbSpecies = atlas.model.getNumSpecies()
+	assert atlas.addMap(second, 'second.xml') == nbSpecies-1
+	speciesIds = [ sbmlSpecies.getId() for sbmlSpecies in atlas.model.getListOfSpecies() ]
+	assert 'TLR9bis' not in speciesIds
+	assert speciesIds[nbSpecies:] == ['second_IkB']
+
+	# The reactions of the second map use the species of the atlas
+	association = atlas.model.getReaction('second_re1')
+	assert sorted([ sbmlReference.getSpecies() for sbmlReference in association.getListOfReactants() ]) == ['MYD88', 'TLR9']
+	assert [ sbmlReference.getSpecies() for sbmlReference in atlas.model.getReaction('second_re7').getListOfReactants() ] == ['second_IkB']
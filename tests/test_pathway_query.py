@@ -0,0 +1,63 @@
+# Reachability index of pathway_query.py on a small hand-written SBML map: A -r1-> B -r2-> C,
+# C -r3-> B (a cycle), D -r4-> D (a self-loop), E modifies r5, which produces F.
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from pathway_query import loadIndex
+
+reactions = [('r1', ['A'], [], ['B']), ('r2', ['B'], [], ['C']), ('r3', ['C'], [], ['B']),
+		('r4', ['D'], [], ['D']), ('r5', [], ['E'], ['F'])]
+
+def writeMap(sbmlFile, reactions):
+	species = "".join([ '<species id="%s" name="%s_name" compartment="c"/>' % (speciesId, speciesId) for speciesId in 'ABCDEF' ])
+	sbmlReactions = ""
+	for (reactionId, reactants, modifiers, products) in reactions:
+		sbmlReactions += '<reaction id="%s">' % reactionId
+		for (listTag, referenceTag, references) in [('listOfReactants', 'speciesReference', reactants), ('listOfModifiers', 'modifierSpeciesReference', modifiers), ('listOfProducts', 'speciesReference', products)]:
+			if len(references) != 0:
+				sbmlReactions += '<%s>%s</%s>' % (listTag, "".join([ '<%s species="%s"/>' % (referenceTag, reference) for reference in references ]), listTag)
+		sbmlReactions += '</reaction>'
+	with open(sbmlFile, 'w') as sbmlHandle:
+		sbmlHandle.write('<sbml xmlns="http://www.sbml.org/sbml/level2/version4" level="2" version="4"><model>'
+				'<listOfCompartments><compartment id="c"/></listOfCompartments>'
+				'<listOfSpecies>'+species+'</listOfSpecies><listOfReactions>'+sbmlReactions+'</listOfReactions></model></sbml>')
+
+@pytest.fixture
+def index(tmp_path):
+	sbmlFile = str(tmp_path / 'map_sbml.xml')
+	writeMap(sbmlFile, reactions)
+	return loadIndex(sbmlFile)
+
+def test_species_reach_themselves_only_on_cycles(index):
+	assert [ speciesId for speciesId in 'ABCDEF' if index.reaches(speciesId, speciesId) ] == ['B', 'C', 'D']
+	assert index.reaches('A', 'C') and index.reaches('E', 'F')
+	assert not index.reaches('C', 'A') and not index.reaches('F', 'E')
+
+def test_closure_matches_a_search_of_the_graph(index):
+	successors = dict((speciesId, set()) for speciesId in 'ABCDEF')
+	for (reactionId, reactants, modifiers, products) in reactions:
+		for source in reactants+modifiers:
+			successors[source].update(products)
+	for source in 'ABCDEF':
+		reached = set()
+		frontier = set(successors[source])
+		while frontier:
+			reached |= frontier
+			frontier = set([ child for node in frontier for child in successors[node] ]) - reached
+		assert set([ target for target in 'ABCDEF' if index.reaches(source, target) ]) == reached, source
+
+def test_shortest_paths_give_the_reactions(index):
+	assert index.shortestPath('A', 'C') == [('A', 'r1'), ('B', 'r2'), ('C', None)]
+	assert index.shortestPath('B', 'B') == [('B', 'r2'), ('C', 'r3'), ('B', None)]
+	assert index.shortestPath('D_name', 'D') == [('D', 'r4'), ('D', None)]
+	assert index.shortestPath('E', 'F') == [('E', 'r5'), ('F', None)]
+	assert index.shortestPath('A', 'A') is None
+	assert index.shortestPath('C', 'A') is None
+
+def test_index_is_rebuilt_when_the_map_changes(tmp_path, index):
+	sbmlFile = str(tmp_path / 'map_sbml.xml')
+	assert loadIndex(sbmlFile).contentHash == index.contentHash
+	writeMap(sbmlFile, reactions+[('r6', ['F'], [], ['A'])])
+	assert loadIndex(sbmlFile).shortestPath('E', 'A') == [('E', 'r5'), ('F', 'r6'), ('A', None)]